@@ -23,7 +23,7 @@ class ResultAction(base.BoundFileAction):
     self.delayed_queries = []
 
     self.task_id = None
-    self.local_count, self.local_count, self.local_count = 0, 0, 0
+    self.local_count, self.remote_count, self.pair_count = 0, 0, 0
     if task_data:
       self.set_task_data(task_data)
 
@@ -33,9 +33,9 @@ class ResultAction(base.BoundFileAction):
     self.task_id = task_data['id']
     self.local_count = task_data['local_count']
     self.remote_count = task_data['remote_count']
-    self.match_count = task_data['match_count']
+    self.pair_count = task_data['pair_count']
     log('result').info("Task counts: %s, %s, %s", self.local_count,
-                       self.remote_count, self.match_count)
+                       self.remote_count, self.pair_count)
 
   def activate(self, ctx=None):
     super(ResultAction, self).activate(ctx)
@@ -48,69 +48,61 @@ class ResultAction(base.BoundFileAction):
   def start_results(self):
     self.ui.set_status("Receiving match results...")
     self.ui.progress.setRange(0, (self.local_count + self.remote_count +
-                                  self.match_count))
+                                  self.pair_count))
     self.ui.progress.setValue(0)
 
     log('result').info("Result download started")
-    params = {'from_matches__task': self.task_id}
-    q = network.QueryWorker("GET", "collab/instances/", paginated=True,
-                            json=True, params=params)
+    # locals, remotes and matches are all streamed by a single request, every
+    # instance is sent once before any of its matches
+    url = "collab/tasks/{}/results/".format(self.task_id)
+    q = network.QueryWorker("GET", url, stream=True)
     self.delayed_queries.append(q)
-    q.start(self.handle_locals)
+    q.start(self.handle_results)
 
-    params = {'to_matches__task': self.task_id,
-              'annotation_count': True}
-    q = network.QueryWorker("GET", "collab/instances/", paginated=True,
-                            json=True, params=params)
-    self.delayed_queries.append(q)
-    q.start(self.handle_remotes)
-
-    q = network.QueryWorker("GET", "collab/matches/", paginated=True,
-                            json=True, params={'task': self.task_id})
-    self.delayed_queries.append(q)
-    q.start(self.handle_matches)
-
-  def handle_locals(self, response):
-    for obj in response['results']:
-      # if local item was already created for a match result, update it with
-      # actual local item information while keeping any matches, otherwise
-      # create an empty matches list and assign object
-      if obj['id'] in self.locals:
-        self.locals[obj['id']].update(obj)
-      else:
-        self.locals[obj['id']] = obj
-        self.locals[obj['id']]['matches'] = []
-
-    log('result').info("locals new results %s", len(response['results']))
-    self.handle_page(len(response['results']))
-
-  def handle_remotes(self, response):
-    # this is pretty simple, just hold a mapping from ids to objects
+  def handle_results(self, response):
     for obj in response['results']:
-      self.remotes[obj['id']] = obj
-
-    log('result').info("remotes new results %s", len(response['results']))
+      kind = obj.pop('kind')
+      if kind == 'local':
+        self.add_local(obj)
+      elif kind == 'remote':
+        self.add_remote(obj)
+      elif kind == 'match':
+        self.add_match(obj)
+
+    log('result').info("new results %s", len(response['results']))
     self.handle_page(len(response['results']))
 
-  def handle_matches(self, response):
-    for match in response['results']:
-      local_id = match['from_instance']
-      # TODO: local_id may be removed instead of renamed to save some space
-      # Some other bits of data may also be removed
-      match['local_id'] = match.pop('from_instance')
-      match['remote_id'] = match.pop('to_instance')
-
-      # create an empty local item if matched local item was not processed yet
-      if local_id not in self.locals:
-        self.locals[local_id] = {}
-      if 'matches' not in self.locals[local_id]:
-        self.locals[local_id]['matches'] = []
-
-      # append match to locals
-      self.locals[local_id]['matches'].append(match)
+  def add_local(self, obj):
+    # if local item was already created for a match result, update it with
+    # actual local item information while keeping any matches, otherwise
+    # create an empty matches list and assign object
+    if obj['id'] in self.locals:
+      self.locals[obj['id']].update(obj)
+    else:
+      self.locals[obj['id']] = obj
+      self.locals[obj['id']]['matches'] = []
 
-    log('result').info("match new results %s", len(response['results']))
-    self.handle_page(len(response['results']))
+  def add_remote(self, obj):
+    # this is pretty simple, just hold a mapping from ids to objects
+    self.remotes[obj['id']] = obj
+
+  def add_match(self, match):
+    local_id = match['from_instance']
+    # TODO: local_id may be removed instead of renamed to save some space
+    # Some other bits of data may also be removed
+    match['local_id'] = match.pop('from_instance')
+    match['remote_id'] = match.pop('to_instance')
+    # matchers lists every match type of the pair, type joins them for display
+    match['type'] = ", ".join(match['matchers'])
+
+    # create an empty local item if matched local item was not processed yet
+    if local_id not in self.locals:
+      self.locals[local_id] = {}
+    if 'matches' not in self.locals[local_id]:
+      self.locals[local_id]['matches'] = []
+
+    # append match to locals
+    self.locals[local_id]['matches'].append(match)
 
   def handle_page(self, results_count):
     self.ui.progress.setValue(self.ui.progress.value() + results_count)
@@ -140,6 +132,7 @@ class ResultAction(base.BoundFileAction):
     if match:
       remote = {'offset': remote['offset'], 'name': remote['name'],
                 'score': match["score"], 'key': match["type"],
+                'keys': match["matchers"],
                 'local': remote['id'] in self.locals.keys()}
     context['remote'] = remote
 
@@ -9,6 +9,7 @@ from .. import network, netnode, log
 from . import base
 
 import hashlib
+import functools
 
 
 class UploadAction(base.BoundFileAction):
@@ -103,15 +104,24 @@ class UploadAction(base.BoundFileAction):
     # function clear and upload entire ready set to the server.
     url_params = "?force_update=true" if self.force_update else ""
     if len(self.instance_objs) >= 100 or not self.instances:
-      q = network.QueryWorker("POST", "collab/instances/" + url_params,
+      q = network.QueryWorker("POST", "collab/instances/bulk/" + url_params,
                               params=self.instance_objs, json=True)
-      q.start(self.progress_advance)
+      q.start(functools.partial(self.handle_upload, self.instance_objs))
       self.delayed_queries.append(q)
 
       self.instance_objs = []
       self.ui.increase_maximum()
     self.progress_advance()
 
+  def handle_upload(self, instance_objs, result):
+    # instances are uploaded in batches, invalid ones are skipped and reported
+    # by their index in the batch
+    for index, errors in result.get('errors', {}).items():
+      offset = instance_objs[int(index)].get('offset')
+      log('upload_action').warning("Instance at %s was not uploaded: %s",
+                                   offset, errors)
+    self.progress_advance()
+
   def progress_advance(self, result=None):
     del result
     self.ui.advance()
@@ -1,9 +1,8 @@
 from . import vectors
 from . import annotations
-from .. import log
+from .. import log, network
 
 import inspect
-import json
 
 
 def apply(offset, annotation):
@@ -13,7 +12,7 @@ def apply(offset, annotation):
             annotation_cls.type == annotation['type']):
       continue
 
-    annotation_data = json.loads(annotation['data'])
+    annotation_data = network.load_data(annotation['data'])
     annotation_obj = annotation_cls(offset)
     if annotation_obj.data() == annotation_data:
       log('annotation_apply').info("Setting annotation %s skipped at %s with "
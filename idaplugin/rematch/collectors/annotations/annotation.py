@@ -14,7 +14,7 @@ class Annotation(collector.Collector):
 
   def serialize(self):
     s = super(Annotation, self).serialize()
-    if s:
+    if s and self.uuid is not None:
       s["uuid"] = str(self.uuid)
     return s
 
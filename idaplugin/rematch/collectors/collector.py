@@ -1,4 +1,4 @@
-import json
+from .. import network
 
 
 class Collector(object):
@@ -9,4 +9,4 @@ class Collector(object):
     data = self.data()
     if data is None:
       return None
-    return {"type": self.type, "data": json.dumps(data)}
+    return {"type": self.type, "data": network.dump_data(data)}
@@ -1,7 +1,5 @@
 import ida_kernwin
 
-import json
-
 from .. idasix import QtGui, QtWidgets, QtCore
 
 from . import gui, widgets
@@ -135,7 +133,7 @@ class ResultDialog(gui.DockableDialog):
     if not len(response) == 1:
       raise exceptions.ServerException()
 
-    nodes = json.loads(response[0]['data'])
+    nodes = network.load_data(response[0]['data'])
     self.graph_dialog.SetNodes(nodes)
     self.graph_dialog.Show()
     self.reset_focus()
@@ -196,7 +194,6 @@ class ResultDialog(gui.DockableDialog):
 
     self.apply_pbar = QtWidgets.QProgressDialog("", "&Cancel", 0, item_count)
 
-    # TODO: optimize this query
     q = network.QueryWorker("GET", "collab/annotations/full_hierarchy",
                             params={"instance": self.matched_map.keys()},
                             json=True)
@@ -184,7 +184,12 @@ class FilterDialog(gui.GuiDialog):
                     "<b>'score'</b>: (INTERNAL) a float between 0 and 1.0 "
                     "representing the match score of this function and the "
                     "core element",
-                    "<b>'key'</b>: (INTERNAL) the match type.",
+                    "<b>'key'</b>: (INTERNAL) the match types of all "
+                    "matchers that matched the two functions, joined by "
+                    "commas (such as 'assembly_hash, name_hash').",
+                    "<b>'keys'</b>: (INTERNAL) a list of the match types of "
+                    "all matchers that matched the two functions, best "
+                    "tested with 'in'.",
                     "<b>'documentation'</b>: (INTERNAL) available "
                     "documentation for each line of code",
                     "<b>'local'</b> : True if this function originated from "
@@ -1,5 +1,3 @@
-import json
-
 # Try python 2 and then python 3
 try:
   from urllib2 import HTTPError, URLError
@@ -74,7 +72,8 @@ def factory(ex):
   if isinstance(ex, HTTPError):
     response_text = ex.read()
     try:
-      response = json.loads(response_text)
+      from .network import load_response
+      response = load_response(response_text, ex.headers.get('Content-Type'))
     except Exception:
       response = response_text
     ex_cls = None
@@ -11,9 +11,19 @@ except ImportError:
   from http.cookiejar import CookieJar
 
 from json import loads, dumps
+import zlib
+
+# msgpack is optional, plugin falls back to exchanging json when it's missing
+try:
+  import msgpack
+except ImportError:
+  msgpack = None
 
 from . import config, log, utils, exceptions
 
+MSGPACK_TYPE = 'application/msgpack'
+MSGPACK_PREFIX = 'collab/'
+
 # building opener
 cookiejar = CookieJar()
 opener = request.build_opener(request.HTTPCookieProcessor(cookiejar))
@@ -31,7 +41,7 @@ class QueryWorker(QtCore.QRunnable):
   SPLIT = 900
 
   def __init__(self, method, url, server=None, token=None, params=None,
-               json=False, paginated=False, splittable=None):
+               json=False, paginated=False, splittable=None, stream=False):
     super(QueryWorker, self).__init__()
 
     # TODO: conside making paginated infered from response
@@ -47,6 +57,9 @@ class QueryWorker(QtCore.QRunnable):
     if paginated and not json:
       raise Exception("paginated=True must accompany json=True")
 
+    if stream and (paginated or splittable or method != "GET"):
+      raise ValueError("QueryWorker can only stream a single GET request")
+
     self.method = method
     self.url = url
     self.server = server
@@ -55,6 +68,7 @@ class QueryWorker(QtCore.QRunnable):
     self.json = json
     self.paginated = paginated
     self.splittable = splittable
+    self.stream = stream
     if self.splittable:
       self.splittable_values = self.params[self.splittable]
     else:
@@ -106,6 +120,21 @@ class QueryWorker(QtCore.QRunnable):
     self.running = False
 
   def run_query(self):
+    # streamed responses are emitted as pages of the objects received so far,
+    # so callbacks handle them the same as paginated responses
+    if self.stream:
+      pages = stream_query(self.url, self.server, self.token, self.params)
+      try:
+        for results in pages:
+          # stop receiving as soon as the worker is cancelled
+          if not self.running:
+            break
+          yield {'results': results}
+      finally:
+        # closes the response of an incomplete stream
+        pages.close()
+      return
+
     while self.running:
       if self.splittable:
         self.params[self.splittable] = self.splittable_values[:self.SPLIT]
@@ -134,8 +163,9 @@ class QueryWorker(QtCore.QRunnable):
       break
 
   def run(self):
+    responses = self.run_query()
     try:
-      for response in self.run_query():
+      for response in responses:
         # make sure QueryWorker wasn't cancelled while query was blocking
         if not self.running:
           break
@@ -145,6 +175,9 @@ class QueryWorker(QtCore.QRunnable):
       import traceback
       log('network').info("emitting exception: %s", ex)
       self.signals.error.emit(ex, traceback.format_exc())
+    finally:
+      # release a cancelled stream's response right away
+      responses.close()
 
     self.running = False
 
@@ -161,12 +194,19 @@ def default_exception_callback(exception, traceback):
   print("callback exception: {}".format(traceback))
 
 
-def build_params(method, params):
+def uses_msgpack(url):
+  """Only collab endpoints negotiate msgpack, all others exchange json"""
+  return msgpack is not None and url.startswith(MSGPACK_PREFIX)
+
+
+def build_params(method, params, binary=False):
   """Convert params format based on request paramters."""
   if not params:
     return ""
 
   if method in ("POST", "PATCH") and isinstance(params, (list, dict)):
+    if binary:
+      return msgpack.packb(params, use_bin_type=True)
     return dumps(params)
   elif method == "GET" and isinstance(params, dict):
     return urllib.urlencode(params, doseq=True)
@@ -183,13 +223,14 @@ def query(method, url, server=None, token=None, params=None, json=False):
     raise exceptions.QueryException()
 
   full_url = server_url + url
-  headers = get_headers(token, json)
+  binary = json and uses_msgpack(url)
+  headers = get_headers(token, json, binary)
 
   log('network').info("[query] %s %s%s%s", method, full_url, headers, params)
 
   # issue request
   try:
-    params = build_params(method, params)
+    params = build_params(method, params, binary)
 
     if method == "GET":
       req = request.Request(full_url + "?" + params, headers=headers)
@@ -204,12 +245,99 @@ def query(method, url, server=None, token=None, params=None, json=False):
     response_obj = response.read()
     log('network').info("[response] %s", response_obj)
     if json:
-      response_obj = loads(response_obj)
+      response_obj = load_response(response_obj,
+                                   response.info().get('Content-Type'))
     return response_obj
   except Exception as ex:
     exceptions.factory(ex)
 
 
+def stream_query(url, server=None, token=None, params=None, batch_size=1000):
+  """Issue a GET request for an NDJSON stream, yielding lists of up to
+  batch_size objects as soon as they are received, without holding the entire
+  response in memory."""
+  server_url = get_server(server)
+  if not server_url:
+    raise exceptions.QueryException()
+
+  full_url = server_url + url
+  headers = get_headers(token, False)
+  headers['Accept'] = 'application/x-ndjson'
+  headers['Accept-Encoding'] = 'gzip'
+
+  log('network').info("[stream] %s%s%s", full_url, headers, params)
+
+  response = None
+  try:
+    req = request.Request(full_url + "?" + build_params("GET", params),
+                          headers=headers)
+    response = opener.open(req)
+
+    gzipped = response.info().get('Content-Encoding') == 'gzip'
+    results = []
+    for line in iter_lines(response, gzipped):
+      results.append(loads(line))
+      if len(results) >= batch_size:
+        yield results
+        results = []
+    if results:
+      yield results
+  except Exception as ex:
+    exceptions.factory(ex)
+  finally:
+    if response is not None:
+      response.close()
+
+
+def iter_lines(response, gzipped, chunk_size=64 * 1024):
+  """Yield the non empty lines of a response as they are received"""
+  decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS) if gzipped else None
+  remainder = b''
+  while True:
+    chunk = response.read(chunk_size)
+    if not chunk:
+      break
+    if decompressor:
+      chunk = decompressor.decompress(chunk)
+
+    lines = (remainder + chunk).split(b'\n')
+    remainder = lines.pop()
+    for line in lines:
+      if line.strip():
+        yield line.decode('utf-8')
+
+  if decompressor:
+    remainder += decompressor.flush()
+  if remainder.strip():
+    yield remainder.decode('utf-8')
+
+
+def load_response(response_obj, content_type):
+  if content_type and content_type.split(';')[0].strip() == MSGPACK_TYPE:
+    return msgpack.unpackb(response_obj, raw=False)
+  return loads(response_obj)
+
+
+def dump_data(data):
+  """Encode a json document field, such as vector and annotation data. Those
+  are sent as nested data when using msgpack, and as json strings otherwise.
+  Documents are only sent to collab endpoints, which use msgpack whenever
+  it is available."""
+  if msgpack:
+    return data
+  return dumps(data)
+
+
+def load_data(data):
+  """Decode a json document field received in a response. Documents are
+  objects or arrays, which msgpack responses hold as nested data and json
+  responses (including streamed ones) hold as json strings, so only strings
+  are decoded regardless of which format the server responded with"""
+  if isinstance(data, (type(u''), bytes)):
+    return loads(data)
+  return data
+
+
 def get_server(server):
   """getting and finalzing server address."""
 
@@ -225,11 +353,14 @@ def get_server(server):
   return server
 
 
-def get_headers(token, json):
+def get_headers(token, json, binary=False):
   """Setting up headers."""
 
   headers = {}
-  if json:
+  if json and binary:
+    headers['Accept'] = MSGPACK_TYPE + ', application/json, */*'
+    headers['Content-Type'] = MSGPACK_TYPE
+  elif json:
     headers['Accept'] = 'application/json, text/html, */*'
     headers['Content-Type'] = 'application/json'
   if token is None and 'token' in config['login']:
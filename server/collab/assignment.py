@@ -0,0 +1,79 @@
+import numpy as np
+import scipy.sparse
+
+# sparse bipartite matching was added in scipy 1.6, which is not available
+# for python 2, so optimal assignment is only supported on python 3
+try:
+  from scipy.sparse.csgraph import min_weight_full_bipartite_matching
+except ImportError:
+  min_weight_full_bipartite_matching = None
+
+
+def is_optimal_assignment_supported():
+  return min_weight_full_bipartite_matching is not None
+
+
+def greedy_assignment(sources, targets, scores, limit=1):
+  """Return a mask of pairs assigned by picking pairs in descending score
+  order, as long as neither of their instances is already assigned limit
+  pairs. Ties are broken by pair order."""
+  source_index = np.unique(sources, return_inverse=True)[1]
+  target_index = np.unique(targets, return_inverse=True)[1]
+  source_counts = np.zeros(source_index.max() + 1, dtype=np.int64)
+  target_counts = np.zeros(target_index.max() + 1, dtype=np.int64)
+
+  assigned = np.zeros(len(scores), dtype=bool)
+  for pair in np.argsort(-scores, kind='mergesort').tolist():
+    source, target = source_index[pair], target_index[pair]
+    if source_counts[source] >= limit or target_counts[target] >= limit:
+      continue
+    source_counts[source] += 1
+    target_counts[target] += 1
+    assigned[pair] = True
+  return assigned
+
+
+def optimal_assignment(sources, targets, scores):
+  """Return a mask of pairs of a one-to-one assignment maximizing the sum of
+  assigned scores, solved as a sparse minimum weight bipartite matching.
+
+  Matching has to be complete, so every source and target also gets a
+  dummy node to be matched with when left unassigned. Costs are chosen so
+  that the cost of an assignment is a constant minus the sum of its scores:
+  a pair costs MAX + 1 - score plus 1 for its pair of dummies, while leaving
+  both instances unassigned costs MAX / 2 + 1 for each of them."""
+  sources, source_index = np.unique(sources, return_inverse=True)
+  targets, target_index = np.unique(targets, return_inverse=True)
+  source_count, target_count = len(sources), len(targets)
+  pair_count = len(scores)
+  max_score = scores.max()
+
+  # rows are sources followed by target dummies, columns are targets
+  # followed by source dummies
+  source_range = np.arange(source_count)
+  target_range = np.arange(target_count)
+  rows = np.concatenate([source_index, source_range,
+                         source_count + target_range,
+                         source_count + target_index])
+  columns = np.concatenate([target_index, target_count + source_range,
+                            target_range, target_count + source_index])
+  costs = np.concatenate([max_score + 1 - scores,
+                          np.full(source_count + target_count,
+                                  max_score / 2. + 1),
+                          np.ones(pair_count)])
+
+  size = source_count + target_count
+  graph = scipy.sparse.csr_matrix((costs, (rows, columns)),
+                                  shape=(size, size))
+  matched_rows, matched_columns = min_weight_full_bipartite_matching(graph)
+
+  matched_columns = matched_columns[matched_rows < source_count]
+  matched_rows = matched_rows[matched_rows < source_count]
+  matched = matched_columns < target_count
+  assignment = {(row, column) for row, column
+                in zip(matched_rows[matched].tolist(),
+                       matched_columns[matched].tolist())}
+
+  return np.array([pair in assignment for pair
+                   in zip(source_index.tolist(), target_index.tolist())],
+                  dtype=bool)
@@ -0,0 +1,69 @@
+from itertools import islice
+
+from django.db import connection
+
+
+def copy_rows(model, fields, rows, batch_size=10000):
+  """Stream rows straight into model's table using PostgreSQL's COPY FROM
+  STDIN, without creating any model objects. Each row is a tuple of values
+  ordered the same as fields. Rows are copied in batches, so a rows generator
+  is free to query the database between batches. Returns the number of copied
+  rows."""
+  quote_name = connection.ops.quote_name
+  columns = ", ".join(quote_name(model._meta.get_field(f).column)
+                      for f in fields)
+  sql = "COPY {} ({}) FROM STDIN".format(quote_name(model._meta.db_table),
+                                         columns)
+
+  rows = iter(rows)
+  count = 0
+  with connection.cursor() as cursor:
+    while True:
+      # no queries may be issued while a COPY is in progress, so pull an
+      # entire batch before starting one
+      rows_batch = list(islice(rows, batch_size))
+      if not rows_batch:
+        break
+      cursor.copy_expert(sql, RowsFile(rows_batch))
+      count += len(rows_batch)
+  return count
+
+
+class RowsFile(object):
+  """A read-only file-like object, lazily encoding rows in COPY's text format
+  as they're read."""
+
+  ESCAPES = {ord('\\'): u'\\\\', ord('\t'): u'\\t', ord('\n'): u'\\n',
+             ord('\r'): u'\\r'}
+
+  def __init__(self, rows):
+    self.rows = iter(rows)
+    self.buffer = u''
+
+  def read(self, size=-1):
+    chunks = [self.buffer]
+    length = len(self.buffer)
+    while size < 0 or length < size:
+      try:
+        row = next(self.rows)
+      except StopIteration:
+        break
+      line = u'\t'.join(self.encode_value(v) for v in row) + u'\n'
+      chunks.append(line)
+      length += len(line)
+
+    data = u''.join(chunks)
+    if size < 0:
+      size = len(data)
+    self.buffer = data[size:]
+    return data[:size]
+
+  @classmethod
+  def encode_value(cls, value):
+    if value is None:
+      return u'\\N'
+    if isinstance(value, bool):
+      return u't' if value else u'f'
+    if not isinstance(value, type(u'')):
+      value = u'{}'.format(value)
+    return value.translate(cls.ESCAPES)
@@ -0,0 +1,178 @@
+import glob
+import os
+import shutil
+import tempfile
+import time
+
+import numpy as np
+import scipy.sparse
+
+from django.conf import settings
+
+
+# Replaced versions of stored matrices are kept around for loads that resolved
+# them before they were replaced
+STALE_VERSION_SECONDS = 10 * 60
+
+
+class FeatureMatrix(object):
+  """Sparse histogram matrix of vectors, one row per instance sorted by
+  instance id. Columns are the stable FeatureKey columns of histogram keys,
+  so matrices of different file versions share their columns."""
+  ARRAYS = ('instance_ids', 'data', 'indices', 'indptr')
+
+  def __init__(self, instance_ids, data, indices, indptr, version=0):
+    self.instance_ids = instance_ids
+    # FeatureVersion of the vectors the matrix was built out of
+    self.version = version
+    column_count = int(indices.max()) + 1 if len(indices) else 0
+    self.matrix = scipy.sparse.csr_matrix((data, indices, indptr),
+                                          shape=(len(instance_ids),
+                                                 column_count),
+                                          copy=False)
+
+  @classmethod
+  def from_rows(cls, rows, version=0):
+    """Build a matrix out of (instance_id, hist_columns, hist_values) rows
+    sorted by instance id."""
+    instance_ids = []
+    data = []
+    indices = []
+    indptr = [0]
+    for instance_id, hist_columns, hist_values in rows:
+      instance_ids.append(instance_id)
+      if hist_columns:
+        data.extend(hist_values)
+        indices.extend(hist_columns)
+      indptr.append(len(indices))
+
+    return cls(np.array(instance_ids, dtype=np.int64),
+               np.array(data, dtype=np.float64),
+               np.array(indices, dtype=np.int32),
+               np.array(indptr, dtype=np.int64), version)
+
+  def select(self, instance_ids):
+    """Return the rows of instance_ids, or None if any of them is missing.
+    Selecting all rows returns the stored matrix itself, without copying."""
+    if np.array_equal(self.instance_ids, instance_ids):
+      return self.matrix
+
+    if not len(self.instance_ids):
+      return None
+
+    rows = np.searchsorted(self.instance_ids, instance_ids)
+    rows = np.minimum(rows, len(self.instance_ids) - 1)
+    if not np.array_equal(self.instance_ids[rows], instance_ids):
+      return None
+    return self.matrix[rows]
+
+  def save(self, path):
+    """Atomically store matrix at path. Every save writes a new directory
+    next to path and then replaces the path symlink to point at it, so
+    concurrent loads map either the previous arrays or the new ones. Replaced
+    directories are only removed once stale, as loads may still be reading
+    them."""
+    parent = os.path.dirname(path)
+    if not os.path.isdir(parent):
+      try:
+        os.makedirs(parent)
+      except OSError:
+        # created concurrently by another worker
+        if not os.path.isdir(parent):
+          raise
+
+    version_path = tempfile.mkdtemp(prefix=os.path.basename(path) + '.',
+                                    dir=parent)
+    arrays = (self.instance_ids, self.matrix.data, self.matrix.indices,
+              self.matrix.indptr)
+    for name, array in zip(self.ARRAYS, arrays):
+      np.save(os.path.join(version_path, name + '.npy'), array)
+    np.save(os.path.join(version_path, 'version.npy'),
+            np.array([self.version], dtype=np.int64))
+
+    # renaming a symlink over path replaces it atomically, unlike directories
+    link_path = version_path + '.link'
+    os.symlink(os.path.basename(version_path), link_path)
+    os.rename(link_path, path)
+    remove_stale_versions(path)
+
+  @classmethod
+  def load(cls, path):
+    """Load a stored matrix, memory mapping its arrays so all workers on the
+    same host share a single copy in the page cache."""
+    # resolve the stored version once, so all arrays are of the same one
+    path = os.path.realpath(path)
+    if not os.path.isdir(path):
+      return None
+
+    try:
+      arrays = [np.load(os.path.join(path, name + '.npy'), mmap_mode='r')
+                for name in cls.ARRAYS]
+      version = int(np.load(os.path.join(path, 'version.npy'))[0])
+    except (IOError, OSError):
+      # removed concurrently
+      return None
+    return cls(*arrays, version=version)
+
+
+def remove_stale_versions(path):
+  """Remove stored versions of path other than the current one, once they
+  were not modified for STALE_VERSION_SECONDS"""
+  current_path = os.path.realpath(path) if os.path.islink(path) else None
+  expiry = time.time() - STALE_VERSION_SECONDS
+  for version_path in glob.glob(path + '.*'):
+    if (version_path == current_path or os.path.islink(version_path) or
+        not os.path.isdir(version_path)):
+      continue
+    try:
+      if os.path.getmtime(version_path) > expiry:
+        continue
+    except OSError:
+      # removed concurrently by another worker
+      continue
+    shutil.rmtree(version_path, ignore_errors=True)
+
+
+def get_path(file_version_id, vector_type):
+  return os.path.join(settings.FEATURE_STORE_ROOT, str(file_version_id),
+                      vector_type)
+
+
+def build(file_version_id, vector_type):
+  from collab.models import Vector, FeatureVersion
+
+  # the version is read first, so vectors changed while building are stored
+  # along with an older version and rebuilt the next time they are used
+  version = FeatureVersion.get_version(file_version_id, vector_type)
+  vectors = Vector.objects.filter(file_version_id=file_version_id,
+                                  type=vector_type)
+  rows = (vectors.order_by('instance_id')
+                 .values_list('instance_id', 'hist_columns', 'hist_values'))
+  features = FeatureMatrix.from_rows(rows.iterator(), version)
+  features.save(get_path(file_version_id, vector_type))
+  return features
+
+
+def get(file_version_id, vector_type):
+  """Return the stored features of a file version, building them if they
+  were not built on this host yet, or were built out of vectors that have
+  changed since."""
+  from collab.models import FeatureVersion
+
+  features = FeatureMatrix.load(get_path(file_version_id, vector_type))
+  version = FeatureVersion.get_version(file_version_id, vector_type)
+  if features is None or features.version != version:
+    features = build(file_version_id, vector_type)
+  return features
+
+
+def select(file_version_id, vector_type, instance_ids):
+  """Return the stored features of instance_ids of a file version. Features
+  are rebuilt if any instance is missing from them, as happens when vectors
+  are uploaded after the store was built."""
+  features = get(file_version_id, vector_type)
+  matrix = features.select(instance_ids)
+  if matrix is None:
+    features = build(file_version_id, vector_type)
+    matrix = features.select(instance_ids)
+  return matrix
@@ -0,0 +1,245 @@
+import json
+import numbers
+import uuid
+
+from django.db import transaction
+
+from collab.models import FileVersion, Instance, Vector, Annotation
+from collab.bulk import copy_rows
+
+
+# Order of values in annotation rows provided to copy_rows
+ANNOTATION_FIELDS = ('instance', 'uuid', 'type', 'data')
+
+
+class Invalid(ValueError):
+  pass
+
+
+def integer(value):
+  if isinstance(value, bool) or not isinstance(value, numbers.Integral):
+    raise Invalid("A valid integer is required.")
+  return value
+
+
+def choice(choices):
+  values = {value for value, _ in choices}
+
+  def check(value):
+    if value not in values:
+      raise Invalid("\"{}\" is not a valid choice.".format(value))
+    return value
+  return check
+
+
+def document(value):
+  # documents are stored JSON encoded, the same as JSONStringField stores
+  # them. JSON clients send them encoded
+  if not isinstance(value, (type(u''), str)):
+    raise Invalid("Not a valid string.")
+  try:
+    json.loads(value)
+  except ValueError:
+    raise Invalid("Not a valid JSON document.")
+  return value
+
+
+def nested_document(value):
+  # msgpack clients send documents as nested data, which may be a string
+  try:
+    return json.dumps(value)
+  except (TypeError, ValueError):
+    raise Invalid("Not a valid JSON document.")
+
+
+def uuid_value(value):
+  try:
+    return uuid.UUID(value)
+  except (AttributeError, TypeError, ValueError):
+    raise Invalid("Must be a valid UUID.")
+
+
+def optional(check):
+  def check_optional(value):
+    return None if value is None else check(value)
+  check_optional.optional = True
+  return check_optional
+
+
+INSTANCE_SCHEMA = {'file_version': integer,
+                   'type': choice(Instance.TYPE_CHOICES),
+                   'offset': optional(integer),
+                   'size': integer,
+                   'count': integer}
+VECTOR_SCHEMA = {'type': choice(Vector.TYPE_CHOICES),
+                 'type_version': integer,
+                 'data': document}
+ANNOTATION_SCHEMA = {'type': choice(Annotation.TYPE_CHOICES),
+                     'data': document,
+                     'uuid': optional(uuid_value)}
+NESTED_VECTOR_SCHEMA = dict(VECTOR_SCHEMA, data=nested_document)
+NESTED_ANNOTATION_SCHEMA = dict(ANNOTATION_SCHEMA, data=nested_document)
+
+
+def validate_object(data, schema):
+  """Return the cleaned fields of a JSON object and the errors of every
+  invalid field, keyed the same as serializer errors are"""
+  if not isinstance(data, dict):
+    return None, {'non_field_errors': ["Expected an object."]}
+
+  cleaned = {}
+  errors = {}
+  for name, check in schema.items():
+    if name not in data and not getattr(check, 'optional', False):
+      errors[name] = ["This field is required."]
+      continue
+    try:
+      cleaned[name] = check(data.get(name))
+    except Invalid as ex:
+      errors[name] = [str(ex)]
+  return cleaned, errors
+
+
+def validate_list(data, schema, unique_field):
+  if data is None:
+    return [], None
+  if not isinstance(data, list):
+    return None, ["Expected a list of items."]
+
+  items = []
+  errors = {}
+  values = set()
+  for index, item_data in enumerate(data):
+    item, item_errors = validate_object(item_data, schema)
+    if not item_errors:
+      value = item[unique_field]
+      if value is not None and value in values:
+        item_errors = {unique_field: ["Must be unique."]}
+      values.add(value)
+    if item_errors:
+      errors[index] = item_errors
+    items.append(item)
+  return items, errors or None
+
+
+def validate_instance(data, nested_documents=False):
+  """Validate an instance and its nested vectors and annotations, without
+  querying the database. Documents are expected as nested data rather than
+  JSON strings when nested_documents is set."""
+  instance, errors = validate_object(data, INSTANCE_SCHEMA)
+  if instance is None:
+    return None, errors
+
+  if nested_documents:
+    vector_schema, annotation_schema = (NESTED_VECTOR_SCHEMA,
+                                        NESTED_ANNOTATION_SCHEMA)
+  else:
+    vector_schema, annotation_schema = VECTOR_SCHEMA, ANNOTATION_SCHEMA
+  for field, schema, unique_field in (('vectors', vector_schema, 'type'),
+                                      ('annotations', annotation_schema,
+                                       'uuid')):
+    instance[field], field_errors = validate_list(data.get(field), schema,
+                                                  unique_field)
+    if field_errors:
+      errors[field] = field_errors
+
+  # vectors matchers could not encode or derive from would fail the batch
+  vector_errors = errors.get('vectors', {})
+  for index, vector in enumerate(instance['vectors'] or ()):
+    if index in vector_errors:
+      continue
+    try:
+      Vector.validate_data(vector['type'], vector['data'])
+    except ValueError as ex:
+      vector_errors[index] = {'data': [str(ex)]}
+  if vector_errors:
+    errors['vectors'] = vector_errors
+  return instance, errors
+
+
+def validate_instances(items, nested_documents=False):
+  """Validate a batch of instances. Returns the cleaned instances, and the
+  errors of every invalid instance keyed by its index. Conflicts with stored
+  objects are looked up with a query per model for the entire batch."""
+  instances = {}
+  errors = {}
+  for index, data in enumerate(items):
+    instance, instance_errors = validate_instance(data, nested_documents)
+    if instance_errors:
+      errors[index] = instance_errors
+    else:
+      instances[index] = instance
+
+  file_version_ids = {i['file_version'] for i in instances.values()}
+  file_versions = FileVersion.objects.in_bulk(file_version_ids)
+  offsets = set(Instance.objects.filter(file_version__in=file_version_ids,
+                                        offset__in={i['offset'] for i
+                                                    in instances.values()})
+                                .values_list('file_version', 'offset'))
+  uuids = {a['uuid'] for i in instances.values() for a in i['annotations']}
+  uuids = set(Annotation.objects.filter(uuid__in=uuids - {None})
+                                .values_list('uuid', flat=True))
+
+  for index, instance in sorted(instances.items()):
+    instance_errors = {}
+    file_version = file_versions.get(instance['file_version'])
+    offset = (instance['file_version'], instance['offset'])
+    if file_version is None:
+      instance_errors['file_version'] = ["Invalid pk \"{}\" - object does "
+                                         "not exist.".format(offset[0])]
+    elif offset[1] is not None and offset in offsets:
+      instance_errors['offset'] = ["Instance with this file version and "
+                                   "offset already exists."]
+
+    instance_uuids = {a['uuid'] for a in instance['annotations']} - {None}
+    annotation_errors = {i: {'uuid': ["Annotation with this uuid already "
+                                      "exists."]}
+                         for i, a in enumerate(instance['annotations'])
+                         if a['uuid'] in uuids}
+    if annotation_errors:
+      instance_errors['annotations'] = annotation_errors
+
+    if instance_errors:
+      errors[index] = instance_errors
+      del instances[index]
+      continue
+    instance['file_version'] = file_version
+    offsets.add(offset)
+    uuids |= instance_uuids
+  return instances, errors
+
+
+@transaction.atomic
+def ingest_instances(owner, items, nested_documents=False):
+  """Store a batch of uploaded instances with their vectors and annotations
+  in a few statements for the entire batch. Invalid instances are skipped.
+  Returns the id of every stored instance, or None in place of skipped
+  ones, and the errors of every skipped instance keyed by its index."""
+  instances, errors = validate_instances(items, nested_documents)
+
+  objs = {index: Instance(owner=owner, file_version=data['file_version'],
+                          type=data['type'], offset=data['offset'],
+                          size=data['size'], count=data['count'])
+          for index, data in instances.items()}
+  # ids of created instances are returned by the multi-row INSERT
+  Instance.objects.bulk_create(objs.values())
+
+  # vectors have binary and array typed fields, so they're inserted with a
+  # multi-row INSERT as well rather than copied as text
+  vectors = [Vector(instance=objs[index], file_version=obj.file_version,
+                    **vector_data)
+             for index, obj in objs.items()
+             for vector_data in instances[index]['vectors']]
+  Vector.encode_vectors(vectors)
+  vectors += Vector.derive_vectors(vectors)
+  Vector.objects.bulk_create(vectors)
+
+  annotation_rows = ((obj.id, annotation['uuid'], annotation['type'],
+                      annotation['data'])
+                     for index, obj in objs.items()
+                     for annotation in instances[index]['annotations'])
+  copy_rows(Annotation, ANNOTATION_FIELDS, annotation_rows)
+
+  ids = [objs[index].id if index in objs else None
+         for index in range(len(items))]
+  return ids, errors
@@ -0,0 +1,196 @@
+import re
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+
+from collab.models import File, FileVersion, Task, Instance, Vector, Match
+
+
+# Indexes created by migration 0013_matching_indexes, and the indexes they
+# replaced
+INDEXES = ('collab_vector_matching', 'collab_instance_sizes',
+           'collab_match_task_from', 'collab_match_task_to')
+REPLACED_INDEXES = ('collab_match (task_id)',)
+
+VECTOR_TYPES = (Vector.TYPE_ASSEMBLY_HASH, Vector.TYPE_NAME_HASH)
+
+
+class Command(BaseCommand):
+  help = ("Generate a vectors dataset and compare the plans and timings of "
+          "matcher and result queries with and without the matching "
+          "indexes. Generated data is deleted once done. Tables are locked "
+          "while queries are run without indexes, so avoid running against "
+          "a live server.")
+
+  def add_arguments(self, parser):
+    parser.add_argument('--vectors', type=int, default=10 ** 7)
+    parser.add_argument('--file-versions', type=int, default=100)
+    parser.add_argument('--tasks', type=int, default=10)
+    parser.add_argument('--hashes', type=int, default=10 ** 5,
+                        help="Number of distinct vector hashes")
+
+  def handle(self, *args, **options):
+    del args
+    with connection.cursor() as cursor:
+      cursor.execute("SELECT indexname FROM pg_indexes "
+                     "WHERE indexname = ANY(%s)", [list(INDEXES)])
+      missing = set(INDEXES) - {name for name, in cursor.fetchall()}
+    if missing:
+      raise CommandError("Missing indexes {}, migrate first"
+                         "".format(", ".join(sorted(missing))))
+
+    # generated data is committed, so it can be vacuumed and index only
+    # scans are planned the same as they are for previously uploaded vectors
+    owner = User.objects.create(username='benchmark_indexes')
+    try:
+      queries = self.generate(owner, options['vectors'],
+                              options['file_versions'], options['tasks'],
+                              options['hashes'])
+      with connection.cursor() as cursor:
+        cursor.execute("VACUUM ANALYZE collab_instance, collab_vector, "
+                       "collab_match")
+      self.benchmark(queries)
+    finally:
+      self.cleanup(owner)
+
+  def generate(self, owner, vector_count, file_version_count, task_count,
+               hash_count):
+    instance_count = vector_count // len(VECTOR_TYPES) // file_version_count
+    self.stdout.write("Generating {} file versions of {} instances"
+                      "".format(file_version_count, instance_count))
+
+    target_file = File.objects.create(owner=owner, name='target',
+                                      description='', md5hash='0' * 32)
+    file_versions = [FileVersion.objects.create(file=target_file,
+                                                md5hash='{:032x}'.format(i),
+                                                complete=True)
+                     for i in range(file_version_count)]
+    tasks = [Task.objects.create(owner=owner,
+                                 source_file_version=file_versions[i],
+                                 matchers='[]')
+             for i in range(min(task_count, file_version_count - 1))]
+
+    with connection.cursor() as cursor:
+      cursor.execute("INSERT INTO collab_instance "
+                     "(created, owner_id, file_version_id, type, \"offset\", "
+                     "size, count) "
+                     "SELECT NOW(), %s, fv.id, 'function', i, "
+                     "(RANDOM() * 10000)::bigint, (RANDOM() * 1000)::bigint "
+                     "FROM collab_fileversion AS fv, "
+                     "generate_series(0, %s - 1) AS i "
+                     "WHERE fv.file_id = %s",
+                     [owner.id, instance_count, target_file.id])
+
+      # hashes are packed the same as HashMatcher.pack_hash packs integers
+      self.stdout.write("Generating vectors")
+      cursor.execute("INSERT INTO collab_vector "
+                     "(instance_id, file_version_id, type, type_version, "
+                     "data, hash) "
+                     "SELECT i.id, i.file_version_id, t.type, 0, '', "
+                     "int8send((RANDOM() * %s)::bigint) "
+                     "FROM collab_instance AS i, "
+                     "UNNEST(%s::text[]) AS t(type) "
+                     "WHERE i.owner_id = %s",
+                     [hash_count, list(VECTOR_TYPES), owner.id])
+
+      # every task matches each source instance to a single target instance
+      self.stdout.write("Generating matches")
+      for task in tasks:
+        cursor.execute("INSERT INTO collab_match "
+                       "(created, from_instance_id, to_instance_id, task_id, "
+                       "type, score) "
+                       "SELECT NOW(), source.id, target.id, %s, %s, 100 "
+                       "FROM collab_instance AS source "
+                       "INNER JOIN collab_instance AS target "
+                       "ON target.\"offset\" = source.\"offset\" "
+                       "WHERE source.file_version_id = %s "
+                       "AND target.file_version_id = %s",
+                       [task.id, Vector.TYPE_ASSEMBLY_HASH,
+                        task.source_file_version_id,
+                        file_versions[-1].id])
+
+    source, target = file_versions[0], file_versions[-1]
+    task = tasks[-1]
+    hash_vectors = Vector.objects.filter(type=Vector.TYPE_ASSEMBLY_HASH)
+    return [('hash vectors',
+             hash_vectors.filter(file_version=target)
+                         .values('instance_id', 'hash')),
+            ('binned hash vectors',
+             hash_vectors.filter(file_version=target,
+                                 instance__size__gte=1000,
+                                 instance__size__lt=2000)
+                         .values('instance_id', 'hash')),
+            ('ordered vectors',
+             hash_vectors.filter(file_version=source)
+                         .order_by('instance_id')
+                         .values_list('instance_id', 'hash')),
+            ('task matches',
+             Match.objects.filter(task=task)
+                          .values('from_instance__offset',
+                                  'to_instance__offset', 'score')),
+            ('task source instances',
+             Instance.objects.filter(from_matches__task=task).distinct()),
+            ('task target instances',
+             Instance.objects.filter(to_matches__task=task).distinct())]
+
+  def benchmark(self, queries):
+    timings = []
+    # every plan is measured on its second run, after the first one warmed
+    # the cache, so the order queries are run in does not bias timings
+    for name, queryset in queries:
+      with_plan = self.explain(queryset, runs=2)
+
+      # indexes are dropped in a transaction that is always rolled back, but
+      # tables are locked until it is
+      with transaction.atomic():
+        with connection.cursor() as cursor:
+          for index in INDEXES:
+            cursor.execute("DROP INDEX {}".format(index))
+          for index in REPLACED_INDEXES:
+            cursor.execute("CREATE INDEX ON {}".format(index))
+          cursor.execute("ANALYZE collab_match")
+        without_plan = self.explain(queryset, runs=2)
+        transaction.set_rollback(True)
+
+      for title, plan in (("with", with_plan), ("without", without_plan)):
+        self.stdout.write("{} {} indexes:\n{}\n".format(name, title, plan))
+      timings.append((name, self.get_time(with_plan),
+                      self.get_time(without_plan)))
+
+    self.stdout.write("{:<24}{:>16}{:>16}".format("query", "with (ms)",
+                                                  "without (ms)"))
+    for name, with_time, without_time in timings:
+      self.stdout.write("{:<24}{:>16.1f}{:>16.1f}".format(name, with_time,
+                                                          without_time))
+
+  @staticmethod
+  def cleanup(owner):
+    # deleted directly, as collecting millions of objects for cascading
+    # deletion takes far longer than generating them
+    with connection.cursor() as cursor:
+      cursor.execute("DELETE FROM collab_match USING collab_task "
+                     "WHERE collab_match.task_id = collab_task.id "
+                     "AND collab_task.owner_id = %s", [owner.id])
+      cursor.execute("DELETE FROM collab_vector USING collab_instance "
+                     "WHERE collab_vector.instance_id = collab_instance.id "
+                     "AND collab_instance.owner_id = %s", [owner.id])
+      cursor.execute("DELETE FROM collab_instance WHERE owner_id = %s",
+                     [owner.id])
+    owner.delete()
+
+  @staticmethod
+  def explain(queryset, runs=1):
+    """Return the plan of the last of several runs of queryset"""
+    sql, params = queryset.query.sql_with_params()
+    with connection.cursor() as cursor:
+      for _ in range(runs):
+        cursor.execute("EXPLAIN (ANALYZE, BUFFERS) " + sql, params)
+        plan = "\n".join(line for line, in cursor.fetchall())
+    return plan
+
+  @staticmethod
+  def get_time(plan):
+    # capitalized since PostgreSQL 10
+    return float(re.search(r"Execution time: ([\d.]+) ms", plan,
+                           re.IGNORECASE).group(1))
@@ -23,9 +23,20 @@ def matcher_choices():
             if not m.is_abstract()]
 
 
+def match_types_mask(match_types):
+  """Return a bitmask of match types, one bit per matcher by its position in
+  matchers_list. Positions are stored, so matchers may only be appended."""
+  return sum(1 << i for i, m in enumerate(matchers_list)
+             if m.match_type in match_types)
+
+
+def mask_match_types(mask):
+  return [m.match_type for i, m in enumerate(matchers_list) if mask & (1 << i)]
+
+
 __all__ = ['Matcher', 'HashMatcher', 'EuclideanDictionaryMatcher',
            'InstructionHashMatcher', 'IdentityHashMatcher',
            'AssemblyHashMatcher', 'MnemonicHashMatcher', 'NameHashMatcher',
            'MnemonicEuclideanMatcher', 'DictionaryMatcher',
            'BasicBlockSizeEuclideanMatcher', 'BasicBlockMDIndexMatcher',
-           'matchers_list']
+           'matchers_list', 'match_types_mask', 'mask_match_types']
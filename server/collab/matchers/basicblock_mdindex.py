@@ -1,15 +1,15 @@
-from decimal import Decimal
 import json
 
-import networkx as nx
-from tarjan import tarjan_recursive as tarjan
+from tarjan import tarjan
 import numpy as np
 
 from . import hash_matcher
+from .hash_matcher import inttypes
 
 
 class BasicBlockMDIndexMatcher(hash_matcher.HashMatcher):
-  vector_type = 'basicblock_adjacency'
+  vector_type = 'basicblock_mdindex'
+  derived_from = 'basicblock_adjacency'
   match_type = 'basicblock_mdindex_hash'
   matcher_name = "Basic Block MDIndex Hash"
   matcher_description = ("Exact matches for functions with identical MDIndex "
@@ -18,20 +18,82 @@ class BasicBlockMDIndexMatcher(hash_matcher.HashMatcher):
                          "mostly known for BinDiff, to describe graphs based "
                          "solely on graph properties, with no consideration "
                          "of data.")
-  qs = np.sqrt(np.array([Decimal(1), Decimal(2), Decimal(3), Decimal(5),
-                         Decimal(7)]))
+  # MDIndex values are stored rounded, so equal graphs get equal hashes even if
+  # floating point errors creep in
+  DIGITS = 9
+  qs = np.sqrt(np.array([1, 2, 3, 5, 7], dtype=np.float64))
+
+  @staticmethod
+  def validate_source_data(data):
+    """Adjacency vectors are JSON objects mapping every basic block id to
+    the ids of its successors"""
+    try:
+      adjacency = json.loads(data)
+    except ValueError:
+      raise ValueError("Not a valid JSON document.")
+    if not isinstance(adjacency, dict):
+      raise ValueError("Basic block adjacency must be an object.")
+    try:
+      nodes = {int(node) for node in adjacency}
+    except ValueError:
+      raise ValueError("Basic block ids must be integers.")
+    for successors in adjacency.values():
+      if not (isinstance(successors, list) and
+              all(isinstance(successor, inttypes) and
+                  not isinstance(successor, bool) and successor in nodes
+                  for successor in successors)):
+        raise ValueError("Successors must be lists of basic block ids.")
+
+  @classmethod
+  def derive_data(cls, adjacency):
+    """MDIndex is calculated once, when basic block adjacency vectors are
+    stored, and is matched as a plain hash value afterwards."""
+    return cls.derive_data_batch([adjacency])[0]
 
   @classmethod
-  def hash_func(cls, adjacency):
-    # JSON only allows strings as keys, so we gotta convert them back to ints
-    # before we run tarjan's algorithm on the adjacency dict
-    adjacency = {int(k): v for k, v in json.loads(adjacency).items()}
-    graph = nx.convert.from_dict_of_lists(adjacency, create_using=nx.DiGraph)
-    t_order = sum(tarjan(adjacency), [])
-
-    embs = np.array([(t_order.index(s),
-                      graph.in_degree[s], graph.out_degree[s],
-                      graph.in_degree[d], graph.out_degree[d])
-                      for s, d in graph.edges])
-
-    return (1 / np.sqrt(np.dot(embs, cls.qs))).sum()
+  def derive_data_batch(cls, adjacencies):
+    return [json.dumps(round(mdindex, cls.DIGITS))
+            for mdindex in cls.calc_mdindex_batch(adjacencies).tolist()]
+
+  @classmethod
+  def calc_mdindex(cls, adjacency):
+    return cls.calc_mdindex_batch([adjacency])[0]
+
+  @classmethod
+  def calc_mdindex_batch(cls, adjacencies):
+    """Calculate the MDIndex of multiple JSON encoded adjacency dicts at once.
+    Nodes of all graphs are numbered by their topological rank, offset by the
+    number of nodes in preceding graphs, so degrees and edge embeddings of the
+    entire batch are calculated in a few array operations."""
+    sources, destinations, ranks, edge_graphs = [], [], [], []
+    node_count = 0
+    graph_count = 0
+    for graph_count, adjacency in enumerate(adjacencies, 1):
+      # JSON only allows strings as keys, so we gotta convert them back to
+      # ints before we run tarjan's algorithm on the adjacency dict
+      adjacency = {int(k): v for k, v in json.loads(adjacency).items()}
+      rank = {node: node_count + i
+              for i, node in enumerate(sum(tarjan(adjacency), []))}
+
+      for source, successors in adjacency.items():
+        # graph edges are unique, even if a successor is listed twice
+        for destination in dict.fromkeys(successors):
+          sources.append(rank[source])
+          destinations.append(rank[destination])
+          ranks.append(rank[source] - node_count)
+          edge_graphs.append(graph_count - 1)
+      node_count += len(rank)
+
+    sources = np.array(sources, dtype=np.int64)
+    destinations = np.array(destinations, dtype=np.int64)
+    in_degrees = np.bincount(destinations, minlength=node_count)
+    out_degrees = np.bincount(sources, minlength=node_count)
+
+    embs = np.column_stack((ranks,
+                            in_degrees[sources], out_degrees[sources],
+                            in_degrees[destinations],
+                            out_degrees[destinations])).astype(np.float64)
+    edge_values = 1 / np.sqrt(np.dot(embs, cls.qs))
+
+    return np.bincount(np.array(edge_graphs, dtype=np.int64),
+                       weights=edge_values, minlength=graph_count)
@@ -1,10 +1,14 @@
 import json
+import numbers
+from itertools import groupby
+from operator import itemgetter
 
 import numpy as np
-import sklearn as skl
-import sklearn.metrics  # noqa flake8 importing as a different name
-import sklearn.feature_extraction  # noqa flake8 importing as a different name
+import scipy.sparse
 
+from django.conf import settings
+
+from collab import feature_store
 from . import matcher
 
 # python 2 & 3 compatibility
@@ -15,41 +19,165 @@ except ImportError:
 
 
 class DictionaryMatcher(matcher.Matcher):
+  # Number of tile sized arrays allocated while scoring a single tile
+  TILE_COPIES = 3
+
+  @staticmethod
+  def load_hist(data):
+    """Decode a JSON encoded histogram, mapping its keys to their numeric
+    values"""
+    try:
+      hist = json.loads(data)
+    except ValueError:
+      raise ValueError("Not a valid JSON document.")
+    if not isinstance(hist, dict):
+      raise ValueError("Histogram must be an object.")
+    if not all(isinstance(value, numbers.Real) and
+               not isinstance(value, bool) for value in hist.values()):
+      raise ValueError("Histogram values must be numbers.")
+    return {str(key): float(value) for key, value in hist.items()}
+
+  @classmethod
+  def validate_data(cls, data):
+    cls.load_hist(data)
+
+  @classmethod
+  def encode_vectors(cls, vectors):
+    """Histograms are stored as arrays of their values and the stable
+    vocabulary columns of their keys, sorted by column"""
+    from collab.models import FeatureKey
+
+    hists = []
+    for vector in vectors:
+      try:
+        hists.append((vector, cls.load_hist(vector.data)))
+      except ValueError:
+        continue
+
+    for type_version in {vector.type_version for vector, _ in hists}:
+      type_hists = [(vector, hist) for vector, hist in hists
+                    if vector.type_version == type_version]
+      keys = set().union(*(hist.keys() for _, hist in type_hists))
+      columns = FeatureKey.get_columns(cls.vector_type, type_version, keys)
+
+      for vector, hist in type_hists:
+        hist = sorted((columns[key], value) for key, value in hist.items())
+        vector.hist_columns = [column for column, _ in hist]
+        vector.hist_values = [value for _, value in hist]
+
   @classmethod
   def format_data(cls, source, target):
-    source_rows = izip(*source.values_list('instance_id', 'data'))
-    target_rows = izip(*target.values_list('instance_id', 'data'))
+    """Build sparse matrices of source and target histograms, out of the
+    feature store of their file versions"""
+    source_ids, source_parts = cls.format_rows(source)
+    target_ids, target_parts = cls.format_rows(target)
+
+    # columns are shared by all vectors of a type, so matrices only need to
+    # span the same columns
+    column_count = max([0] + [m.shape[1] for m in source_parts + target_parts])
+    source_matrix = cls.build_matrix(source_parts, column_count)
+    target_matrix = cls.build_matrix(target_parts, column_count)
 
-    source_instance_ids, source_json = source_rows
-    target_instance_ids, target_json = target_rows
+    return (source_ids, source_matrix), (target_ids, target_matrix)
 
-    source_data = [json.loads(d) for d in source_json]
-    target_data = [json.loads(d) for d in target_json]
+  @classmethod
+  def format_rows(cls, vectors):
+    """Return instance ids of vectors and their features, grouped by file
+    version. Features of complete file versions are sliced out of the feature
+    store, those of file versions still being uploaded are read from the
+    database."""
+    rows = (vectors.order_by('file_version_id', 'instance_id')
+                   .values_list('file_version_id', 'file_version__complete',
+                                'instance_id'))
+
+    instance_ids = []
+    parts = []
+    for (file_version_id, complete), group in groupby(rows.iterator(),
+                                                      itemgetter(0, 1)):
+      group_ids = np.array([instance_id for _, _, instance_id in group],
+                           dtype=np.int64)
+      if complete:
+        matrix = feature_store.select(file_version_id, cls.vector_type,
+                                      group_ids)
+      else:
+        group_vectors = (vectors.filter(file_version_id=file_version_id)
+                                .order_by('instance_id')
+                                .values_list('instance_id', 'hist_columns',
+                                             'hist_values'))
+        matrix = feature_store.FeatureMatrix.from_rows(group_vectors).matrix
+
+      instance_ids.append(group_ids)
+      parts.append(matrix)
 
-    source_values = source_instance_ids, source_data
-    target_values = target_instance_ids, target_data
+    if not instance_ids:
+      return np.array([], dtype=np.int64), parts
+    return np.concatenate(instance_ids), parts
 
-    return source_values, target_values
+  @staticmethod
+  def build_matrix(parts, column_count):
+    """Stack feature matrices of all parts, widened to column_count columns
+    without copying their arrays"""
+    matrices = [scipy.sparse.csr_matrix((m.data, m.indices, m.indptr),
+                                        shape=(m.shape[0], column_count),
+                                        copy=False)
+                for m in parts]
+    if not matrices:
+      return scipy.sparse.csr_matrix((0, column_count))
+    if len(matrices) == 1:
+      return matrices[0]
+    return scipy.sparse.vstack(matrices, format='csr')
 
   @classmethod
-  def match(cls, source, target):
+  def match(cls, source, target, top_k=None):
     source_values, target_values = cls.format_data(source, target)
-    source_instance_ids, source_data = source_values
-    target_instance_ids, target_data = target_values
-
-    dictvect = skl.feature_extraction.DictVectorizer()
-    source_matrix = dictvect.fit(source_data + target_data)
-    source_matrix = dictvect.transform(source_data)
-    target_matrix = dictvect.transform(target_data)
+    source_instance_ids, source_matrix = source_values
+    target_instance_ids, target_matrix = target_values
     print("source matrix: {}, target matrix: {}".format(source_matrix.shape,
                                                         target_matrix.shape))
 
-    distance_matrix = cls.cmp_fn(source_matrix, target_matrix)
-    print("min, max dist: {}, {}".format(distance_matrix.min(),
-                                         distance_matrix.max()))
+    # Score matrix is computed one block of source rows at a time, so only a
+    # single tile is held in memory regardless of the number of vectors
+    block_rows = cls.get_block_rows(target_matrix.shape[0])
+    for block_start in range(0, source_matrix.shape[0], block_rows):
+      source_block = source_matrix[block_start:block_start + block_rows]
+
+      distance_block = cls.cmp_fn(source_block, target_matrix)
+      score_block = cls.normalize(distance_block, source_block, target_matrix)
+
+      # Pairs are filtered for the entire tile at once, so python objects are
+      # only created for the matches that are kept
+      block_indices, target_indices = cls.select_pairs(score_block, top_k)
+      source_ids = source_instance_ids[block_start + block_indices]
+      target_ids = target_instance_ids[target_indices]
+      scores = score_block[block_indices, target_indices]
+      for match in izip(source_ids.tolist(), target_ids.tolist(),
+                        scores.tolist()):
+        yield match
 
-    distance_matrix = (1 - (distance_matrix / distance_matrix.max())) * 100
-    for source_i, target_i in np.ndindex(*distance_matrix.shape):
-      yield (source_instance_ids[source_i],
-             target_instance_ids[target_i],
-             distance_matrix[source_i][target_i])
+  @classmethod
+  def select_pairs(cls, scores, top_k):
+    """Return the row and column indices of all finite scores of at least
+    MIN_SCORE. When top_k is provided, only the top_k highest scores of every
+    row are considered. Rows of a tile cover all targets, so each row's
+    selection is final."""
+    invalid = ~np.isfinite(scores)
+    if invalid.any():
+      print("Dropping {} non-finite scores".format(invalid.sum()))
+      scores[invalid] = -np.inf
+
+    if top_k is None or top_k >= scores.shape[1]:
+      return np.nonzero(scores >= cls.MIN_SCORE)
+
+    rows = np.repeat(np.arange(scores.shape[0]), top_k)
+    columns = np.argpartition(scores, -top_k, axis=1)[:, -top_k:].ravel()
+    selected = scores[rows, columns] >= cls.MIN_SCORE
+    return rows[selected], columns[selected]
+
+  @classmethod
+  def get_block_rows(cls, target_count):
+    """Return the number of source rows that fit in a single tile. A tile
+    holds a float64 value per target for each source row, and TILE_COPIES of
+    those are alive at once while distances are calculated and normalized."""
+    row_size = max(target_count, 1) * np.dtype(np.float64).itemsize
+    row_size *= cls.TILE_COPIES
+    return max(settings.MATCHER_MEMORY_BUDGET // row_size, 1)
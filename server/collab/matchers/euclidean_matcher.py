@@ -1,8 +1,25 @@
-from . import dictionary_matcher
+import numpy as np
 from sklearn.metrics.pairwise import euclidean_distances
+from sklearn.utils.extmath import row_norms
+
+from . import dictionary_matcher
 
 
 class EuclideanDictionaryMatcher(dictionary_matcher.DictionaryMatcher):
   @staticmethod
   def cmp_fn(source, target):
     return euclidean_distances(source, target)
+
+  @staticmethod
+  def normalize(distances, source, target):
+    # Histograms are non-negative, so the distance of two of them is never
+    # above that of two orthogonal vectors, sqrt(|source|^2 + |target|^2).
+    # Normalizing by that bound scores every pair independently, without
+    # requiring the maximal distance of the whole matrix in advance.
+    bounds = np.sqrt(row_norms(source, squared=True)[:, np.newaxis] +
+                     row_norms(target, squared=True)[np.newaxis, :])
+    with np.errstate(divide='ignore', invalid='ignore'):
+      np.divide(distances, bounds, out=distances)
+    distances *= -100
+    distances += 100
+    return distances
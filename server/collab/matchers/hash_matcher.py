@@ -1,12 +1,25 @@
 import collections
+import json
+import struct
+import binascii
+
 from . import matcher
 
+# python 2 & 3 compatibility
+try:
+  strtypes = (str, unicode)
+  inttypes = (int, long)
+except NameError:
+  strtypes = str
+  inttypes = int
+
 
 class HashMatcher(matcher.Matcher):
   @classmethod
-  def match(cls, source, target):
-    # TODO: Could be optimized by implementing as a single SQL query where
-    # hash_func is not implemented
+  def match(cls, source, target, top_k=None):
+    # all hash matches share the same score, so there's no meaningful way to
+    # pick the best matches out of them
+    del top_k
 
     flipped_rest = collections.defaultdict(list)
     target_values = target.values_list('instance_id', 'data').iterator()
@@ -20,6 +33,51 @@ class HashMatcher(matcher.Matcher):
       for target_instance_id in matches:
         yield (source_instance_id, target_instance_id, 100)
 
+  @classmethod
+  def get_match_query(cls, source, target):
+    # hashes are generated in python and cannot be joined by the database
+    if hasattr(cls, 'hash_func'):
+      return None
+
+    source_sql, source_params = (source.values('instance_id', 'hash')
+                                       .query.sql_with_params())
+    target_sql, target_params = (target.values('instance_id', 'hash')
+                                       .query.sql_with_params())
+
+    sql = ("SELECT source.instance_id AS source_id, "
+           "target.instance_id AS target_id, 100 AS score "
+           "FROM ({}) AS source INNER JOIN ({}) AS target "
+           "ON source.hash = target.hash").format(source_sql, target_sql)
+    return sql, source_params + target_params
+
+  @classmethod
+  def encode_vectors(cls, vectors):
+    for vector in vectors:
+      vector.hash = cls.pack_hash(vector.data)
+
+  @staticmethod
+  def pack_hash(data):
+    """Pack a JSON encoded hash value into its binary form: unsigned 64 bit
+    integers and floats into 8 bytes and hex digests into their raw bytes.
+    Any other value is kept as its encoded text."""
+    try:
+      value = json.loads(data)
+    except ValueError:
+      value = None
+
+    if isinstance(value, bool):
+      pass
+    elif isinstance(value, inttypes) and 0 <= value < 2 ** 64:
+      return struct.pack('>Q', value)
+    elif isinstance(value, float):
+      return struct.pack('>d', value)
+    elif isinstance(value, strtypes):
+      try:
+        return binascii.unhexlify(value)
+      except (TypeError, ValueError):
+        pass
+    return data.encode('utf-8')
+
   @classmethod
   def apply_hash_func(cls, values):
     """allow easy hash generation from more structured data by applying a
@@ -2,11 +2,41 @@ from django.db.models import Q
 
 
 class Matcher(object):
+  # Matchers only provide matches scored at least MIN_SCORE
+  MIN_SCORE = 50
+
   @classmethod
-  def match(cls, source, target):
+  def match(cls, source, target, top_k=None):
     raise NotImplementedError("Method match for vector type {} not "
                               "implemented".format(cls))
 
+  @classmethod
+  def get_match_query(cls, source, target):
+    """Return an SQL query and its params, selecting the source instance id,
+    target instance id and score of every match. Matchers that cannot be
+    expressed as a query return None and are matched in python instead."""
+    del source, target
+    return None
+
+  @classmethod
+  def validate_data(cls, data):
+    """Raise ValueError if the JSON encoded data of a vector cannot be
+    encoded for matching. Vectors matchers cannot make sense of are stored
+    as they are and never matched, unless they're rejected by validation."""
+    del data
+
+  @classmethod
+  def validate_source_data(cls, data):
+    """Raise ValueError if a vector cannot be derived from the JSON encoded
+    data of a vector of the type this matcher derives from."""
+    del data
+
+  @classmethod
+  def encode_vectors(cls, vectors):
+    """Fill the typed fields matchers read instead of the JSON encoded data
+    of vectors, decoded once when vectors are stored."""
+    del vectors
+
   @staticmethod
   def get_filter():
     return Q()
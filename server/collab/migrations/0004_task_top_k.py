@@ -0,0 +1,19 @@
+# Generated by Django 2.1.2 on 2026-10-18 19:02
+
+import django.core.validators
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('collab', '0003_auto_20181104_0545'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='task',
+            name='top_k',
+            field=models.PositiveIntegerField(blank=True, null=True, validators=[django.core.validators.MinValueValidator(1)]),
+        ),
+    ]
@@ -0,0 +1,109 @@
+# Generated by Django 2.1.2 on 2026-10-18 19:20
+
+import json
+
+from tarjan import tarjan
+import numpy as np
+
+from django.db import migrations, models
+
+
+# MDIndex calculation as of this migration, so later changes to the matcher
+# do not change vectors derived by it
+DIGITS = 9
+QS = np.sqrt(np.array([1, 2, 3, 5, 7], dtype=np.float64))
+
+
+def load_adjacency(data):
+    """Return the adjacency dict of a JSON encoded basic block graph, or None
+    if it is malformed"""
+    try:
+        adjacency = {int(k): v for k, v in json.loads(data).items()}
+    except (AttributeError, TypeError, ValueError):
+        return None
+    for successors in adjacency.values():
+        if not (isinstance(successors, list) and
+                all(s in adjacency and not isinstance(s, bool)
+                    for s in successors)):
+            return None
+    return adjacency
+
+
+def calc_mdindex_batch(adjacencies):
+    sources, destinations, ranks, edge_graphs = [], [], [], []
+    node_count = 0
+    for graph, adjacency in enumerate(adjacencies):
+        rank = {node: node_count + i
+                for i, node in enumerate(sum(tarjan(adjacency), []))}
+        for source, successors in adjacency.items():
+            for destination in dict.fromkeys(successors):
+                sources.append(rank[source])
+                destinations.append(rank[destination])
+                ranks.append(rank[source] - node_count)
+                edge_graphs.append(graph)
+        node_count += len(rank)
+
+    sources = np.array(sources, dtype=np.int64)
+    destinations = np.array(destinations, dtype=np.int64)
+    in_degrees = np.bincount(destinations, minlength=node_count)
+    out_degrees = np.bincount(sources, minlength=node_count)
+    embs = np.column_stack((ranks,
+                            in_degrees[sources], out_degrees[sources],
+                            in_degrees[destinations],
+                            out_degrees[destinations])).astype(np.float64)
+    edge_values = 1 / np.sqrt(np.dot(embs, QS))
+    return np.bincount(np.array(edge_graphs, dtype=np.int64),
+                       weights=edge_values, minlength=len(adjacencies))
+
+
+def derive_mdindex_vectors(apps, schema_editor):
+    Vector = apps.get_model('collab', 'Vector')
+    adjacency_vectors = (Vector.objects.using(schema_editor.connection.alias)
+                                       .filter(type='basicblock_adjacency')
+                                       .values_list('instance_id',
+                                                    'file_version_id',
+                                                    'type_version', 'data'))
+
+    def create_vectors(rows):
+        mdindexes = calc_mdindex_batch([row[3] for row in rows])
+        Vector.objects.bulk_create(
+            Vector(instance_id=instance_id, file_version_id=file_version_id,
+                   type='basicblock_mdindex', type_version=type_version,
+                   data=json.dumps(round(mdindex, DIGITS)))
+            for (instance_id, file_version_id, type_version, _), mdindex
+            in zip(rows, mdindexes.tolist()))
+
+    # nothing is derived out of malformed adjacency vectors
+    rows = []
+    for instance_id, file_version_id, type_version, data in \
+            adjacency_vectors.iterator():
+        adjacency = load_adjacency(data)
+        if adjacency is None:
+            continue
+        rows.append((instance_id, file_version_id, type_version, adjacency))
+        if len(rows) >= 10000:
+            create_vectors(rows)
+            rows = []
+    create_vectors(rows)
+
+
+def remove_mdindex_vectors(apps, schema_editor):
+    Vector = apps.get_model('collab', 'Vector')
+    (Vector.objects.using(schema_editor.connection.alias)
+                   .filter(type='basicblock_mdindex').delete())
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('collab', '0004_task_top_k'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='vector',
+            name='type',
+            field=models.CharField(choices=[('instruction_hash', 'Instruction Hash'), ('identity_hash', 'Identity Hash'), ('name_hash', 'Name Hash'), ('assembly_hash', 'Assembly Hash'), ('mnemonic_hash', 'Mnemonic Hash'), ('mnemonic_hist', 'Mnemonic Hist'), ('basicblocksize_hist', 'Basic Block Size Hist'), ('basicblock_adjacency', 'Basic Block Adjacency'), ('basicblock_mdindex', 'Basic Block MDIndex')], max_length=64),
+        ),
+        migrations.RunPython(derive_mdindex_vectors, remove_mdindex_vectors),
+    ]
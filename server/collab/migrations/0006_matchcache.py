@@ -0,0 +1,32 @@
+# Generated by Django 2.1.2 on 2026-10-18 20:14
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('collab', '0005_basicblock_mdindex'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MatchCache',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('source_start', models.BigIntegerField(blank=True, null=True)),
+                ('source_end', models.BigIntegerField(blank=True, null=True)),
+                ('match_type', models.CharField(choices=[('instruction_hash', 'Instruction Hash'), ('identity_hash', 'Identity Hash'), ('name_hash', 'Name Hash'), ('assembly_hash', 'Assembly Hash'), ('mnemonic_hash', 'Mnemonic Hash'), ('mnemonic_euclidean', 'Mnemonic Euclidean Distance'), ('basicblocksize_euclidean', 'Basic Block Size Distance'), ('basicblock_mdindex_hash', 'Basic Block MDIndex Hash')], max_length=64)),
+                ('type_version', models.IntegerField()),
+                ('source_file_version', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='collab.FileVersion')),
+                ('target_file_version', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='collab.FileVersion')),
+                ('task', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='collab.Task')),
+            ],
+        ),
+        migrations.AlterIndexTogether(
+            name='matchcache',
+            index_together={('source_file_version', 'match_type')},
+        ),
+    ]
@@ -0,0 +1,134 @@
+# Generated by Django 2.1.2 on 2026-10-18 20:41
+
+import binascii
+import json
+import struct
+
+import django.contrib.postgres.fields
+from django.db import migrations, models
+
+# python 2 & 3 compatibility
+try:
+    strtypes = (str, unicode)
+    inttypes = (int, long)
+except NameError:
+    strtypes = (str,)
+    inttypes = (int,)
+
+
+# Vector types of hash and dictionary matchers, and their encoding, as of
+# this migration
+HASH_TYPES = ('instruction_hash', 'identity_hash', 'name_hash',
+              'assembly_hash', 'mnemonic_hash', 'basicblock_mdindex')
+HIST_TYPES = ('mnemonic_hist', 'basicblocksize_hist')
+BATCH_SIZE = 1000
+
+
+def pack_hash(data):
+    try:
+        value = json.loads(data)
+    except ValueError:
+        value = None
+
+    if isinstance(value, bool):
+        pass
+    elif isinstance(value, inttypes) and 0 <= value < 2 ** 64:
+        return struct.pack('>Q', value)
+    elif isinstance(value, float):
+        return struct.pack('>d', value)
+    elif isinstance(value, strtypes):
+        try:
+            return binascii.unhexlify(value)
+        except (TypeError, ValueError):
+            pass
+    return data.encode('utf-8')
+
+
+def encode_hist(data):
+    """Return the sorted keys and values of a JSON encoded histogram, or None
+    if it is malformed"""
+    try:
+        hist = json.loads(data)
+    except ValueError:
+        return None
+    if not isinstance(hist, dict):
+        return None
+    if not all(isinstance(value, (float,) + inttypes) and
+               not isinstance(value, bool) for value in hist.values()):
+        return None
+
+    keys = sorted(hist.keys())
+    return keys, [float(hist[key]) for key in keys]
+
+
+def update_vectors(schema_editor, columns, rows):
+    """Set columns of every vector in rows with a single statement. Rows are
+    tuples of a vector id followed by values of columns, which are pairs of a
+    column name and its type."""
+    if not rows:
+        return
+    row_sql = "({})".format(", ".join(["%s::integer"] +
+                                      ["%s::" + column_type
+                                       for _, column_type in columns]))
+    sql = ("UPDATE collab_vector AS v SET {} FROM (VALUES {}) AS u(id, {}) "
+           "WHERE v.id = u.id"
+           "").format(", ".join("{0} = u.{0}".format(name)
+                                for name, _ in columns),
+                      ", ".join([row_sql] * len(rows)),
+                      ", ".join(name for name, _ in columns))
+    schema_editor.execute(sql, [value for row in rows for value in row])
+
+
+def encode_vectors(apps, schema_editor):
+    Vector = apps.get_model('collab', 'Vector')
+    vectors = Vector.objects.using(schema_editor.connection.alias)
+    binary = schema_editor.connection.Database.Binary
+
+    rows = []
+    hashes = vectors.filter(type__in=HASH_TYPES).values_list('id', 'data')
+    for vector_id, data in hashes.iterator():
+        rows.append((vector_id, binary(pack_hash(data))))
+        if len(rows) >= BATCH_SIZE:
+            update_vectors(schema_editor, [('hash', 'bytea')], rows)
+            rows = []
+    update_vectors(schema_editor, [('hash', 'bytea')], rows)
+
+    # malformed histograms are left without typed data, and never matched
+    rows = []
+    hist_columns = [('hist_keys', 'text[]'), ('hist_values', 'float8[]')]
+    hists = vectors.filter(type__in=HIST_TYPES).values_list('id', 'data')
+    for vector_id, data in hists.iterator():
+        hist = encode_hist(data)
+        if hist is None:
+            continue
+        rows.append((vector_id,) + hist)
+        if len(rows) >= BATCH_SIZE:
+            update_vectors(schema_editor, hist_columns, rows)
+            rows = []
+    update_vectors(schema_editor, hist_columns, rows)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('collab', '0006_matchcache'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='vector',
+            name='hash',
+            field=models.BinaryField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='vector',
+            name='hist_keys',
+            field=django.contrib.postgres.fields.ArrayField(base_field=models.TextField(), blank=True, editable=False, null=True, size=None),
+        ),
+        migrations.AddField(
+            model_name='vector',
+            name='hist_values',
+            field=django.contrib.postgres.fields.ArrayField(base_field=models.FloatField(), blank=True, editable=False, null=True, size=None),
+        ),
+        migrations.RunPython(encode_vectors, migrations.RunPython.noop),
+    ]
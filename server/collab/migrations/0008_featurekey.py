@@ -0,0 +1,84 @@
+# Generated by Django 2.1.2 on 2026-10-18 21:26
+
+import django.contrib.postgres.fields
+from django.db import migrations, models
+
+
+BATCH_SIZE = 1000
+
+
+def update_vectors(schema_editor, rows):
+    """Set the histogram columns and values of a batch of vectors with a
+    single statement"""
+    if not rows:
+        return
+    sql = ("UPDATE collab_vector AS v "
+           "SET hist_columns = u.hist_columns, hist_values = u.hist_values "
+           "FROM (VALUES {}) AS u(id, hist_columns, hist_values) "
+           "WHERE v.id = u.id"
+           "").format(", ".join(["(%s::integer, %s::integer[], "
+                                 "%s::float8[])"] * len(rows)))
+    schema_editor.execute(sql, [value for row in rows for value in row])
+
+
+def encode_hist_columns(apps, schema_editor):
+    Vector = apps.get_model('collab', 'Vector')
+    FeatureKey = apps.get_model('collab', 'FeatureKey')
+    alias = schema_editor.connection.alias
+    vectors = Vector.objects.using(alias)
+
+    columns = {}
+    updates = []
+    rows = (vectors.filter(hist_keys__isnull=False)
+                   .values_list('id', 'type', 'type_version', 'hist_keys',
+                                'hist_values'))
+    for vector_id, vector_type, type_version, keys, values in rows.iterator():
+        for key in keys:
+            if (vector_type, type_version, key) not in columns:
+                feature_key, _ = (FeatureKey.objects.using(alias)
+                                  .get_or_create(vector_type=vector_type,
+                                                 type_version=type_version,
+                                                 key=key))
+                columns[vector_type, type_version, key] = feature_key.id
+
+        hist = sorted((columns[vector_type, type_version, key], value)
+                      for key, value in zip(keys, values))
+        updates.append((vector_id, [column for column, _ in hist],
+                        [value for _, value in hist]))
+        if len(updates) >= BATCH_SIZE:
+            update_vectors(schema_editor, updates)
+            updates = []
+    update_vectors(schema_editor, updates)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('collab', '0007_vector_typed_data'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FeatureKey',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('vector_type', models.CharField(choices=[('instruction_hash', 'Instruction Hash'), ('identity_hash', 'Identity Hash'), ('name_hash', 'Name Hash'), ('assembly_hash', 'Assembly Hash'), ('mnemonic_hash', 'Mnemonic Hash'), ('mnemonic_hist', 'Mnemonic Hist'), ('basicblocksize_hist', 'Basic Block Size Hist'), ('basicblock_adjacency', 'Basic Block Adjacency'), ('basicblock_mdindex', 'Basic Block MDIndex')], max_length=64)),
+                ('type_version', models.IntegerField()),
+                ('key', models.TextField()),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='featurekey',
+            unique_together={('vector_type', 'type_version', 'key')},
+        ),
+        migrations.AddField(
+            model_name='vector',
+            name='hist_columns',
+            field=django.contrib.postgres.fields.ArrayField(base_field=models.IntegerField(), blank=True, editable=False, null=True, size=None),
+        ),
+        migrations.RunPython(encode_hist_columns, migrations.RunPython.noop),
+        migrations.RemoveField(
+            model_name='vector',
+            name='hist_keys',
+        ),
+    ]
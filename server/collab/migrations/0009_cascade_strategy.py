@@ -0,0 +1,18 @@
+# Generated by Django 2.1.2 on 2026-10-18 21:58
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('collab', '0008_featurekey'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='task',
+            name='strategy',
+            field=models.CharField(choices=[('all_strategy', 'All'), ('binning_strategy', 'Binning'), ('cascade_strategy', 'Cascade'), ('exclusive_cascade_strategy', 'Exclusive Cascade')], default='all_strategy', max_length=256),
+        ),
+    ]
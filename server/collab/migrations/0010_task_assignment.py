@@ -0,0 +1,24 @@
+# Generated by Django 2.1.2 on 2026-10-18 22:31
+
+import django.core.validators
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('collab', '0009_cascade_strategy'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='task',
+            name='assignment',
+            field=models.CharField(choices=[('none', 'Keep all matches'), ('greedy', 'Greedy assignment'), ('optimal', 'Optimal one-to-one assignment')], default='none', max_length=64),
+        ),
+        migrations.AddField(
+            model_name='task',
+            name='assignment_limit',
+            field=models.PositiveSmallIntegerField(default=1, validators=[django.core.validators.MinValueValidator(1)]),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 2.1.2 on 2026-10-18 23:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('collab', '0010_task_assignment'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='task',
+            name='strategy',
+            field=models.CharField(choices=[('all_strategy', 'All'), ('binning_strategy', 'Binning'), ('cascade_strategy', 'Cascade'), ('exclusive_cascade_strategy', 'Exclusive Cascade'), ('blocking_strategy', 'Blocking')], default='all_strategy', max_length=256),
+        ),
+    ]
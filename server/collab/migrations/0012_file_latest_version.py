@@ -0,0 +1,33 @@
+# Generated by Django 2.1.2 on 2026-10-18 23:40
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def populate_latest_versions(apps, schema_editor):
+    del schema_editor
+    File = apps.get_model('collab', 'File')
+    FileVersion = apps.get_model('collab', 'FileVersion')
+
+    latest_versions = (FileVersion.objects.filter(file=models.OuterRef('pk'),
+                                                  complete=True)
+                                          .order_by('-created', '-id')
+                                          .values('id')[:1])
+    File.objects.update(latest_version=models.Subquery(latest_versions))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('collab', '0011_blocking_strategy'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='file',
+            name='latest_version',
+            field=models.ForeignKey(blank=True, editable=False, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='collab.FileVersion'),
+        ),
+        migrations.RunPython(populate_latest_versions,
+                             migrations.RunPython.noop),
+    ]
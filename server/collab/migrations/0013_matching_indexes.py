@@ -0,0 +1,50 @@
+# Generated by Django 2.1.2 on 2026-10-18 23:55
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+# Composite indexes of the hot matching and result queries, built
+# concurrently so existing deployments keep serving while they build. Columns
+# that are only read come last rather than in an INCLUDE clause, which
+# requires PostgreSQL 11, so the queries are still answered by index only
+# scans on older servers
+INDEXES = [
+    # vectors of a file version and type, either joined by hash or read in
+    # instance order, without visiting the table
+    ('collab_vector_matching',
+     'collab_vector (file_version_id, type, instance_id, hash)'),
+    # the size and count vectors are binned and blocked by, read while
+    # joining vectors to their instances
+    ('collab_instance_sizes',
+     'collab_instance (id, file_version_id, "offset", size, count)'),
+    # matches of a task, and instances filtered by the matches of a task
+    ('collab_match_task_from',
+     'collab_match (task_id, from_instance_id, to_instance_id, score)'),
+    ('collab_match_task_to',
+     'collab_match (task_id, to_instance_id, from_instance_id)'),
+]
+
+
+class Migration(migrations.Migration):
+
+    atomic = False
+
+    dependencies = [
+        ('collab', '0012_file_latest_version'),
+    ]
+
+    operations = [
+        migrations.RunSQL(
+            "CREATE INDEX CONCURRENTLY IF NOT EXISTS {} ON {}".format(name,
+                                                                     index),
+            "DROP INDEX CONCURRENTLY IF EXISTS {}".format(name))
+        for name, index in INDEXES
+    ] + [
+        # superseded by the composite task indexes
+        migrations.AlterField(
+            model_name='match',
+            name='task',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='matches', to='collab.Task'),
+        ),
+    ]
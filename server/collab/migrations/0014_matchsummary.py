@@ -0,0 +1,67 @@
+# Generated by Django 2.1.2 on 2026-10-19 00:20
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+# Match types by their bit position in the matchers mask, frozen as they were
+# listed when summaries were introduced
+MATCH_TYPES = ['instruction_hash', 'identity_hash', 'name_hash',
+               'assembly_hash', 'mnemonic_hash', 'mnemonic_euclidean',
+               'basicblocksize_euclidean', 'basicblock_mdindex_hash']
+
+
+def summarize_matches(apps, schema_editor):
+    Task = apps.get_model('collab', 'Task')
+    MatchSummary = apps.get_model('collab', 'MatchSummary')
+
+    masks = [1 << i for i in range(len(MATCH_TYPES))]
+    schema_editor.execute(
+        "INSERT INTO collab_matchsummary (task_id, from_instance_id, "
+        "to_instance_id, score, matchers) "
+        "SELECT m.task_id, m.from_instance_id, m.to_instance_id, "
+        "MAX(m.score), BIT_OR(COALESCE(t.mask, 0)) "
+        "FROM collab_match AS m "
+        "LEFT JOIN UNNEST(%s::text[], %s::integer[]) AS t(type, mask) "
+        "ON m.type = t.type "
+        "GROUP BY m.task_id, m.from_instance_id, m.to_instance_id",
+        (MATCH_TYPES, masks))
+
+    pair_counts = (MatchSummary.objects.filter(task=models.OuterRef('pk'))
+                                       .order_by()
+                                       .values('task')
+                                       .annotate(count=models.Count('id'))
+                                       .values('count'))
+    Task.objects.update(pair_count=models.functions.Coalesce(
+        models.Subquery(pair_counts), 0))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('collab', '0013_matching_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='task',
+            name='pair_count',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.CreateModel(
+            name='MatchSummary',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('score', models.FloatField()),
+                ('matchers', models.IntegerField()),
+                ('from_instance', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='from_match_summaries', to='collab.Instance')),
+                ('task', models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='match_summaries', to='collab.Task')),
+                ('to_instance', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='to_match_summaries', to='collab.Instance')),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='matchsummary',
+            unique_together={('task', 'from_instance', 'to_instance')},
+        ),
+        migrations.RunPython(summarize_matches, migrations.RunPython.noop),
+    ]
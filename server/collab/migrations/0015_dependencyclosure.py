@@ -0,0 +1,62 @@
+# Generated by Django 2.1.2 on 2026-10-19 02:10
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def build_closure(apps, schema_editor):
+    Dependency = apps.get_model('collab', 'Dependency')
+
+    # dependencies are added one at a time, the same as they are once
+    # uploaded
+    sql = ("INSERT INTO collab_dependencyclosure "
+           "(ancestor_id, descendant_id, depth) "
+           "SELECT a.id, d.id, MAX(a.depth + d.depth + 1) "
+           "FROM (SELECT id, 0 AS depth FROM collab_annotation "
+           "      WHERE uuid = %s "
+           "      UNION ALL "
+           "      SELECT c.ancestor_id, c.depth "
+           "      FROM collab_dependencyclosure AS c "
+           "      INNER JOIN collab_annotation AS an "
+           "      ON c.descendant_id = an.id "
+           "      WHERE an.uuid = %s) AS a(id, depth), "
+           "     (SELECT id, 0 AS depth FROM collab_annotation "
+           "      WHERE uuid = %s "
+           "      UNION ALL "
+           "      SELECT c.descendant_id, c.depth "
+           "      FROM collab_dependencyclosure AS c "
+           "      INNER JOIN collab_annotation AS an "
+           "      ON c.ancestor_id = an.id "
+           "      WHERE an.uuid = %s) AS d(id, depth) "
+           "GROUP BY a.id, d.id "
+           "ON CONFLICT (ancestor_id, descendant_id) DO UPDATE "
+           "SET depth = GREATEST(collab_dependencyclosure.depth, "
+           "                     EXCLUDED.depth)")
+    dependencies = Dependency.objects.values_list('dependent', 'dependency')
+    for dependent, dependency in dependencies.iterator():
+        schema_editor.execute(sql, (dependent, dependent, dependency,
+                                    dependency))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('collab', '0014_matchsummary'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DependencyClosure',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('depth', models.IntegerField()),
+                ('ancestor', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='descendant_closures', to='collab.Annotation')),
+                ('descendant', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='ancestor_closures', to='collab.Annotation')),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='dependencyclosure',
+            unique_together={('ancestor', 'descendant')},
+        ),
+        migrations.RunPython(build_closure, migrations.RunPython.noop),
+    ]
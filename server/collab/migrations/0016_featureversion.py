@@ -0,0 +1,27 @@
+# Generated by Django 2.1.2 on 2026-10-19 03:05
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('collab', '0015_dependencyclosure'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FeatureVersion',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('vector_type', models.CharField(choices=[('instruction_hash', 'Instruction Hash'), ('identity_hash', 'Identity Hash'), ('name_hash', 'Name Hash'), ('assembly_hash', 'Assembly Hash'), ('mnemonic_hash', 'Mnemonic Hash'), ('mnemonic_hist', 'Mnemonic Hist'), ('basicblocksize_hist', 'Basic Block Size Hist'), ('basicblock_adjacency', 'Basic Block Adjacency'), ('basicblock_mdindex', 'Basic Block MDIndex')], max_length=64)),
+                ('version', models.IntegerField(default=0)),
+                ('file_version', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='feature_versions', to='collab.FileVersion')),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='featureversion',
+            unique_together={('file_version', 'vector_type')},
+        ),
+    ]
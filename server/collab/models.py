@@ -1,13 +1,15 @@
-from django.db import models
+from django.db import models, connection
 from django.db.models.fields import files
+from django.db.models import OuterRef, Subquery
+from django.db.models.signals import pre_save, post_save, post_delete
+from django.dispatch import receiver
 from django.contrib.auth.models import User
-from django.core.validators import MinLengthValidator
-
-import django_cte
+from django.contrib.postgres.fields import ArrayField
+from django.core.validators import MinLengthValidator, MinValueValidator
 
 from .validators import idb_validator
 from .strategies import strategy_choices
-from .matchers import matcher_choices
+from .matchers import matcher_choices, matchers_list, mask_match_types
 
 
 class Project(models.Model):
@@ -36,11 +38,26 @@ class File(models.Model):
                              validators=[MinLengthValidator(32)])
   file = files.FileField(upload_to="tasks", null=True, blank=True,
                          validators=[idb_validator])
+  # newest complete version of the file, which is the one matched against
+  latest_version = models.ForeignKey('FileVersion', models.SET_NULL,
+                                     null=True, blank=True, editable=False,
+                                     related_name='+')
 
   def __unicode__(self):
     return "File {}".format(self.name)
   __str__ = __unicode__
 
+  @classmethod
+  def update_latest_versions(cls, file_ids):
+    """Point files at their newest complete version, or at none if none of
+    their versions is complete"""
+    latest_versions = (FileVersion.objects.filter(file=OuterRef('pk'),
+                                                  complete=True)
+                                          .order_by('-created', '-id')
+                                          .values('id')[:1])
+    cls.objects.filter(id__in=file_ids).update(
+      latest_version=Subquery(latest_versions))
+
 
 class FileVersion(models.Model):
   created = models.DateTimeField(auto_now_add=True)
@@ -56,6 +73,24 @@ class FileVersion(models.Model):
     return "File {} version {}".format(self.file.name, self.md5hash)
   __str__ = __unicode__
 
+  def save(self, *args, **kwargs):
+    # a version that is no longer complete may still be the file's latest
+    was_complete = (self.pk is not None and
+                    FileVersion.objects.filter(pk=self.pk,
+                                               complete=True).exists())
+    super(FileVersion, self).save(*args, **kwargs)
+    if self.complete or was_complete:
+      File.update_latest_versions([self.file_id])
+
+
+@receiver(post_delete, sender=FileVersion)
+def update_latest_version(sender, instance, **kwargs):
+  """Fall back to the newest remaining complete version once a complete file
+  version is deleted, whether directly or by a cascade"""
+  del sender, kwargs
+  if instance.complete:
+    File.update_latest_versions([instance.file_id])
+
 
 class Instance(models.Model):
   TYPE_EMPTY_DATA = 'empty_data'
@@ -99,6 +134,7 @@ class Vector(models.Model):
   TYPE_MNEMONIC_HIST = 'mnemonic_hist'
   TYPE_BASICBLOCKSIZE_HIST = 'basicblocksize_hist'
   TYPE_BASICBLOCK_ADJACENCY = 'basicblock_adjacency'
+  TYPE_BASICBLOCK_MDINDEX = 'basicblock_mdindex'
   TYPE_CHOICES = [(TYPE_INSTRUCTION_HASH, "Instruction Hash"),
                   (TYPE_IDENTITY_HASH, "Identity Hash"),
                   (TYPE_NAME_HASH, "Name Hash"),
@@ -106,7 +142,8 @@ class Vector(models.Model):
                   (TYPE_MNEMONIC_HASH, "Mnemonic Hash"),
                   (TYPE_MNEMONIC_HIST, "Mnemonic Hist"),
                   (TYPE_BASICBLOCKSIZE_HIST, "Basic Block Size Hist"),
-                  (TYPE_BASICBLOCK_ADJACENCY, "Basic Block Adjacency")]
+                  (TYPE_BASICBLOCK_ADJACENCY, "Basic Block Adjacency"),
+                  (TYPE_BASICBLOCK_MDINDEX, "Basic Block MDIndex")]
 
   instance = models.ForeignKey(Instance, models.CASCADE,
                                related_name='vectors')
@@ -116,6 +153,14 @@ class Vector(models.Model):
   type_version = models.IntegerField()
   data = models.TextField()
 
+  # typed representations of data, decoded once when vectors are stored so
+  # matchers do not have to parse data of every vector they match
+  hash = models.BinaryField(null=True, blank=True)
+  hist_columns = ArrayField(models.IntegerField(), null=True, blank=True,
+                            editable=False)
+  hist_values = ArrayField(models.FloatField(), null=True, blank=True,
+                           editable=False)
+
   class Meta(object):
     unique_together = (('instance', 'type'),)
 
@@ -125,6 +170,151 @@ class Vector(models.Model):
                                                 self.instance)
   __str__ = __unicode__
 
+  def save(self, *args, **kwargs):
+    self.encode_vectors([self])
+    super(Vector, self).save(*args, **kwargs)
+
+  @staticmethod
+  def validate_data(vector_type, data):
+    """Raise ValueError if any matcher cannot encode the JSON encoded data of
+    a vector of vector_type, or derive a vector out of it"""
+    for matcher in matchers_list:
+      if matcher.vector_type == vector_type:
+        matcher.validate_data(data)
+      if getattr(matcher, 'derived_from', None) == vector_type:
+        matcher.validate_source_data(data)
+
+  @staticmethod
+  def encode_vectors(vectors):
+    """Fill typed fields out of data, according to the matchers of each
+    vector's type. Must be called explicitly before bulk creating vectors."""
+    for matcher in matchers_list:
+      typed_vectors = [v for v in vectors if v.type == matcher.vector_type]
+      if typed_vectors:
+        matcher.encode_vectors(typed_vectors)
+
+  @classmethod
+  def derive_vectors(cls, vectors):
+    """Build the vectors matchers derive out of uploaded vectors, so any
+    expensive preprocessing is done once when vectors are stored instead of
+    on every match."""
+    derived_vectors = []
+    for matcher in matchers_list:
+      if not hasattr(matcher, 'derived_from'):
+        continue
+
+      # nothing is derived out of malformed vectors, same as they are never
+      # matched
+      sources = []
+      for vector in vectors:
+        if vector.type != matcher.derived_from:
+          continue
+        try:
+          matcher.validate_source_data(vector.data)
+        except ValueError:
+          continue
+        sources.append(vector)
+      if not sources:
+        continue
+
+      derived_data = matcher.derive_data_batch([v.data for v in sources])
+      derived_vectors += [cls(instance=vector.instance,
+                              file_version=vector.file_version,
+                              type=matcher.vector_type,
+                              type_version=vector.type_version,
+                              data=data)
+                          for vector, data in zip(sources, derived_data)]
+    cls.encode_vectors(derived_vectors)
+    return derived_vectors
+
+  @classmethod
+  def update_derived_vectors(cls, vector):
+    """Rebuild the vectors derived out of a stored vector once its data
+    changes"""
+    derived_vectors = {v.type: v for v in cls.derive_vectors([vector])}
+    for matcher in matchers_list:
+      if getattr(matcher, 'derived_from', None) != vector.type:
+        continue
+      derived_vector = derived_vectors.get(matcher.vector_type)
+      if derived_vector is None:
+        cls.objects.filter(instance=vector.instance_id,
+                           type=matcher.vector_type).delete()
+        continue
+      cls.objects.update_or_create(
+        instance=vector.instance, type=matcher.vector_type,
+        defaults={'file_version': vector.file_version,
+                  'type_version': derived_vector.type_version,
+                  'data': derived_vector.data})
+
+  @staticmethod
+  def delete_derived_vectors(instance_id, vector_type):
+    """Delete the vectors derived out of a vector of vector_type"""
+    derived_types = [m.vector_type for m in matchers_list
+                     if getattr(m, 'derived_from', None) == vector_type]
+    if derived_types:
+      Vector.objects.filter(instance=instance_id,
+                            type__in=derived_types).delete()
+
+
+class FeatureKey(models.Model):
+  """Append-only vocabulary of histogram keys per vector type and type
+  version. A key's id is its column in feature matrices, so columns are
+  stable across file versions and tasks and never need refitting."""
+  vector_type = models.CharField(max_length=64, choices=Vector.TYPE_CHOICES)
+  type_version = models.IntegerField()
+  key = models.TextField()
+
+  class Meta(object):
+    unique_together = (('vector_type', 'type_version', 'key'),)
+
+  @classmethod
+  def get_columns(cls, vector_type, type_version, keys):
+    """Return the column of every key, adding any new keys to the
+    vocabulary"""
+    keys = list(keys)
+    if not keys:
+      return {}
+
+    sql = ("INSERT INTO {table} (vector_type, type_version, key) "
+           "SELECT %s, %s, UNNEST(%s::text[]) "
+           "ON CONFLICT DO NOTHING").format(table=cls._meta.db_table)
+    with connection.cursor() as cursor:
+      cursor.execute(sql, (vector_type, type_version, keys))
+
+    columns = cls.objects.filter(vector_type=vector_type,
+                                 type_version=type_version, key__in=keys)
+    return dict(columns.values_list('key', 'id'))
+
+
+class FeatureVersion(models.Model):
+  """Version of the vectors of a file version and type. Bumped whenever
+  those vectors are changed, so feature matrices stored on every host out of
+  an older version are rebuilt."""
+  file_version = models.ForeignKey(FileVersion, models.CASCADE,
+                                   related_name='feature_versions')
+  vector_type = models.CharField(max_length=64, choices=Vector.TYPE_CHOICES)
+  version = models.IntegerField(default=0)
+
+  class Meta(object):
+    unique_together = (('file_version', 'vector_type'),)
+
+  @classmethod
+  def get_version(cls, file_version_id, vector_type):
+    version = (cls.objects.filter(file_version=file_version_id,
+                                  vector_type=vector_type)
+                          .values_list('version', flat=True).first())
+    return version or 0
+
+  @classmethod
+  def bump(cls, file_version_id, vector_type):
+    sql = ("INSERT INTO {table} (file_version_id, vector_type, version) "
+           "VALUES (%s, %s, 1) "
+           "ON CONFLICT (file_version_id, vector_type) DO UPDATE "
+           "SET version = {table}.version + 1"
+           "").format(table=cls._meta.db_table)
+    with connection.cursor() as cursor:
+      cursor.execute(sql, (file_version_id, vector_type))
+
 
 class Task(models.Model):
   STATUS_PENDING = 'pending'
@@ -158,6 +348,23 @@ class Task(models.Model):
   matchers = models.TextField(default='[]')
   strategy = models.CharField(choices=strategy_choices(), max_length=256,
                               default='all_strategy')
+  # when set, only the top_k best scoring targets of every source instance are
+  # kept by matchers that score pairs
+  top_k = models.PositiveIntegerField(null=True, blank=True,
+                                      validators=[MinValueValidator(1)])
+
+  # optionally, once all matches are stored only pairs of a one-to-one (or
+  # one-to-assignment_limit) assignment are kept
+  ASSIGNMENT_NONE = 'none'
+  ASSIGNMENT_GREEDY = 'greedy'
+  ASSIGNMENT_OPTIMAL = 'optimal'
+  ASSIGNMENT_CHOICES = ((ASSIGNMENT_NONE, "Keep all matches"),
+                        (ASSIGNMENT_GREEDY, "Greedy assignment"),
+                        (ASSIGNMENT_OPTIMAL, "Optimal one-to-one assignment"))
+  assignment = models.CharField(default=ASSIGNMENT_NONE, max_length=64,
+                                choices=ASSIGNMENT_CHOICES)
+  assignment_limit = models.PositiveSmallIntegerField(
+    default=1, validators=[MinValueValidator(1)])
 
   progress = models.PositiveSmallIntegerField(default=0)
   progress_max = models.PositiveSmallIntegerField(null=True, blank=True)
@@ -165,6 +372,8 @@ class Task(models.Model):
   local_count = models.IntegerField(default=0)
   remote_count = models.IntegerField(default=0)
   match_count = models.IntegerField(default=0)
+  # number of matched instance pairs, which is the number of match summaries
+  pair_count = models.IntegerField(default=0)
 
 
 class Match(models.Model):
@@ -174,15 +383,66 @@ class Match(models.Model):
   to_instance = models.ForeignKey(Instance, models.CASCADE,
                                   related_name='to_matches')
 
-  task = models.ForeignKey(Task, models.CASCADE, db_index=True,
+  # matches are looked up by task through the composite task indexes created
+  # by migration 0013_matching_indexes
+  task = models.ForeignKey(Task, models.CASCADE, db_index=False,
                            related_name='matches')
 
   type = models.CharField(max_length=64, choices=matcher_choices())
   score = models.FloatField()
 
 
+class MatchSummary(models.Model):
+  """All matches of an instance pair by a task, combined once the task is
+  done. Pairs are scored by their highest scored match, and matchers holds a
+  bit of every matcher that matched the pair, by its position in
+  matchers_list."""
+  # looked up by task through the unique together index
+  task = models.ForeignKey(Task, models.CASCADE, db_index=False,
+                           related_name='match_summaries')
+  from_instance = models.ForeignKey(Instance, models.CASCADE,
+                                    related_name='from_match_summaries')
+  to_instance = models.ForeignKey(Instance, models.CASCADE,
+                                  related_name='to_match_summaries')
+
+  score = models.FloatField()
+  matchers = models.IntegerField()
+
+  class Meta(object):
+    unique_together = (('task', 'from_instance', 'to_instance'),)
+
+  def get_match_types(self):
+    return mask_match_types(self.matchers)
+
+
+class MatchCache(models.Model):
+  """Marks the matches of a task's step between a source and a target file
+  version as reusable by later tasks with the same source file version, source
+  range, matcher and vector type version."""
+  created = models.DateTimeField(auto_now_add=True)
+  task = models.ForeignKey(Task, models.CASCADE, related_name='+')
+
+  source_file_version = models.ForeignKey(FileVersion, models.CASCADE,
+                                          related_name='+')
+  source_start = models.BigIntegerField(null=True, blank=True)
+  source_end = models.BigIntegerField(null=True, blank=True)
+  target_file_version = models.ForeignKey(FileVersion, models.CASCADE,
+                                          related_name='+')
+  match_type = models.CharField(max_length=64, choices=matcher_choices())
+  type_version = models.IntegerField()
+
+  class Meta(object):
+    index_together = (('source_file_version', 'match_type'),)
+
+  @classmethod
+  def invalidate(cls, file_version):
+    """Drop entries a newly completed file version supersedes, which are
+    all entries targeting older versions of the same file."""
+    (cls.objects.filter(target_file_version__file=file_version.file_id)
+                .exclude(target_file_version=file_version).delete())
+
+
 class Annotation(models.Model):
-  objects = django_cte.CTEManager()
   TYPE_NAME = 'name'
   TYPE_ASSEMBLY = 'assembly'
   TYPE_PROTOTYPE = 'prototype'
@@ -208,3 +468,89 @@ class Dependency(models.Model):
 
   dependency = models.ForeignKey(Annotation, models.CASCADE, to_field="uuid",
                                  related_name='+')
+
+
+# the closure is maintained by signals rather than by Dependency.save and
+# delete, so dependencies removed by cascades and queryset deletes are
+# accounted for as well
+@receiver(pre_save, sender=Dependency)
+def store_previous_dependent(sender, instance, **kwargs):
+  del sender, kwargs
+  instance.previous_dependent = None
+  if instance.pk is not None:
+    previous = Dependency.objects.filter(pk=instance.pk)
+    instance.previous_dependent = (previous.values_list('dependent', flat=True)
+                                           .first())
+
+
+@receiver(post_save, sender=Dependency)
+def add_dependency_closure(sender, instance, **kwargs):
+  del sender, kwargs
+  if getattr(instance, 'previous_dependent', None) is not None:
+    DependencyClosure.remove_dependency(instance.previous_dependent)
+  DependencyClosure.add_dependency(instance.dependent_id,
+                                   instance.dependency_id)
+
+
+@receiver(post_delete, sender=Dependency)
+def remove_dependency_closure(sender, instance, **kwargs):
+  del sender, kwargs
+  DependencyClosure.remove_dependency(instance.dependent_id)
+
+
+class DependencyClosure(models.Model):
+  """Transitive closure of annotation dependencies. Every annotation an
+  ancestor annotation depends on, directly or through other annotations, is
+  one of its descendants. Depth is the length of the longest dependency
+  chain between them, so dependencies always come deeper than their
+  dependents."""
+  ancestor = models.ForeignKey(Annotation, models.CASCADE,
+                               related_name='descendant_closures')
+  descendant = models.ForeignKey(Annotation, models.CASCADE,
+                                 related_name='ancestor_closures')
+  depth = models.IntegerField()
+
+  class Meta(object):
+    unique_together = (('ancestor', 'descendant'),)
+
+  @classmethod
+  def add_dependency(cls, dependent_uuid, dependency_uuid):
+    """Connect the dependent annotation and all of its ancestors to the
+    dependency annotation and all of its descendants"""
+    sql = ("INSERT INTO {closure} (ancestor_id, descendant_id, depth) "
+           "SELECT a.id, d.id, MAX(a.depth + d.depth + 1) "
+           "FROM (SELECT id, 0 AS depth FROM {annotation} WHERE uuid = %s "
+           "      UNION ALL "
+           "      SELECT c.ancestor_id, c.depth FROM {closure} AS c "
+           "      INNER JOIN {annotation} AS an ON c.descendant_id = an.id "
+           "      WHERE an.uuid = %s) AS a(id, depth), "
+           "     (SELECT id, 0 AS depth FROM {annotation} WHERE uuid = %s "
+           "      UNION ALL "
+           "      SELECT c.descendant_id, c.depth FROM {closure} AS c "
+           "      INNER JOIN {annotation} AS an ON c.ancestor_id = an.id "
+           "      WHERE an.uuid = %s) AS d(id, depth) "
+           "GROUP BY a.id, d.id "
+           "ON CONFLICT (ancestor_id, descendant_id) DO UPDATE "
+           "SET depth = GREATEST({closure}.depth, EXCLUDED.depth)"
+           "").format(closure=cls._meta.db_table,
+                      annotation=Annotation._meta.db_table)
+    with connection.cursor() as cursor:
+      cursor.execute(sql, (dependent_uuid, dependent_uuid, dependency_uuid,
+                           dependency_uuid))
+
+  @classmethod
+  def remove_dependency(cls, dependent_uuid):
+    """Rebuild the descendants of the dependent annotation and of all of its
+    ancestors, which are the only ones reached through a removed dependency.
+    Descendants of any other annotation never pass through them, so the
+    remaining closure is complete once their dependencies are added back."""
+    annotations = Annotation.objects.filter(
+      models.Q(uuid=dependent_uuid) |
+      models.Q(descendant_closures__descendant__uuid=dependent_uuid))
+    annotation_ids = list(annotations.values_list('id', flat=True).distinct())
+
+    cls.objects.filter(ancestor__in=annotation_ids).delete()
+    dependencies = (Dependency.objects.filter(dependent__id__in=annotation_ids)
+                                      .values_list('dependent', 'dependency'))
+    for dependent, dependency in dependencies:
+      cls.add_dependency(dependent, dependency)
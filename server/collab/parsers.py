@@ -0,0 +1,19 @@
+import msgpack
+
+from rest_framework import parsers, exceptions
+
+
+class MsgPackParser(parsers.BaseParser):
+  media_type = 'application/msgpack'
+
+  def parse(self, stream, media_type=None, parser_context=None):
+    del media_type, parser_context
+    try:
+      return msgpack.unpackb(stream.read(), raw=False)
+    except Exception as ex:
+      raise exceptions.ParseError("MsgPack parse error - {}".format(ex))
+
+
+def is_msgpack_request(request):
+  content_type = getattr(request, 'content_type', '') or ''
+  return content_type.split(';')[0].strip() == MsgPackParser.media_type
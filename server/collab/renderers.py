@@ -0,0 +1,37 @@
+import json
+
+import msgpack
+
+from rest_framework import renderers
+from rest_framework.utils import encoders
+
+
+class NDJSONRenderer(renderers.BaseRenderer):
+  """Newline delimited JSON, one object per line. Streamed exports write
+  their lines directly, so this only renders responses of a single object,
+  such as errors, as a single line."""
+  media_type = 'application/x-ndjson'
+  format = 'ndjson'
+  charset = None
+
+  def render(self, data, accepted_media_type=None, renderer_context=None):
+    del accepted_media_type, renderer_context
+    if data is None:
+      return b''
+    return json.dumps(data).encode('utf-8') + b'\n'
+
+
+class MsgPackRenderer(renderers.BaseRenderer):
+  """Compact binary alternative to JSON. JSON document fields are exchanged
+  as native nested objects instead of strings, see JSONStringField."""
+  media_type = 'application/msgpack'
+  format = 'msgpack'
+  charset = None
+  render_style = 'binary'
+
+  def render(self, data, accepted_media_type=None, renderer_context=None):
+    del accepted_media_type, renderer_context
+    if data is None:
+      return b''
+    return msgpack.packb(data, default=encoders.JSONEncoder().default,
+                         use_bin_type=True)
@@ -1,9 +1,36 @@
 from rest_framework import serializers
 from collab.models import (Project, File, FileVersion, Task, Instance, Vector,
-                           Annotation, Match, Dependency)
+                           Annotation, Match, MatchSummary, Dependency)
+from collab.renderers import MsgPackRenderer
+from collab.parsers import is_msgpack_request
+from collab.assignment import is_optimal_assignment_supported
 import json
 
 
+class JSONStringField(serializers.CharField):
+  """A JSON document stored as a string. Clients using a binary format
+  exchange the document itself as nested data, while JSON clients exchange
+  the string, so documents are never encoded twice."""
+  def to_representation(self, value):
+    request = self.context.get('request')
+    renderer = getattr(request, 'accepted_renderer', None)
+    if isinstance(renderer, MsgPackRenderer):
+      try:
+        return json.loads(value)
+      except ValueError:
+        pass
+    return super(JSONStringField, self).to_representation(value)
+
+  def to_internal_value(self, data):
+    if is_msgpack_request(self.context.get('request')):
+      # binary values have no JSON representation
+      try:
+        return json.dumps(data)
+      except (TypeError, ValueError):
+        self.fail('invalid')
+    return super(JSONStringField, self).to_internal_value(data)
+
+
 class ProjectSerializer(serializers.ModelSerializer):
   owner = serializers.ReadOnlyField(source='owner.username')
   created = serializers.ReadOnlyField()
@@ -42,14 +69,27 @@ class TaskSerializer(serializers.ModelSerializer):
   local_count = serializers.ReadOnlyField()
   remote_count = serializers.ReadOnlyField()
   match_count = serializers.ReadOnlyField()
+  pair_count = serializers.ReadOnlyField()
 
   class Meta(object):
     model = Task
     fields = ('id', 'task_id', 'created', 'finished', 'owner', 'status',
               'target_project', 'target_file', 'source_file',
               'source_file_version', 'source_start', 'source_end', 'matchers',
-              'progress', 'progress_max', 'strategy', 'local_count',
-              'remote_count', 'match_count')
+              'progress', 'progress_max', 'strategy', 'top_k', 'assignment',
+              'assignment_limit', 'local_count', 'remote_count',
+              'match_count', 'pair_count')
+
+  @staticmethod
+  def validate(attrs):
+    if attrs.get('assignment') == Task.ASSIGNMENT_OPTIMAL:
+      if not is_optimal_assignment_supported():
+        raise serializers.ValidationError("Optimal assignment requires "
+                                          "scipy 1.6 or newer")
+      if attrs.get('assignment_limit', 1) != 1:
+        raise serializers.ValidationError("Optimal assignment is only "
+                                          "supported one-to-one")
+    return attrs
 
 
 class TaskEditSerializer(TaskSerializer):
@@ -61,6 +101,9 @@ class TaskEditSerializer(TaskSerializer):
   source_end = serializers.ReadOnlyField()
   matchers = serializers.ReadOnlyField()
   strategy = serializers.ReadOnlyField()
+  top_k = serializers.ReadOnlyField()
+  assignment = serializers.ReadOnlyField()
+  assignment_limit = serializers.ReadOnlyField()
 
 
 class SlimInstanceSerializer(serializers.ModelSerializer):
@@ -70,17 +113,30 @@ class SlimInstanceSerializer(serializers.ModelSerializer):
     model = Instance
     fields = ('id', 'type', 'name', 'offset')
 
-  @staticmethod
-  def get_name(instance):
+  @classmethod
+  def get_name(cls, instance):
     if instance.type == Instance.TYPE_UNIVERSAL:
+      return cls.format_name(instance.type, instance.offset, None)
+
+    # name annotations are selected along with instances by InstanceViewSet,
+    # and only queried separately for instances selected elsewhere
+    if hasattr(instance, 'name_data'):
+      annotation_data = instance.name_data
+    else:
+      annotation_data = (Annotation.objects.filter(instance=instance,
+                                                   type='name')
+                                           .values_list('data', flat=True)
+                                           .first())
+    return cls.format_name(instance.type, instance.offset, annotation_data)
+
+  @staticmethod
+  def format_name(instance_type, offset, annotation_data):
+    """Name an instance by the data of its name annotation, if it has one"""
+    if instance_type == Instance.TYPE_UNIVERSAL:
       return "Universal File Instance"
-    try:
-      annotation = Annotation.objects.values_list('data')
-      annotation_data = annotation.get(instance=instance, type='name')[0]
-      name = json.loads(annotation_data)['name']
-      return name
-    except Annotation.DoesNotExist:
-      return "sub_{:X}".format(instance.offset)
+    if annotation_data is None:
+      return "sub_{:X}".format(offset)
+    return json.loads(annotation_data)['name']
 
 
 class CountInstanceSerializer(SlimInstanceSerializer):
@@ -91,11 +147,14 @@ class CountInstanceSerializer(SlimInstanceSerializer):
 
   @staticmethod
   def get_annotation_count(instance):
+    if hasattr(instance, 'annotations_count'):
+      return instance.annotations_count
     return instance.annotations.count()
 
 
 class AnnotationSerializer(serializers.ModelSerializer):
   uuid = serializers.ReadOnlyField()
+  data = JSONStringField()
 
   class Meta(object):
     model = Annotation
@@ -104,12 +163,22 @@ class AnnotationSerializer(serializers.ModelSerializer):
 
 class VectorSerializer(serializers.ModelSerializer):
   file = serializers.ReadOnlyField(source='file_version.file_id')
+  data = JSONStringField()
 
   class Meta(object):
     model = Vector
     fields = ('id', 'file', 'file_version', 'instance', 'type', 'type_version',
               'data')
 
+  def validate(self, attrs):
+    vector_type = attrs.get('type', getattr(self.instance, 'type', None))
+    data = attrs.get('data', getattr(self.instance, 'data', None))
+    try:
+      Vector.validate_data(vector_type, data)
+    except ValueError as ex:
+      raise serializers.ValidationError({'data': [str(ex)]})
+    return attrs
+
 
 class InstanceVectorSerializer(SlimInstanceSerializer):
   class NestedVectorSerializer(VectorSerializer):
@@ -137,10 +206,12 @@ class InstanceVectorSerializer(SlimInstanceSerializer):
     annotations_data = validated_data.pop('annotations', [])
 
     obj = self.Meta.model.objects.create(**validated_data)
-    vectors = (Vector(instance=obj,
+    vectors = [Vector(instance=obj,
                       file_version=validated_data['file_version'],
                       **vector_data)
-               for vector_data in vectors_data)
+               for vector_data in vectors_data]
+    Vector.encode_vectors(vectors)
+    vectors += Vector.derive_vectors(vectors)
     Vector.objects.bulk_create(vectors)
     annotations = (Annotation(instance=obj, **annotation_data)
                    for annotation_data in annotations_data)
@@ -154,6 +225,14 @@ class MatchSerializer(serializers.ModelSerializer):
     fields = ('from_instance', 'to_instance', 'task', 'type', 'score')
 
 
+class MatchSummarySerializer(serializers.ModelSerializer):
+  matchers = serializers.ReadOnlyField(source='get_match_types')
+
+  class Meta(object):
+    model = MatchSummary
+    fields = ('from_instance', 'to_instance', 'task', 'score', 'matchers')
+
+
 class MatcherSerializer(serializers.Serializer):
   match_type = serializers.ReadOnlyField()
   vector_type = serializers.ReadOnlyField()
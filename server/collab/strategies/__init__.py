@@ -2,9 +2,13 @@ from .strategy_step import StrategyStep
 from .strategy import Strategy
 from .all_strategy import AllStrategy
 from .binning_strategy import BinningStrategy
+from .cascade_strategy import CascadeStrategy, ExclusiveCascadeStrategy
+from .blocking_strategy import BlockingStrategy
+from .blocking import Blocking, BlockingKey
 
 
-strategies_list = [AllStrategy, BinningStrategy]
+strategies_list = [AllStrategy, BinningStrategy, CascadeStrategy,
+                   ExclusiveCascadeStrategy, BlockingStrategy]
 
 
 def strategy_choices():
@@ -24,4 +28,6 @@ def get_strategy(strategy, **kwargs):
 
 
 __all__ = ['Strategy', 'StrategyStep', 'AllStrategy', 'BinningStrategy',
-           'strategies_list', 'strategy_choices', 'get_strategy']
+           'CascadeStrategy', 'ExclusiveCascadeStrategy', 'BlockingStrategy',
+           'Blocking', 'BlockingKey', 'strategies_list', 'strategy_choices',
+           'get_strategy']
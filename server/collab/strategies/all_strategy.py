@@ -1,5 +1,4 @@
 from .strategy import Strategy
-from .strategy_step import StrategyStep
 
 
 class AllStrategy(Strategy):
@@ -14,4 +13,4 @@ class AllStrategy(Strategy):
 
   def get_ordered_steps(self):
     ordered_matchers = self.get_ordered_matchers()
-    return [StrategyStep(self, matcher) for matcher in ordered_matchers]
+    return [self.step_cls(self, matcher) for matcher in ordered_matchers]
@@ -1,71 +1,110 @@
 from .strategy import Strategy
 from .strategy_step import BinningStrategyStep
 
-from django.db.models import Max, Min
+from django.db.models import Q, Count, Aggregate, BigIntegerField
+from django.contrib.postgres.fields import ArrayField
 
-from math import ceil, log
+from math import ceil, sqrt
+
+
+class SizeQuantiles(Aggregate):
+  """Discrete quantiles of an ordered expression, one for every fraction"""
+  function = 'PERCENTILE_DISC'
+  template = ("%(function)s(ARRAY[%(fractions)s]::float8[]) "
+              "WITHIN GROUP (ORDER BY %(expressions)s)")
+
+  def __init__(self, expression, fractions, **extra):
+    fractions = ", ".join(repr(float(f)) for f in fractions)
+    super(SizeQuantiles, self).__init__(
+      expression, fractions=fractions,
+      output_field=ArrayField(BigIntegerField()), **extra)
 
 
 class BinningStrategy(Strategy):
   strategy_name = 'Binning'
   strategy_type = 'binning_strategy'
   strategy_description = ("divide functions to bins by function size, and "
-                          "only attempt to match functions in the same bin.")
+                          "only attempt to match functions in the same bin. "
+                          "Bins hold similar numbers of functions, based on "
+                          "the size distribution of both source and target "
+                          "functions.")
+
+  step_cls = BinningStrategyStep
 
   # Prevent splitting matched objects to bins which are too small
   MINIMAL_BIN_SIZE = 16
-  BIN_BASE = 2
-
-  def get_bins(self, matcher):
-    del matcher
-
-    source_sizes = (self.vector_cls.objects.filter(self.get_source_filter())
-                                           .aggregate(Min('instance__size'),
-                                                      Max('instance__size')))
-    target_sizes = (self.vector_cls.objects.filter(self.get_target_filter())
-                                           .aggregate(Min('instance__size'),
-                                                      Max('instance__size')))
-
-    # find the common denomenator of sizes
-    # or 0 parts are a trick to replce Nones with 0
-    min_size = max(source_sizes['instance__size__min'] or 0,
-                   target_sizes['instance__size__min'] or 0)
-    max_size = min(source_sizes['instance__size__max'] or 0,
-                   target_sizes['instance__size__max'] or 0)
-
-    # Get the highest exponent of BASE that is below the minimal actual matched
-    # object's size. This is esentially the upper bound bin size. Make sure
-    # that size is at least MINIMAL_BIN_SIZE, because we want all really small
-    # matched objects to be binned together (sizes 4 & 6 should still be
-    # matched to eachother, difference is too small to men anything)
-    min_size = max(min_size, self.MINIMAL_BIN_SIZE)
-    min_bin_base_power = int(ceil(log(min_size, self.BIN_BASE)))
-
-    # Get the lowest exponenet of BASE that is above the minimat actual matched
-    # object's size. This is esentially the upper bound bin size.
-    max_size = max(max_size, 1)
-    max_bin_base_power = 1 + int(ceil(log(max_size, self.BIN_BASE)))
-
-    # build binning boundaries based
-    boundaries = [self.BIN_BASE ** i for i in range(min_bin_base_power,
-                                                    max_bin_base_power)]
-
-    # if min size is below the first boundary, which will happen if
-    # min_bin_base_power got bumped up thanks for MINIMAL_BIN_EXPONENT
-    if len(boundaries) > 0 and min_size < boundaries[0]:
-      boundaries = [0] + boundaries
-
-    bins = [(boundaries[i - 1], boundaries[i])
-              for i in range(1, len(boundaries))]
-
-    return bins
+  # Number of bins, grown if needed to keep the estimated number of pairs of
+  # every bin below MAX_BIN_PAIRS. Estimates assume bins split vectors
+  # evenly, so bins merged by repeated sizes or by MINIMAL_BIN_SIZE, and
+  # targets of the BIN_OVERLAP, may still exceed it.
+  BIN_COUNT = 8
+  MAX_BIN_PAIRS = 10 ** 7
+  # Size quantiles bin boundaries are picked out of, and the maximal number
+  # of bins
+  QUANTILES = 256
+  # Target size range of every bin is widened by this fraction on both ends,
+  # so pairs across bin boundaries are still matched
+  BIN_OVERLAP = 0.1
+
+  def get_bins(self):
+    """Return bins of every matcher's vector type, computed by a single
+    aggregate query over source and target vectors of all matchers"""
+    source_filter = self.get_source_filter()
+    target_filter = self.get_target_filter()
+
+    vectors_filter = Q()
+    for matcher in self.get_ordered_matchers():
+      vectors_filter |= Q(type=matcher.vector_type) & matcher.get_filter()
+    if not vectors_filter:
+      return {}
+
+    fractions = [float(i) / self.QUANTILES for i in range(1, self.QUANTILES)]
+    vectors = self.vector_cls.objects.filter(vectors_filter &
+                                             (source_filter | target_filter))
+    sizes = (vectors.order_by()
+                    .values('type')
+                    .annotate(source_count=Count('id', filter=source_filter),
+                              target_count=Count('id', filter=target_filter),
+                              quantiles=SizeQuantiles('instance__size',
+                                                      fractions)))
+
+    return {s['type']: self.get_type_bins(s['source_count'],
+                                          s['target_count'], s['quantiles'])
+            for s in sizes}
+
+  def get_type_bins(self, source_count, target_count, quantiles):
+    """Return (min_size, max_size) bins of a vector type. The number of bins
+    is estimated out of the counts of vectors alone, actual pairs of every
+    bin are not counted."""
+    if not source_count or not target_count:
+      return []
+
+    # bins estimated to split both source and target vectors evenly, so
+    # bin_count bins hold about source_count * target_count / bin_count ** 2
+    # pairs each
+    pair_bins = sqrt(float(source_count) * target_count / self.MAX_BIN_PAIRS)
+    bin_count = max(self.BIN_COUNT, int(ceil(pair_bins)))
+    bin_count = min(bin_count, self.QUANTILES)
+
+    quantile_step = float(self.QUANTILES) / bin_count
+    boundaries = {quantiles[int(round(i * quantile_step)) - 1]
+                  for i in range(1, bin_count)}
+
+    # all small matched objects are binned together, size differences there
+    # are too small to mean anything
+    boundaries = sorted(b for b in boundaries if b >= self.MINIMAL_BIN_SIZE)
+
+    # first and last bins are open ended, so no object is left out
+    boundaries = [None] + boundaries + [None]
+    return list(zip(boundaries[:-1], boundaries[1:]))
 
   def get_ordered_steps(self):
     ordered_steps = list()
 
+    bins = self.get_bins()
     for matcher in self.get_ordered_matchers():
-      for bin_min, bin_max in self.get_bins(matcher):
-        step = BinningStrategyStep(self, matcher, bin_min, bin_max)
+      for bin_min, bin_max in bins.get(matcher.vector_type, []):
+        step = self.step_cls(self, matcher, bin_min, bin_max)
         ordered_steps.append(step)
 
     return ordered_steps
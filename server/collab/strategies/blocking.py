@@ -0,0 +1,78 @@
+from django.db.models import F, Func, Count, IntegerField
+
+
+class BlockingKey(object):
+  """A cheap property of vectors' instances, split into logarithmic bands.
+  Only pairs whose bands are at most tolerance bands apart are plausible."""
+  def __init__(self, name, field, base=2, tolerance=0):
+    self.name = name
+    self.field = field
+    self.base = base
+    self.tolerance = tolerance
+
+  def get_expression(self):
+    return Func(F(self.field), base=float(self.base),
+                template="FLOOR(LN(GREATEST(%(expressions)s, 1)) / "
+                         "LN(%(base)s))",
+                output_field=IntegerField())
+
+  def get_target_filter(self, band):
+    return {self.name + '__gte': band - self.tolerance,
+            self.name + '__lte': band + self.tolerance}
+
+  def __repr__(self):
+    return "<{}; {} base {} tolerance {}>".format(self.__class__.__name__,
+                                                  self.field, self.base,
+                                                  self.tolerance)
+
+
+class Blocking(object):
+  """Splits source and target vectors to candidate blocks by a combination
+  of blocking keys, so matchers only score pairs within a block"""
+  def __init__(self, *keys):
+    self.keys = keys
+
+  def annotate(self, vectors):
+    return vectors.annotate(**{key.name: key.get_expression()
+                               for key in self.keys})
+
+  def get_block_counts(self, vectors):
+    names = [key.name for key in self.keys]
+    blocks = (self.annotate(vectors).order_by()
+                                    .values(*names)
+                                    .annotate(count=Count('id')))
+    return {tuple(block[name] for name in names): block['count']
+            for block in blocks}
+
+  def get_blocks(self, source_vectors, target_vectors):
+    """Return the filters of source and target vectors of every candidate
+    block, and the number of pairs with and without blocking"""
+    source_counts = self.get_block_counts(source_vectors)
+    target_counts = self.get_block_counts(target_vectors)
+
+    blocks = []
+    candidate_pairs = 0
+    for source_block, source_count in source_counts.items():
+      target_count = sum(count for target_block, count in target_counts.items()
+                         if self.is_candidate(source_block, target_block))
+      if not target_count:
+        continue
+
+      candidate_pairs += source_count * target_count
+      source_filter = {key.name: band
+                       for key, band in zip(self.keys, source_block)}
+      target_filter = {}
+      for key, band in zip(self.keys, source_block):
+        target_filter.update(key.get_target_filter(band))
+      blocks.append((source_filter, target_filter))
+
+    total_pairs = sum(source_counts.values()) * sum(target_counts.values())
+    return blocks, candidate_pairs, total_pairs
+
+  def is_candidate(self, source_block, target_block):
+    return all(abs(source_band - target_band) <= key.tolerance
+               for key, source_band, target_band
+               in zip(self.keys, source_block, target_block))
+
+  def __repr__(self):
+    return "<{}; {}>".format(self.__class__.__name__, self.keys)
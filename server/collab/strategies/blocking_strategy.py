@@ -0,0 +1,16 @@
+from .all_strategy import AllStrategy
+from .blocking import Blocking, BlockingKey
+
+
+class BlockingStrategy(AllStrategy):
+  strategy_name = 'Blocking'
+  strategy_type = 'blocking_strategy'
+  strategy_description = ("Runs all matchers, but only on pairs of functions "
+                          "with a similar number of instructions and a "
+                          "similar size, at most a factor of four apart. "
+                          "Exact hash matchers still match all pairs.")
+
+  blocking = Blocking(BlockingKey('count_band', 'instance__count', base=2,
+                                  tolerance=1),
+                      BlockingKey('size_band', 'instance__size', base=2,
+                                  tolerance=1))
@@ -0,0 +1,46 @@
+from collab.matchers import HashMatcher
+
+from .strategy import Strategy
+from .strategy_step import CascadeStrategyStep
+
+
+class CascadeStrategy(Strategy):
+  strategy_name = 'Cascade'
+  strategy_type = 'cascade_strategy'
+  strategy_description = ("Runs matchers one after the other, cheap exact "
+                          "hash matchers first. Source functions already "
+                          "confidently matched by a previous matcher are not "
+                          "matched again by later ones, which greatly reduces "
+                          "the work of expensive matchers when matching "
+                          "similar files.")
+
+  step_cls = CascadeStrategyStep
+  # steps depend on matches of previous steps, so must not run concurrently
+  sequential_steps = True
+
+  # Instances matched at least this score are excluded from later steps
+  CONFIDENT_SCORE = 90
+  exclude_matched_targets = False
+
+  def get_ordered_steps(self):
+    # stable sort keeps the matchers_list order among hash matchers and among
+    # all others
+    ordered_matchers = sorted(self.get_ordered_matchers(),
+                              key=lambda m: not issubclass(m, HashMatcher))
+    return [self.step_cls(self, matcher) for matcher in ordered_matchers]
+
+  def get_matched_instances(self, field):
+    from collab.models import Match
+    return (Match.objects.filter(task_id=self.task,
+                                 score__gte=self.CONFIDENT_SCORE)
+                         .values(field))
+
+
+class ExclusiveCascadeStrategy(CascadeStrategy):
+  strategy_name = 'Exclusive Cascade'
+  strategy_type = 'exclusive_cascade_strategy'
+  strategy_description = ("Same as the Cascade strategy, but functions "
+                          "confidently matched by a previous matcher are "
+                          "excluded from both sides of later matchers.")
+
+  exclude_matched_targets = True
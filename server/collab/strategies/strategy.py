@@ -1,20 +1,31 @@
-from django.db.models import Q
+from django.db.models import Q, F
 
 import json
 
 from collab.matchers import matchers_list
 
+from .strategy_step import StrategyStep
+
 
 class Strategy(object):
+  step_cls = StrategyStep
+  # steps are independent of each other and may all run concurrently
+  sequential_steps = False
+  # when set, steps only match pairs in the same candidate block
+  blocking = None
+
   def __init__(self, vector_cls, source_file, source_start, source_end,
-               source_file_version, target_project, target_file, matchers):
+               source_file_version, target_project, target_file, matchers,
+               top_k=None, task=None):
     self.vector_cls = vector_cls
+    self.task = task
     self.source_file = source_file
     self.source_start = source_start
     self.source_end = source_end
     self.source_file_version = source_file_version
     self.target_project = target_project
     self.target_file = target_file
+    self.top_k = top_k
 
     self.matchers = set(json.loads(matchers))
 
@@ -36,32 +47,31 @@ class Strategy(object):
     return source_filter
 
   def get_target_filter(self):
+    # By itself, this selects the latest complete version of every file, by
+    # joining vectors' file versions against their files' latest version
+    target_filter = Q(file_version__file__latest_version=F('file_version'))
+
     # Exclude source file inputs from the target
-    fv_filter = ~Q(file=self.source_file)
+    target_filter &= ~Q(file_version__file=self.source_file)
 
     # if provided with a target file make sure to filter by it, else limit to
     # provided project or not at all
     if self.target_file:
-      fv_filter &= Q(file=self.target_file)
+      target_filter &= Q(file_version__file=self.target_file)
     elif self.target_project:
-      fv_filter &= Q(file__project_id=self.target_project)
+      target_filter &= Q(file_version__file__project_id=self.target_project)
 
-    # TODO: this currently requires importing models.FileVersion which creates
-    # a cyclic import, so this hacky import is a way to handle that until we
-    # come up with a better solution.
-    # By itself, this selects the single newest file version for every file
-    from collab.models import FileVersion
-    file_versions = (FileVersion.objects.filter(fv_filter)
-                                        .order_by('file', '-created')
-                                        .distinct('file'))
-
-    return Q(file_version__in=file_versions)
+    return target_filter
 
   def get_ordered_matchers(self):
     # return matchers in self.matchers ordered by the order they appear in
     # matchers.matchers_list
     return [m for m in matchers_list if m.match_type in self.matchers]
 
+  def build_step(self, matcher, **kwargs):
+    matcher_cls = next(m for m in matchers_list if m.match_type == matcher)
+    return self.step_cls(self, matcher_cls, **kwargs)
+
   @classmethod
   def is_abstract(cls):
     return not (hasattr(cls, 'strategy_type') and
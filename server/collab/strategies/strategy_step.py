@@ -1,11 +1,37 @@
 from django.db.models import Q
 
+from collab.matchers import HashMatcher
+
 
 class StrategyStep(object):
   def __init__(self, strategy, matcher):
     self.strategy = strategy
     self.matcher = matcher
 
+  def get_params(self):
+    """Return the parameters needed to rebuild this step using
+    Strategy.build_step, possibly by a different worker"""
+    return {'matcher': self.matcher.match_type}
+
+  def get_cache_key(self):
+    """Return the fields identifying this step's matches in a MatchCache,
+    or None if matches of a source and target file version also depend on
+    other file versions, and therefore cannot be reused."""
+    # top matches are picked out of all targets, hash matches all score the
+    # same and are unaffected by top_k
+    if (self.strategy.top_k is not None and
+        not issubclass(self.matcher, HashMatcher)):
+      return None
+
+    # blocked steps only match some of the pairs
+    if self.is_blocked():
+      return None
+
+    return {'source_file_version_id': self.strategy.source_file_version,
+            'source_start': self.strategy.source_start,
+            'source_end': self.strategy.source_end,
+            'match_type': self.get_match_type()}
+
   def get_match_type(self):
     return self.matcher.match_type
 
@@ -21,8 +47,47 @@ class StrategyStep(object):
     return (self.get_filter() &
             self.strategy.get_target_filter())
 
+  def is_blocked(self):
+    """Return whether the strategy's blocking applies to this step. Hash
+    matchers are never blocked, exact matches are cheap to find among all
+    pairs and the blocking keys would only drop some of them"""
+    return (self.strategy.blocking is not None and
+            not issubclass(self.matcher, HashMatcher))
+
   def gen_matches(self, source_vectors, target_vectors):
-    return self.matcher.match(source_vectors, target_vectors)
+    if not self.is_blocked():
+      return self.matcher.match(source_vectors, target_vectors,
+                                top_k=self.strategy.top_k)
+    return self.gen_blocked_matches(self.strategy.blocking, source_vectors,
+                                    target_vectors)
+
+  def gen_blocked_matches(self, blocking, source_vectors, target_vectors):
+    """Match each block of source vectors only to the target vectors of its
+    candidate blocks"""
+    blocks, candidate_pairs, total_pairs = blocking.get_blocks(source_vectors,
+                                                               target_vectors)
+    print("Blocking by {} left {} out of {} pairs ({:.2%}) in {} blocks"
+          "".format(blocking, candidate_pairs, total_pairs,
+                    float(candidate_pairs) / max(total_pairs, 1),
+                    len(blocks)))
+
+    # every source vector belongs to a single block, so the top_k matches of
+    # each block are the top_k matches of its source vectors
+    source_vectors = blocking.annotate(source_vectors)
+    target_vectors = blocking.annotate(target_vectors)
+    for source_filter, target_filter in blocks:
+      for match in self.matcher.match(source_vectors.filter(**source_filter),
+                                      target_vectors.filter(**target_filter),
+                                      top_k=self.strategy.top_k):
+        yield match
+
+  def get_match_query(self, source_vectors, target_vectors):
+    """Return a query inserting all matches of this step in the database, or
+    None if matches are generated by gen_matches. The query joins all pairs,
+    so it is only used by unblocked steps"""
+    if self.is_blocked():
+      return None
+    return self.matcher.get_match_query(source_vectors, target_vectors)
 
   def __repr__(self):
       return "<{}; Matcher={}>".format(self.__class__.__name__,
@@ -30,8 +95,11 @@ class StrategyStep(object):
 
 
 class BinningStrategyStep(StrategyStep):
+  """Matches source objects sized min_size up to (excluding) max_size, to
+  target objects in the same size range widened by the strategy's
+  BIN_OVERLAP. A None size leaves the bin open ended."""
   def __init__(self, strategy, matcher, min_size, max_size):
-    if min_size >= max_size:
+    if min_size is not None and max_size is not None and min_size >= max_size:
       raise ValueError("Invalid bin sizes")
 
     super(BinningStrategyStep, self).__init__(strategy, matcher)
@@ -39,12 +107,57 @@ class BinningStrategyStep(StrategyStep):
     self.min_size = min_size
     self.max_size = max_size
 
+  @staticmethod
+  def get_cache_key():
+    # bins are derived from sizes of all targets
+    return None
+
+  def get_params(self):
+    params = super(BinningStrategyStep, self).get_params()
+    params.update(min_size=self.min_size, max_size=self.max_size)
+    return params
+
+  @staticmethod
+  def get_size_filter(min_size, max_size):
+    size_filter = Q()
+    if min_size is not None:
+      size_filter &= Q(instance__size__gte=min_size)
+    if max_size is not None:
+      size_filter &= Q(instance__size__lt=max_size)
+    return size_filter
+
   def get_source_filter(self):
     return (super(BinningStrategyStep, self).get_source_filter() &
-            Q(instance__size__gte=self.min_size) &
-            Q(instance__size__lte=self.max_size))
+            self.get_size_filter(self.min_size, self.max_size))
 
   def get_target_filter(self):
+    overlap = 1 + self.strategy.BIN_OVERLAP
+    min_size = None if self.min_size is None else self.min_size / overlap
+    max_size = None if self.max_size is None else self.max_size * overlap
     return (super(BinningStrategyStep, self).get_target_filter() &
-            Q(instance__size__gte=self.min_size) &
-            Q(instance__size__lte=self.max_size))
+            self.get_size_filter(min_size, max_size))
+
+  def __repr__(self):
+      return "<{}; Matcher={}; Sizes={}-{}>".format(self.__class__.__name__,
+                                                    self.matcher.match_type,
+                                                    self.min_size,
+                                                    self.max_size)
+
+
+class CascadeStrategyStep(StrategyStep):
+  @staticmethod
+  def get_cache_key():
+    # matches depend on matches of previous steps of the same task
+    return None
+
+  def get_source_filter(self):
+    matched = self.strategy.get_matched_instances('from_instance')
+    return (super(CascadeStrategyStep, self).get_source_filter() &
+            ~Q(instance__in=matched))
+
+  def get_target_filter(self):
+    target_filter = super(CascadeStrategyStep, self).get_target_filter()
+    if self.strategy.exclude_matched_targets:
+      matched = self.strategy.get_matched_instances('to_instance')
+      target_filter &= ~Q(instance__in=matched)
+    return target_filter
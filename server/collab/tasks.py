@@ -1,29 +1,43 @@
-from itertools import islice, chain
+from collab.models import (Task, FileVersion, Instance, Vector, Match,
+                           MatchSummary, MatchCache)
+from collab.bulk import copy_rows
+from collab.assignment import greedy_assignment, optimal_assignment
+from collab.matchers import (matchers_list, match_types_mask,
+                             DictionaryMatcher)
+from collab import strategies, feature_store
 
-from collab.models import Task, Vector, Match
-from collab import strategies
-
-from celery import shared_task
+from celery import shared_task, chord, chain
 
 from django.utils.timezone import now
-from django.db.models import F
+from django.db import connection
+from django.db.models import F, Count, Max
 
 import numpy as np
 
 
+# Order of values in match rows provided to copy_rows
+MATCH_FIELDS = ('task', 'from_instance', 'to_instance', 'type', 'score',
+                'created')
+
+
+def get_task_strategy(task):
+  # get input parameters
+  task_values = task.values('source_start', 'source_end', 'target_file',
+                            'target_project', 'source_file_version',
+                            'matchers', 'strategy', 'top_k',
+                            source_file=F('source_file_version__file'),
+                            task=F('id')).get()
+
+  # create strategy instance
+  return strategies.get_strategy(vector_cls=Vector, **task_values)
+
+
 @shared_task
 def match(task_id):
   try:
     task = Task.objects.filter(id=task_id)
 
-    # get input parameters
-    task_values = task.values('source_start', 'source_end', 'target_file',
-                              'target_project', 'source_file_version',
-                              'matchers', 'strategy',
-                              source_file=F('source_file_version__file')).get()
-
-    # create strategy instance
-    strategy = strategies.get_strategy(vector_cls=Vector, **task_values)
+    strategy = get_task_strategy(task)
 
     # building steps according to strategy
     steps = strategy.get_ordered_steps()
@@ -32,26 +46,60 @@ def match(task_id):
     task.update(status=Task.STATUS_STARTED, task_id=match.request.id,
                 progress_max=len(steps), progress=0)
 
-    local_ids = set()
-    remote_ids = set()
+    # every step is matched by a separate subtask, so steps are spread across
+    # all available workers. The task is finished once all of them are done
     print("Running task {}, strategy {}".format(match.request.id, strategy))
-    # TODO: local and remote counts are wrong, they count all vectors used
-    # instead of number of vectors that actually matched
-    for step in steps:
-      match_count = match_by_step(task_id, local_ids, remote_ids, step)
-      task.update(progress=F('progress') + 1,
-                  match_count=F('match_count') + match_count,
-                  local_count=len(local_ids), remote_count=len(remote_ids))
+    step_tasks = [match_step.si(task_id, step.get_params()) for step in steps]
+    if strategy.sequential_steps:
+      chain(*(step_tasks + [finish_match.si(task_id)]))()
+    else:
+      chord(step_tasks)(finish_match.si(task_id))
+  except Exception:
+    task.update(status=Task.STATUS_FAILED, finished=now())
+    raise
+
+
+@shared_task
+def match_step(task_id, step_params):
+  try:
+    task = Task.objects.filter(id=task_id)
+
+    step = get_task_strategy(task).build_step(**step_params)
+    match_count = match_by_step(task_id, step)
+    task.update(progress=F('progress') + 1,
+                match_count=F('match_count') + match_count)
+  except Exception:
+    task.update(status=Task.STATUS_FAILED, finished=now())
+    raise
+
+  return match_count
+
+
+@shared_task
+def finish_match(task_id):
+  try:
+    task = Task.objects.filter(id=task_id)
+    matches = Match.objects.filter(task_id=task_id)
 
     # sanity checks
     if not task.filter(progress=F('progress_max')).count():
       raise RuntimeError("Task successfully finished without executing all "
                          "steps")
 
-    match_count = Match.objects.filter(task_id=task_id).count()
+    match_count = matches.count()
     if not task.filter(match_count=match_count).count():
         raise RuntimeError("Collected counts of matches does not match final "
                            "matches count")
+
+    assign_matches(task_id)
+    pair_count = summarize_matches(task_id)
+
+    # count matched instances once all matches are stored and assigned
+    task.update(match_count=matches.count(), pair_count=pair_count,
+                **matches.aggregate(local_count=Count('from_instance',
+                                                      distinct=True),
+                                    remote_count=Count('to_instance',
+                                                       distinct=True)))
   except Exception:
     task.update(status=Task.STATUS_FAILED, finished=now())
     raise
@@ -59,61 +107,198 @@ def match(task_id):
   task.update(status=Task.STATUS_DONE, finished=now())
 
 
-# Django bulk_create converts `objs` to a list, rendering any generator
-# useless. This batch method is used to implement `batch_size` functionality
-# outside of `bulk_create`.
-# For more info and status see:
-# https://code.djangoproject.com/ticket/28231
-def batch(iterable, size):
-    sourceiter = iter(iterable)
-    while True:
-        batchiter = islice(sourceiter, size)
-        yield chain([next(batchiter)], batchiter)
+@shared_task
+def build_feature_store(file_version_id):
+  """Store feature matrices of a complete file version for all dictionary
+  matchers, so they are not rebuilt by every matching step"""
+  vector_types = {m.vector_type for m in matchers_list
+                  if issubclass(m, DictionaryMatcher)}
+  for vector_type in vector_types:
+    feature_store.build(file_version_id, vector_type)
+
+
+def assign_matches(task_id):
+  """Only keep matches of instance pairs assigned by the task's assignment
+  method, scoring every pair by its highest scored match"""
+  assignment, limit = (Task.objects.filter(id=task_id)
+                                   .values_list('assignment',
+                                                'assignment_limit').get())
+  if assignment == Task.ASSIGNMENT_NONE:
     return
 
+  pairs = (Match.objects.filter(task_id=task_id)
+                        .order_by()
+                        .values('from_instance', 'to_instance')
+                        .annotate(score=Max('score'))
+                        .values_list('from_instance', 'to_instance', 'score'))
+  pairs = list(pairs)
+  if not pairs:
+    return
+  sources, targets, scores = (np.array(values) for values in zip(*pairs))
+
+  # matches left unassigned are deleted below, so they could no longer be
+  # copied into later tasks reusing this task's matches
+  MatchCache.objects.filter(task_id=task_id).delete()
+
+  if assignment == Task.ASSIGNMENT_GREEDY:
+    assigned = greedy_assignment(sources, targets, scores, limit)
+  elif assignment == Task.ASSIGNMENT_OPTIMAL:
+    assigned = optimal_assignment(sources, targets, scores)
+  else:
+    raise ValueError("Unfamiliar assignment method: {}".format(assignment))
 
-def match_by_step(task_id, local_ids, remote_ids, step):
+  sql = ("DELETE FROM {match} AS m WHERE m.task_id = %s AND NOT EXISTS ("
+         "SELECT 1 FROM UNNEST(%s::integer[], %s::integer[]) AS a(f, t) "
+         "WHERE m.from_instance_id = a.f AND m.to_instance_id = a.t)"
+         "").format(match=Match._meta.db_table)
+  with connection.cursor() as cursor:
+    cursor.execute(sql, (task_id, sources[assigned].tolist(),
+                         targets[assigned].tolist()))
+  print("Assignment kept {} out of {} matched pairs"
+        "".format(assigned.sum(), len(pairs)))
+
+
+def summarize_matches(task_id):
+  """Combine all matches of every matched instance pair to a single match
+  summary. Returns the number of matched pairs. Pairs are kept even if only
+  matched by types of no listed matcher, with no bits set for those."""
+  match_types = [m.match_type for m in matchers_list]
+  masks = [match_types_mask([match_type]) for match_type in match_types]
+
+  MatchSummary.objects.filter(task_id=task_id).delete()
+  sql = ("INSERT INTO {summary} (task_id, from_instance_id, to_instance_id, "
+         "score, matchers) "
+         "SELECT m.task_id, m.from_instance_id, m.to_instance_id, "
+         "MAX(m.score), BIT_OR(COALESCE(t.mask, 0)) "
+         "FROM {match} AS m "
+         "LEFT JOIN UNNEST(%s::text[], %s::integer[]) AS t(type, mask) "
+         "ON m.type = t.type "
+         "WHERE m.task_id = %s "
+         "GROUP BY m.task_id, m.from_instance_id, m.to_instance_id"
+         "").format(summary=MatchSummary._meta.db_table,
+                    match=Match._meta.db_table)
+  with connection.cursor() as cursor:
+    cursor.execute(sql, (match_types, masks, task_id))
+    return cursor.rowcount
+
+
+def match_by_step(task_id, step):
   start = now()
   source_vectors = Vector.objects.filter(step.get_source_filter())
   target_vectors = Vector.objects.filter(step.get_target_filter())
 
+  # reuse matches of target file versions previous tasks already matched
+  cache_key = step.get_cache_key()
+  cached_count = 0
+  if cache_key:
+    cache_key['type_version'] = (source_vectors.aggregate(Max('type_version'))
+                                               ['type_version__max'])
+    cached_count, target_vectors = copy_cached_matches(task_id, cache_key,
+                                                       target_vectors)
+
   local_count = source_vectors.count()
   remote_count = target_vectors.count()
   if not local_count or not remote_count:
     print("Skipped step {} with {} local vectors and {} remote vectors"
           "".format(step, local_count, remote_count))
-    return 0
+    return cached_count
 
   print("Matching {} local vectors to {} remote vectors by {}"
         "".format(local_count, remote_count, step))
 
-  match_count = 0
-  match_objs = gen_match_objs(task_id, step, source_vectors, target_vectors,
-                              local_ids, remote_ids)
-  for b in batch(match_objs, 10000):
-    # bulk_create turns b into a list regardless, so lets make it useful
-    b = list(b)
-    match_count += len(b)
-    Match.objects.bulk_create(b)
+  match_query = step.get_match_query(source_vectors, target_vectors)
+  if match_query:
+    match_count = insert_matches(task_id, step, *match_query)
+  else:
+    match_rows = gen_match_rows(task_id, step, source_vectors, target_vectors)
+    match_count = copy_rows(Match, MATCH_FIELDS, match_rows)
   print("Took {} and resulted in {} match objects".format(now() - start,
                                                           match_count))
 
-  return match_count
+  if cache_key:
+    cache_matches(task_id, cache_key, target_vectors)
+
+  return cached_count + match_count
+
+
+def copy_cached_matches(task_id, cache_key, target_vectors):
+  """Copy matches of all target file versions available in MatchCache into
+  task. Returns the number of copied matches and target_vectors, excluding
+  vectors of target file versions that were copied."""
+  target_file_versions = (target_vectors.order_by()
+                                        .values('file_version_id')
+                                        .distinct())
+  caches = MatchCache.objects.filter(
+    target_file_version__complete=True,
+    target_file_version__in=target_file_versions,
+    **cache_key)
+  caches = caches.order_by('created').values_list('target_file_version', 'id')
+
+  # a single (latest) cache entry is used for every target file version
+  cache_ids = dict(caches)
+  if not cache_ids:
+    return 0, target_vectors
+
+  sql = ("INSERT INTO {match} (from_instance_id, to_instance_id, score, "
+         "type, created, task_id) "
+         "SELECT m.from_instance_id, m.to_instance_id, m.score, m.type, "
+         "%s, %s "
+         "FROM {match} AS m "
+         "INNER JOIN {instance} AS i ON m.to_instance_id = i.id "
+         "INNER JOIN {cache} AS c ON m.task_id = c.task_id AND "
+         "i.file_version_id = c.target_file_version_id AND "
+         "m.type = c.match_type "
+         "WHERE c.id = ANY(%s)"
+         "").format(match=Match._meta.db_table,
+                    instance=Instance._meta.db_table,
+                    cache=MatchCache._meta.db_table)
+  with connection.cursor() as cursor:
+    cursor.execute(sql, (now(), task_id, list(cache_ids.values())))
+    cached_count = cursor.rowcount
+
+  print("Copied {} cached matches of {} target file versions"
+        "".format(cached_count, len(cache_ids)))
+  target_vectors = target_vectors.exclude(file_version__in=cache_ids.keys())
+  return cached_count, target_vectors
+
+
+def cache_matches(task_id, cache_key, target_vectors):
+  """Record matches of task to all complete target file versions were
+  calculated, so later tasks could reuse them."""
+  source_complete = FileVersion.objects.filter(
+    id=cache_key['source_file_version_id'], complete=True).exists()
+  if not source_complete:
+    return
+
+  target_file_versions = (FileVersion.objects
+                                     .filter(complete=True,
+                                             vectors__in=target_vectors)
+                                     .values_list('id', flat=True)
+                                     .distinct())
+  MatchCache.objects.bulk_create(MatchCache(task_id=task_id,
+                                            target_file_version_id=fv_id,
+                                            **cache_key)
+                                 for fv_id in target_file_versions)
+
+
+def insert_matches(task_id, step, match_sql, match_params):
+  # Matches are both found and stored by the database, without ever passing
+  # through the worker
+  sql = ("INSERT INTO {table} (from_instance_id, to_instance_id, score, "
+         "created, task_id, type) "
+         "SELECT matches.*, %s, %s, %s FROM ({matches}) AS matches"
+         "").format(table=Match._meta.db_table, matches=match_sql)
+  params = (now(), task_id, step.get_match_type()) + tuple(match_params)
+
+  with connection.cursor() as cursor:
+    cursor.execute(sql, params)
+    return cursor.rowcount
 
 
-def gen_match_objs(task_id, step, source_vectors, target_vectors, local_ids,
-                   remote_ids):
+def gen_match_rows(task_id, step, source_vectors, target_vectors):
+  created = now()
+  match_type = step.get_match_type()
   matches = step.gen_matches(source_vectors, target_vectors)
   for source_instance, target_instance, score in matches:
-    if not np.isfinite(score):
-      print("Infinite score detected: {} in step {} between {} and {}"
-            "".format(score, step, source_instance, target_instance))
-      continue
-    if score < 50:
-      continue
-    mat = Match(task_id=task_id, from_instance_id=source_instance,
-                to_instance_id=target_instance, score=score,
-                type=step.get_match_type())
-    local_ids.add(source_instance)
-    remote_ids.add(target_instance)
-    yield mat
+    yield (task_id, source_instance, target_instance, match_type, score,
+           created)
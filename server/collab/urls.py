@@ -9,6 +9,7 @@ router.register(r'files', views.FileViewSet)
 router.register(r'file_versions', views.FileVersionViewSet)
 router.register(r'tasks', views.TaskViewSet)
 router.register(r'matches', views.MatchViewSet)
+router.register(r'match_summaries', views.MatchSummaryViewSet)
 router.register(r'instances', views.InstanceViewSet)
 router.register(r'vectors', views.VectorViewSet)
 router.register(r'annotations', views.AnnotationViewSet)
@@ -1,30 +1,47 @@
 from logging import getLogger
 import functools
+import json
 
 from rest_framework import (viewsets, permissions, decorators, response,
-                            pagination, status)
+                            pagination, status, renderers)
+from rest_framework.settings import api_settings
 
 from django.db import models
-from django.http import Http404
-
-import django_cte
+from django.db.models.functions import Coalesce
+from django.http import Http404, StreamingHttpResponse
+from django.utils.cache import patch_vary_headers
+from django.utils.text import compress_sequence
 
 from collab.models import (Project, File, FileVersion, Task, Instance, Vector,
-                           Match, Annotation, Dependency)
+                           Match, MatchSummary, MatchCache, Annotation,
+                           Dependency, DependencyClosure, FeatureVersion)
 from collab.serializers import (ProjectSerializer, FileSerializer,
                                 FileVersionSerializer, TaskSerializer,
                                 TaskEditSerializer, InstanceVectorSerializer,
                                 VectorSerializer, MatchSerializer,
+                                MatchSummarySerializer,
                                 SlimInstanceSerializer, AnnotationSerializer,
                                 MatcherSerializer, StrategySerializer,
                                 DependencySerializer, CountInstanceSerializer)
 from collab.permissions import IsOwnerOrReadOnly
 from collab import tasks
-from collab.matchers import matchers_list
+from collab.ingest import ingest_instances
+from collab.renderers import NDJSONRenderer, MsgPackRenderer
+from collab.parsers import MsgPackParser, is_msgpack_request
+from collab.matchers import matchers_list, mask_match_types
 from collab.strategies import strategies_list
 from collab.filters import InstanceFilter
 
 
+class MsgPackMixin(object):
+  """Negotiate msgpack along with the default formats. Only collab
+  endpoints exchange msgpack, see JSONStringField."""
+  renderer_classes = (tuple(api_settings.DEFAULT_RENDERER_CLASSES) +
+                      (MsgPackRenderer,))
+  parser_classes = (tuple(api_settings.DEFAULT_PARSER_CLASSES) +
+                    (MsgPackParser,))
+
+
 class ViewSetOwnerMixin(object):
   permission_classes = (permissions.IsAuthenticated, IsOwnerOrReadOnly)
 
@@ -48,6 +65,87 @@ class DefaultPagination(pagination.CursorPagination):
     page_size_query_param = 'page_size'
 
 
+class IdPagination(DefaultPagination):
+    ordering = 'id'
+
+
+def ndjson_response(request, objects, chunk_size=1000):
+  """Stream objects as NDJSON, one object per line. Objects are encoded in
+  chunks as they are consumed, and gzipped for clients accepting gzip
+  encoding."""
+  content = ndjson_chunks(objects, chunk_size)
+
+  gzipped = accepts_gzip(request.META.get('HTTP_ACCEPT_ENCODING', ''))
+  if gzipped:
+    content = compress_sequence(content)
+  streaming_response = StreamingHttpResponse(
+    content, content_type=NDJSONRenderer.media_type)
+  if gzipped:
+    streaming_response['Content-Encoding'] = 'gzip'
+  patch_vary_headers(streaming_response, ('Accept-Encoding',))
+  return streaming_response
+
+
+def accepts_gzip(accept_encoding):
+  """Return whether an Accept-Encoding header value accepts gzip, either
+  explicitly or through a wildcard, with a non zero quality value"""
+  qualities = {}
+  for coding in accept_encoding.split(','):
+    params = coding.split(';')
+    name = params[0].strip().lower()
+    quality = 1.0
+    for param in params[1:]:
+      key, _, value = param.partition('=')
+      if key.strip().lower() == 'q':
+        try:
+          quality = float(value)
+        except ValueError:
+          quality = 0.0
+    if name:
+      qualities[name] = quality
+  return qualities.get('gzip', qualities.get('*', 0.0)) > 0
+
+
+def ndjson_chunks(objects, chunk_size):
+  lines = []
+  for obj in objects:
+    lines.append(json.dumps(obj))
+    if len(lines) >= chunk_size:
+      yield ("\n".join(lines) + "\n").encode('utf-8')
+      lines = []
+  if lines:
+    yield ("\n".join(lines) + "\n").encode('utf-8')
+
+
+class ExportMixin(object):
+  """Adds an export action streaming all filtered objects as NDJSON instead
+  of paginating them. Objects are read through a server side cursor, so
+  memory use is constant regardless of the number of objects."""
+  export_fields = ()
+  export_required_params = ()
+  export_chunk_size = 1000
+
+  @decorators.action(detail=False,
+                     renderer_classes=(NDJSONRenderer, renderers.JSONRenderer))
+  def export(self, request):
+    missing_params = [p for p in self.export_required_params
+                      if p not in request.GET]
+    if missing_params:
+      detail = "Missing required parameters: {}".format(
+        ", ".join(missing_params))
+      return response.Response({'detail': detail},
+                               status=status.HTTP_400_BAD_REQUEST)
+
+    queryset = self.filter_queryset(self.get_queryset())
+    rows = queryset.order_by().values(*self.export_fields).iterator()
+    return ndjson_response(request, (self.export_row(row) for row in rows),
+                           self.export_chunk_size)
+
+  @staticmethod
+  def export_row(row):
+    return row
+
+
 def paginatable(serializer_cls):
   def decorator(f):
     @functools.wraps(f)
@@ -66,13 +164,13 @@ def paginatable(serializer_cls):
   return decorator
 
 
-class ProjectViewSet(ViewSetOwnerMixin, viewsets.ModelViewSet):
+class ProjectViewSet(MsgPackMixin, ViewSetOwnerMixin, viewsets.ModelViewSet):
   queryset = Project.objects.all()
   serializer_class = ProjectSerializer
   filterset_fields = ('created', 'owner', 'name', 'description', 'private')
 
 
-class FileViewSet(ViewSetOwnerMixin, viewsets.ModelViewSet):
+class FileViewSet(MsgPackMixin, ViewSetOwnerMixin, viewsets.ModelViewSet):
   queryset = File.objects.all()
   serializer_class = FileSerializer
   filterset_fields = ('created', 'owner', 'project', 'name', 'description',
@@ -92,7 +190,7 @@ class FileViewSet(ViewSetOwnerMixin, viewsets.ModelViewSet):
     return response.Response(data=serializer.data)
 
 
-class FileVersionViewSet(viewsets.ModelViewSet):
+class FileVersionViewSet(MsgPackMixin, viewsets.ModelViewSet):
   queryset = FileVersion.objects.all()
   serializer_class = FileVersionSerializer
   permission_classes = (permissions.IsAuthenticated,)
@@ -108,8 +206,15 @@ class FileVersionViewSet(viewsets.ModelViewSet):
 
     return super(FileVersionViewSet, self).create(request, *args, **kwargs)
 
+  @staticmethod
+  def perform_update(serializer):
+    file_version = serializer.save()
+    if file_version.complete:
+      MatchCache.invalidate(file_version)
+      tasks.build_feature_store.delay(file_version_id=file_version.id)
+
 
-class TaskViewSet(ViewSetOwnerMixin, viewsets.ModelViewSet):
+class TaskViewSet(MsgPackMixin, ViewSetOwnerMixin, viewsets.ModelViewSet):
   queryset = Task.objects.all()
   filterset_fields = ('task_id', 'created', 'finished', 'owner', 'status')
 
@@ -117,6 +222,70 @@ class TaskViewSet(ViewSetOwnerMixin, viewsets.ModelViewSet):
     task = serializer.save(owner=self.request.user)
     tasks.match.delay(task_id=task.id)
 
+  @decorators.action(detail=True,
+                     renderer_classes=(NDJSONRenderer, renderers.JSONRenderer))
+  def results(self, request, pk=None):
+    """Stream all results of a task as a single NDJSON document. Every line
+    is either a local instance, a remote instance or a match between them,
+    and every instance is only sent once, before any of its matches."""
+    del pk
+    task = self.get_object()
+    return ndjson_response(request, self.get_results(task.id))
+
+  @staticmethod
+  def get_results(task_id):
+    """Collect results in a single pass over the task's match summaries,
+    selected along with both of their instances"""
+    def names(field):
+      return models.Subquery(
+        Annotation.objects.filter(instance=models.OuterRef(field),
+                                  type='name')
+                          .values('data')[:1])
+    remote = models.OuterRef('to_instance')
+    counts = (Annotation.objects.filter(instance=remote)
+                                .order_by()
+                                .values('instance')
+                                .annotate(count=models.Count('id'))
+                                .values('count'))
+    annotation_count = Coalesce(models.Subquery(counts), 0)
+
+    summaries = MatchSummary.objects.filter(task_id=task_id).order_by()
+    summaries = summaries.values('from_instance', 'to_instance', 'score',
+                                 'matchers', 'from_instance__type',
+                                 'from_instance__offset', 'to_instance__type',
+                                 'to_instance__offset')
+    summaries = summaries.annotate(from_name=names('from_instance'),
+                                   to_name=names('to_instance'),
+                                   annotation_count=annotation_count)
+
+    local_ids = set()
+    remote_ids = set()
+    for summary in summaries.iterator():
+      local_id = summary['from_instance']
+      if local_id not in local_ids:
+        local_ids.add(local_id)
+        yield {'kind': 'local', 'id': local_id,
+               'type': summary['from_instance__type'],
+               'offset': summary['from_instance__offset'],
+               'name': SlimInstanceSerializer.format_name(
+                 summary['from_instance__type'],
+                 summary['from_instance__offset'], summary['from_name'])}
+
+      remote_id = summary['to_instance']
+      if remote_id not in remote_ids:
+        remote_ids.add(remote_id)
+        yield {'kind': 'remote', 'id': remote_id,
+               'type': summary['to_instance__type'],
+               'offset': summary['to_instance__offset'],
+               'name': SlimInstanceSerializer.format_name(
+                 summary['to_instance__type'],
+                 summary['to_instance__offset'], summary['to_name']),
+               'annotation_count': summary['annotation_count']}
+
+      yield {'kind': 'match', 'from_instance': local_id,
+             'to_instance': remote_id, 'score': summary['score'],
+             'matchers': mask_match_types(summary['matchers'])}
+
   def get_serializer_class(self):
     # Limit editable fields if performing an update
     serializer_class = TaskSerializer
@@ -125,12 +294,15 @@ class TaskViewSet(ViewSetOwnerMixin, viewsets.ModelViewSet):
     return serializer_class
 
 
-class MatchViewSet(viewsets.ReadOnlyModelViewSet):
+class MatchViewSet(MsgPackMixin, ExportMixin,
+                   viewsets.ReadOnlyModelViewSet):
   queryset = Match.objects.all()
   serializer_class = MatchSerializer
   permission_classes = (permissions.IsAuthenticated,)
   filterset_fields = ('task', 'type', 'score')
   pagination_class = DefaultPagination
+  export_fields = ('from_instance', 'to_instance', 'task', 'type', 'score')
+  export_required_params = ('task',)
 
   @staticmethod
   @decorators.action(detail=False)
@@ -151,8 +323,25 @@ class MatchViewSet(viewsets.ReadOnlyModelViewSet):
     return response.Response(serializer.data)
 
 
-class InstanceViewSet(ViewSetManyAllowedMixin, ViewSetOwnerMixin,
-                      viewsets.ModelViewSet):
+class MatchSummaryViewSet(MsgPackMixin, ExportMixin,
+                          viewsets.ReadOnlyModelViewSet):
+  queryset = MatchSummary.objects.all()
+  serializer_class = MatchSummarySerializer
+  permission_classes = (permissions.IsAuthenticated,)
+  filterset_fields = ('task', 'score')
+  pagination_class = IdPagination
+  export_fields = ('from_instance', 'to_instance', 'task', 'score',
+                   'matchers')
+  export_required_params = ('task',)
+
+  @staticmethod
+  def export_row(row):
+    row['matchers'] = mask_match_types(row['matchers'])
+    return row
+
+
+class InstanceViewSet(MsgPackMixin, ViewSetManyAllowedMixin,
+                      ViewSetOwnerMixin, viewsets.ModelViewSet):
   queryset = Instance.objects.all()
   pagination_class = DefaultPagination
   filterset_class = InstanceFilter
@@ -166,6 +355,30 @@ class InstanceViewSet(ViewSetManyAllowedMixin, ViewSetOwnerMixin,
       return InstanceVectorSerializer
     return SlimInstanceSerializer
 
+  def get_queryset(self):
+    # everything serialized for every instance is selected by the main query,
+    # so serializing a page of instances costs a constant number of queries
+    queryset = super(InstanceViewSet, self).get_queryset()
+
+    names = (Annotation.objects.filter(instance=models.OuterRef('pk'),
+                                       type='name')
+                               .values('data')[:1])
+    queryset = queryset.annotate(name_data=models.Subquery(names))
+
+    serializer_class = self.get_serializer_class()
+    if issubclass(serializer_class, CountInstanceSerializer):
+      counts = (Annotation.objects.filter(instance=models.OuterRef('pk'))
+                                  .order_by()
+                                  .values('instance')
+                                  .annotate(count=models.Count('id'))
+                                  .values('count'))
+      queryset = queryset.annotate(
+        annotations_count=Coalesce(models.Subquery(counts), 0))
+    if issubclass(serializer_class, InstanceVectorSerializer):
+      queryset = (queryset.select_related('owner', 'file_version')
+                          .prefetch_related('vectors', 'annotations'))
+    return queryset
+
   def create(self, request, *args, **kwargs):
     # Create as we're supposed to, but avoid triggering a serializer.data
     # access, as those require pulling a lot of data from the db as well as
@@ -176,8 +389,29 @@ class InstanceViewSet(ViewSetManyAllowedMixin, ViewSetOwnerMixin,
     self.perform_create(serializer)
     return response.Response({}, status=status.HTTP_201_CREATED)
 
-
-class VectorViewSet(ViewSetManyAllowedMixin, viewsets.ModelViewSet):
+  @decorators.action(detail=False, methods=['post'])
+  def bulk(self, request):
+    """Create a batch of instances with their vectors and annotations,
+    skipping and reporting the errors of any invalid instance"""
+    del self
+    if not isinstance(request.data, list):
+      return response.Response({'non_field_errors': ["Expected a list of "
+                                                     "items."]},
+                               status=status.HTTP_400_BAD_REQUEST)
+
+    # msgpack clients send documents as nested data, see JSONStringField
+    ids, errors = ingest_instances(request.user, request.data,
+                                   is_msgpack_request(request))
+    if errors and not any(ids):
+      response_status = status.HTTP_400_BAD_REQUEST
+    else:
+      response_status = status.HTTP_201_CREATED
+    return response.Response({'instances': ids, 'errors': errors},
+                             status=response_status)
+
+
+class VectorViewSet(MsgPackMixin, ViewSetManyAllowedMixin,
+                    viewsets.ModelViewSet):
   queryset = Vector.objects.all()
   serializer_class = VectorSerializer
   permission_classes = (permissions.IsAuthenticated,)
@@ -186,10 +420,28 @@ class VectorViewSet(ViewSetManyAllowedMixin, viewsets.ModelViewSet):
   @staticmethod
   def perform_create(serializer):
     file_version = serializer.validated_data['instance'].file_version
-    serializer.save(file_version=file_version)
+    vector = serializer.save(file_version=file_version)
+    Vector.objects.bulk_create(Vector.derive_vectors([vector]))
+
+  @staticmethod
+  def perform_update(serializer):
+    previous_type = serializer.instance.type
+    vector = serializer.save()
+    if vector.type != previous_type:
+      Vector.delete_derived_vectors(vector.instance_id, previous_type)
+    Vector.update_derived_vectors(vector)
+    # features stored on any host out of the previous data are rebuilt
+    for vector_type in {previous_type, vector.type}:
+      FeatureVersion.bump(vector.file_version_id, vector_type)
+
+  @staticmethod
+  def perform_destroy(instance):
+    Vector.delete_derived_vectors(instance.instance_id, instance.type)
+    instance.delete()
+    FeatureVersion.bump(instance.file_version_id, instance.type)
 
 
-class AnnotationViewSet(viewsets.ModelViewSet):
+class AnnotationViewSet(MsgPackMixin, viewsets.ModelViewSet):
   queryset = Annotation.objects.all()
   serializer_class = AnnotationSerializer
   permission_classes = (permissions.IsAuthenticated,)
@@ -202,29 +454,26 @@ class AnnotationViewSet(viewsets.ModelViewSet):
 
     instance_ids = request.query_params.getlist('instance')
 
-    # TODO: perhaps only provide needed IDs here and fetch them using a
-    # second query?
-    def make_cte_subquery(cte):
-      value0 = models.expressions.Value(0, output_field=models.IntegerField())
-      value1 = models.expressions.Value(1, output_field=models.IntegerField())
-      return (Annotation.objects.filter(instance__in=instance_ids)
-              # .values("uuid", "instance", "type", "data",
-              .values("id", "uuid", depth=value0)
-              .union(cte.join(Annotation, dependents=cte.col.uuid)
-                        .values("id", "uuid", depth=cte.col.depth + value1),
-                     all=True))
-
-    cte = django_cte.With.recursive(make_cte_subquery)
-
-    annotations = (cte.join(Annotation, id=cte.col.id)
-                      .with_cte(cte)
-                      .annotate(depth=cte.col.depth)
-                      .order_by("-depth"))
+    # annotations of the requested instances and every annotation they
+    # depend on, ordered so dependencies come before their dependents
+    closures = DependencyClosure.objects.filter(
+      ancestor__instance__in=instance_ids)
+    depths = (closures.filter(descendant=models.OuterRef('pk'))
+                      .order_by()
+                      .values('descendant')
+                      .annotate(depth=models.Max('depth'))
+                      .values('depth'))
+    annotations_filter = (models.Q(instance__in=instance_ids) |
+                          models.Q(id__in=closures.values('descendant')))
+    annotations = (Annotation.objects.filter(annotations_filter)
+                                    .annotate(depth=Coalesce(
+                                      models.Subquery(depths), 0))
+                                    .order_by('-depth', 'id'))
 
     return annotations
 
 
-class DependencyViewSet(viewsets.ModelViewSet):
+class DependencyViewSet(MsgPackMixin, viewsets.ModelViewSet):
   queryset = Dependency.objects.all()
   serializer_class = DependencySerializer
   permission_classes = (permissions.IsAuthenticated,)
@@ -11,6 +11,7 @@ https://docs.djangoproject.com/en/1.9/ref/settings/
 """
 
 import os
+import tempfile
 import logging.config
 
 # Build paths inside the project like this: os.path.join(BASE_DIR, ...)
@@ -209,6 +210,21 @@ USE_TZ = True
 STATIC_URL = '/static/'
 
 
+# Matchers configuration
+# Upper bound (in bytes) of memory a dictionary matcher may use for a single
+# tile of its score matrix. Source vectors are matched in blocks of rows small
+# enough to keep every tile below this bound.
+MATCHER_MEMORY_BUDGET = int(os.environ.get('MATCHER_MEMORY_BUDGET',
+                                           256 * 1024 * 1024))
+
+# Directory holding memory mapped feature matrices of complete file versions,
+# built once by a worker and shared by all workers on the same host. Matrices
+# are rebuilt when missing, so they are kept out of the source tree by default
+FEATURE_STORE_ROOT = os.environ.get('FEATURE_STORE_ROOT',
+                                    os.path.join(tempfile.gettempdir(),
+                                                 'rematch_feature_store'))
+
+
 # Celery configuration
 # use django's database to keep celery state
 result_backend = 'database'
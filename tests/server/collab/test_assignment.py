@@ -0,0 +1,55 @@
+import numpy as np
+from scipy.optimize import linear_sum_assignment
+
+import pytest
+
+from collab.assignment import (greedy_assignment, optimal_assignment,
+                               is_optimal_assignment_supported)
+
+
+requires_optimal = pytest.mark.skipif(not is_optimal_assignment_supported(),
+                                      reason="requires scipy 1.6")
+
+
+def test_greedy_assignment():
+  sources = np.array([1, 1, 2, 2, 3])
+  targets = np.array([10, 11, 10, 11, 10])
+  scores = np.array([100., 90., 95., 60., 80.])
+
+  assigned = greedy_assignment(sources, targets, scores)
+  assert assigned.tolist() == [True, False, False, True, False]
+
+  assigned = greedy_assignment(sources, targets, scores, limit=2)
+  assert assigned.tolist() == [True, True, True, True, False]
+
+
+@requires_optimal
+def test_optimal_assignment():
+  sources = np.array([1, 1, 2])
+  targets = np.array([10, 11, 10])
+  scores = np.array([100., 90., 95.])
+
+  # greedy picks the single best pair, leaving the second source unassigned
+  assert greedy_assignment(sources, targets,
+                           scores).tolist() == [True, False, False]
+  assert optimal_assignment(sources, targets,
+                            scores).tolist() == [False, True, True]
+
+
+@requires_optimal
+@pytest.mark.parametrize('seed', range(10))
+def test_optimal_assignment_parity(seed):
+  rand = np.random.RandomState(seed)
+  source_count, target_count = rand.randint(1, 20, size=2)
+  pairs = rand.rand(source_count, target_count) < 0.3
+  pairs[0, 0] = True
+  dense_scores = np.where(pairs, rand.randint(50, 101, pairs.shape), 0)
+
+  sources, targets = np.nonzero(pairs)
+  scores = dense_scores[sources, targets].astype(np.float64)
+  assigned = optimal_assignment(sources, targets + 1000, scores)
+
+  assert len(set(sources[assigned])) == assigned.sum()
+  assert len(set(targets[assigned])) == assigned.sum()
+  rows, columns = linear_sum_assignment(-dense_scores)
+  assert scores[assigned].sum() == dense_scores[rows, columns].sum()
@@ -0,0 +1,39 @@
+import pytest
+
+from utils import create_model
+
+from collab.models import Annotation
+from collab.bulk import copy_rows, RowsFile
+
+
+@pytest.mark.parametrize('data', ['plain', 'tab\tseparated', 'new\nline',
+                                  'back\\slash\\N', u'unicode א', ''])
+def test_copy_rows(admin_user, data):
+  instance = create_model('instances', admin_user)
+  instance.save()
+
+  rows = [(instance.id, 'name', data, None)] * 3
+  count = copy_rows(Annotation, ('instance', 'type', 'data', 'uuid'), rows,
+                    batch_size=2)
+  assert count == 3
+
+  annotations = Annotation.objects.filter(instance=instance)
+  assert annotations.count() == 3
+  for annotation in annotations:
+    assert annotation.data == data
+    assert annotation.uuid is None
+
+
+def test_rows_file_read_sizes():
+  rows = [(i, 'x' * i) for i in range(100)]
+  rows_file = RowsFile(rows)
+
+  chunks = []
+  chunk = rows_file.read(7)
+  while chunk:
+    assert len(chunk) <= 7
+    chunks.append(chunk)
+    chunk = rows_file.read(7)
+
+  expected = u''.join(u'{}\t{}\n'.format(*row) for row in rows)
+  assert u''.join(chunks) == expected
@@ -0,0 +1,134 @@
+import os
+import json
+
+import numpy as np
+import pytest
+
+from utils import create_model
+
+from collab import feature_store, matchers
+from collab.models import Vector, FeatureVersion
+
+
+def create_hist_vector(admin_user, file_version, hist):
+  vector = create_model('vectors', admin_user, type='mnemonic_hist',
+                        data=json.dumps(hist), file_version=file_version)
+  vector.save()
+  return vector
+
+
+def test_feature_store(admin_user):
+  file_version = create_model('file_versions', admin_user)
+  file_version.save()
+  vectors = [create_hist_vector(admin_user, file_version, hist)
+             for hist in ({'mov': 3, 'push': 1}, {'call': 2}, {'mov': 1})]
+  instance_ids = np.array(sorted(v.instance_id for v in vectors))
+
+  assert feature_store.FeatureMatrix.load(
+    feature_store.get_path(file_version.id, 'mnemonic_hist')) is None
+  built = feature_store.build(file_version.id, 'mnemonic_hist')
+
+  features = feature_store.get(file_version.id, 'mnemonic_hist')
+  # matrix arrays are read only views of the mapped files
+  assert isinstance(features.instance_ids, np.memmap)
+  for array in (features.matrix.data, features.matrix.indices,
+                features.matrix.indptr):
+    assert not array.flags.writeable
+  assert (features.matrix != built.matrix).nnz == 0
+  assert features.select(instance_ids) is features.matrix
+
+  rows = features.select(instance_ids[1:])
+  assert rows.shape == (2, built.matrix.shape[1])
+  assert (rows != built.matrix[1:]).nnz == 0
+
+  # vectors uploaded after the store was built
+  assert features.select(np.array([instance_ids[0], 0])) is None
+  vector = create_hist_vector(admin_user, file_version, {'ret': 1})
+  instance_ids = np.append(instance_ids, vector.instance_id)
+  matrix = feature_store.select(file_version.id, 'mnemonic_hist',
+                                instance_ids)
+  assert matrix.shape[0] == 4
+  assert matrix[3].nnz == 1
+
+
+def test_feature_store_matches(admin_user, settings):
+  source = create_model('file_versions', admin_user)
+  source.save()
+  target = create_model('file_versions', admin_user)
+  target.save()
+  for file_version in (source, target, source, target, target):
+    create_hist_vector(admin_user, file_version,
+                       {'mov': np.random.randint(1, 5),
+                        'push': np.random.randint(1, 5),
+                        'call': np.random.randint(1, 5)})
+
+  source_vectors = Vector.objects.filter(file_version=source)
+  target_vectors = Vector.objects.filter(file_version=target)
+  matcher = matchers.MnemonicEuclideanMatcher
+  database_matches = sorted(matcher.match(source_vectors, target_vectors))
+
+  source.complete = True
+  source.save()
+  target.complete = True
+  target.save()
+  store_matches = sorted(matcher.match(source_vectors, target_vectors))
+  assert os.path.isdir(feature_store.get_path(target.id, 'mnemonic_hist'))
+
+  assert len(store_matches) == len(database_matches)
+  for store_match, database_match in zip(store_matches, database_matches):
+    assert store_match[:2] == database_match[:2]
+    assert store_match[2] == pytest.approx(database_match[2])
+
+
+def test_feature_store_versions(admin_user, monkeypatch):
+  file_version = create_model('file_versions', admin_user)
+  file_version.save()
+  create_hist_vector(admin_user, file_version, {'mov': 1})
+  path = feature_store.get_path(file_version.id, 'mnemonic_hist')
+
+  feature_store.build(file_version.id, 'mnemonic_hist')
+  features = feature_store.get(file_version.id, 'mnemonic_hist')
+  first_version = os.path.realpath(path)
+  assert os.path.islink(path)
+
+  # the replaced version is kept for loads still reading it
+  feature_store.build(file_version.id, 'mnemonic_hist')
+  assert os.path.realpath(path) != first_version
+  assert os.path.isdir(first_version)
+  assert features.matrix.nnz == 1
+
+  monkeypatch.setattr(feature_store, 'STALE_VERSION_SECONDS', -1)
+  feature_store.build(file_version.id, 'mnemonic_hist')
+  assert not os.path.exists(first_version)
+  assert len(os.listdir(os.path.dirname(path))) == 2
+
+  # stored features are rebuilt once their vectors change
+  FeatureVersion.bump(file_version.id, 'mnemonic_hist')
+  assert feature_store.FeatureMatrix.load(path).version == 0
+  features = feature_store.get(file_version.id, 'mnemonic_hist')
+  assert features.version == 1
+  assert feature_store.FeatureMatrix.load(path).version == 1
+
+
+def test_feature_store_vector_update(admin_api_client, admin_user):
+  file_version = create_model('file_versions', admin_user, complete=True)
+  file_version.save()
+  vector = create_hist_vector(admin_user, file_version, {'mov': 1})
+  instance_ids = np.array([vector.instance_id])
+  matrix = feature_store.select(file_version.id, 'mnemonic_hist',
+                                instance_ids)
+  assert matrix.data.tolist() == [1]
+
+  path = feature_store.get_path(file_version.id, 'mnemonic_hist')
+  stored_path = os.path.realpath(path)
+
+  # stored features are left in place for workers on every host to notice
+  # they are stale
+  response = admin_api_client.patch('/collab/vectors/{}/'.format(vector.id),
+                                    data={'data': json.dumps({'mov': 3})},
+                                    format='json')
+  assert response.status_code == 200
+  assert os.path.realpath(path) == stored_path
+  matrix = feature_store.select(file_version.id, 'mnemonic_hist',
+                                instance_ids)
+  assert matrix.data.tolist() == [3]
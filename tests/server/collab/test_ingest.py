@@ -0,0 +1,163 @@
+import json
+import uuid
+
+import msgpack
+from rest_framework import status
+
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+
+from utils import create_model
+
+from collab.models import Instance, Vector, Annotation
+
+
+def instance_data(file_version, offset, **kwargs):
+  data = {'file_version': file_version.id, 'type': 'function',
+          'offset': offset, 'size': 10, 'count': 1,
+          'vectors': [{'type': 'assembly_hash', 'type_version': 0,
+                       'data': json.dumps(offset)},
+                      {'type': 'mnemonic_hist', 'type_version': 0,
+                       'data': json.dumps({'mov': offset + 1})}],
+          'annotations': [{'type': 'name',
+                           'data': json.dumps({'name':
+                                               'f{}'.format(offset)})}]}
+  data.update(kwargs)
+  return data
+
+
+def test_bulk_instances(admin_api_client, admin_user):
+  file_version = create_model('file_versions', admin_user)
+  file_version.save()
+  create_model('instances', admin_user, file_version=file_version,
+               offset=5).save()
+
+  dependency_uuid = str(uuid.uuid4())
+  items = [instance_data(file_version, 0),
+           instance_data(file_version, 1, type='method'),
+           instance_data(file_version, 2,
+                         annotations=[{'type': 'structure', 'data': '{}',
+                                       'uuid': dependency_uuid}]),
+           instance_data(file_version, 3, vectors=[{'type': 'assembly_hash'}]),
+           instance_data(file_version, 5),
+           instance_data(file_version, 0),
+           instance_data(file_version, 6,
+                         annotations=[{'type': 'structure', 'data': '{}',
+                                       'uuid': dependency_uuid}]),
+           instance_data(file_version, 7,
+                         vectors=[{'type': 'mnemonic_hist', 'type_version': 0,
+                                   'data': json.dumps({'mov': 'x'})},
+                                  {'type': 'basicblock_adjacency',
+                                   'type_version': 0, 'data': '{"0": [1]}'},
+                                  {'type': 'assembly_hash', 'type_version': 0,
+                                   'data': 'not json'},
+                                  {'type': 'name_hash', 'type_version': 0,
+                                   'data': {'nested': 'data'}}]),
+           'instance']
+  response = admin_api_client.post('/collab/instances/bulk/', data=items,
+                                   format='json',
+                                   HTTP_ACCEPT='application/json')
+  assert response.status_code == status.HTTP_201_CREATED
+
+  ids = response.json()['instances']
+  errors = response.json()['errors']
+  assert [i is not None for i in ids] == [True, False, True, False, False,
+                                          False, False, False, False]
+  assert sorted(errors.keys()) == ['1', '3', '4', '5', '6', '7', '8']
+  assert list(errors['1'].keys()) == ['type']
+  assert errors['3'] == {'vectors': {'0': {'type_version':
+                                           ["This field is required."],
+                                           'data':
+                                           ["This field is required."]}}}
+  assert list(errors['4'].keys()) == ['offset']
+  assert list(errors['5'].keys()) == ['offset']
+  assert list(errors['6']['annotations']['0'].keys()) == ['uuid']
+  assert sorted(errors['7']['vectors'].keys()) == ['0', '1', '2', '3']
+  assert all(list(e.keys()) == ['data']
+             for e in errors['7']['vectors'].values())
+  # JSON clients send documents as JSON strings
+  assert errors['7']['vectors']['3'] == {'data': ["Not a valid string."]}
+
+  instance = Instance.objects.get(id=ids[0])
+  assert instance.owner == admin_user
+  assert instance.file_version == file_version
+  vectors = {v.type: v for v in Vector.objects.filter(instance=instance)}
+  assert vectors['assembly_hash'].hash is not None
+  assert vectors['assembly_hash'].file_version == file_version
+  assert json.loads(vectors['mnemonic_hist'].data) == {'mov': 1}
+  assert vectors['mnemonic_hist'].hist_values == [1.0]
+  annotation = Annotation.objects.get(instance=instance)
+  assert json.loads(annotation.data) == {'name': 'f0'}
+  assert annotation.uuid is None
+  assert (Annotation.objects.get(instance=ids[2]).uuid ==
+          uuid.UUID(dependency_uuid))
+
+  response = admin_api_client.post('/collab/instances/bulk/', data=items[1:2],
+                                   format='json',
+                                   HTTP_ACCEPT='application/json')
+  assert response.status_code == status.HTTP_400_BAD_REQUEST
+  response = admin_api_client.post('/collab/instances/bulk/', data=items[0],
+                                   format='json',
+                                   HTTP_ACCEPT='application/json')
+  assert response.status_code == status.HTTP_400_BAD_REQUEST
+
+
+def test_bulk_instances_msgpack(admin_api_client, admin_user):
+  file_version = create_model('file_versions', admin_user)
+  file_version.save()
+
+  # documents are sent as nested data, hash vectors' data is a plain string
+  items = [{'file_version': file_version.id, 'type': 'function',
+            'offset': offset, 'size': 10, 'count': 1,
+            'vectors': [{'type': 'assembly_hash', 'type_version': 0,
+                         'data': 'd41d8cd98f00b204e9800998ecf8427e'},
+                        {'type': 'mnemonic_hist', 'type_version': 0,
+                         'data': {'mov': offset + 1}}],
+            'annotations': [{'type': 'name', 'data': {'name': 'f'}}]}
+           for offset in range(2)]
+  items.append(dict(items[0], offset=2,
+                    vectors=[{'type': 'name_hash', 'type_version': 0,
+                              'data': b'\x00'}]))
+  response = admin_api_client.post('/collab/instances/bulk/',
+                                   data=msgpack.packb(items,
+                                                      use_bin_type=True),
+                                   content_type='application/msgpack',
+                                   HTTP_ACCEPT='application/json')
+  assert response.status_code == status.HTTP_201_CREATED
+
+  ids = response.json()['instances']
+  assert [i is not None for i in ids] == [True, True, False]
+  assert response.json()['errors'] == {'2': {'vectors': {'0': {
+    'data': ["Not a valid JSON document."]}}}}
+  vectors = {v.type: v for v in Vector.objects.filter(instance=ids[0])}
+  assert (json.loads(vectors['assembly_hash'].data) ==
+          'd41d8cd98f00b204e9800998ecf8427e')
+  assert vectors['assembly_hash'].hash is not None
+  assert json.loads(vectors['mnemonic_hist'].data) == {'mov': 1}
+  assert (json.loads(Annotation.objects.get(instance=ids[0]).data) ==
+          {'name': 'f'})
+
+
+def test_bulk_instances_query_count(admin_api_client, admin_user):
+  file_version = create_model('file_versions', admin_user)
+  file_version.save()
+
+  def upload(offsets):
+    items = [instance_data(file_version, offset,
+                           vectors=[{'type': 'assembly_hash',
+                                     'type_version': 0, 'data': '1'}])
+             for offset in offsets]
+    with CaptureQueriesContext(connection) as queries:
+      response = admin_api_client.post('/collab/instances/bulk/', data=items,
+                                       format='json',
+                                       HTTP_ACCEPT='application/json')
+    assert response.status_code == status.HTTP_201_CREATED
+    return len(queries)
+
+  query_count = upload(range(2))
+  # uploading more instances does not query any more
+  assert upload(range(2, 100)) == query_count
+  assert Instance.objects.filter(file_version=file_version).count() == 100
+  assert Vector.objects.filter(file_version=file_version).count() == 100
+  assert (Annotation.objects.filter(instance__file_version=file_version)
+                            .count() == 100)
@@ -1,9 +1,21 @@
+from decimal import Decimal
+import random
+import struct
+import json
+
+import numpy as np
+import networkx as nx
+from sklearn.feature_extraction import DictVectorizer
+from sklearn.metrics.pairwise import euclidean_distances
+from tarjan import tarjan_recursive
+
 import pytest
 from rest_framework import status
 
-from utils import assert_response
+from utils import assert_response, create_model
 
 from collab import matchers
+from collab.models import Vector, FeatureKey
 
 
 def test_matchers(admin_client):
@@ -21,3 +33,270 @@ def test_matchers_abstract(admin_client):
   assert ex.value.args[0] == "Abstract matcher in list"
 
   matchers.matchers_list.remove(matchers.Matcher)
+
+
+def create_hist_vectors(admin_user, file_version, count):
+  for _ in range(count):
+    hist = {str(random.randint(0, 8)): random.randint(1, 5)
+            for _ in range(random.randint(1, 6))}
+    create_model('vectors', admin_user, type='mnemonic_hist',
+                 data=json.dumps(hist), file_version=file_version).save()
+
+
+def test_dictionary_matcher_blocks(admin_user, settings):
+  source = create_model('file_versions', admin_user)
+  source.save()
+  target = create_model('file_versions', admin_user)
+  target.save()
+  create_hist_vectors(admin_user, source, 7)
+  create_hist_vectors(admin_user, target, 5)
+
+  source_vectors = Vector.objects.filter(file_version=source)
+  target_vectors = Vector.objects.filter(file_version=target)
+  matcher = matchers.MnemonicEuclideanMatcher
+
+  full_matches = list(matcher.match(source_vectors, target_vectors))
+  assert len(full_matches) <= 7 * 5
+
+  # A budget too small for a single row forces a tile per source vector
+  settings.MATCHER_MEMORY_BUDGET = 1
+  assert matcher.get_block_rows(5) == 1
+  blocked_matches = list(matcher.match(source_vectors, target_vectors))
+  assert blocked_matches == full_matches
+
+  for _, _, score in full_matches:
+    assert matcher.MIN_SCORE <= score <= 100
+
+
+def test_dictionary_matcher_top_k(admin_user):
+  source = create_model('file_versions', admin_user)
+  source.save()
+  target = create_model('file_versions', admin_user)
+  target.save()
+  create_hist_vectors(admin_user, source, 4)
+  create_hist_vectors(admin_user, target, 6)
+
+  source_vectors = Vector.objects.filter(file_version=source)
+  target_vectors = Vector.objects.filter(file_version=target)
+  matcher = matchers.MnemonicEuclideanMatcher
+
+  all_matches = list(matcher.match(source_vectors, target_vectors))
+  top_matches = list(matcher.match(source_vectors, target_vectors, top_k=2))
+  assert len(top_matches) <= 4 * 2
+
+  for source_id in {m[0] for m in all_matches}:
+    scores = sorted((m[2] for m in all_matches if m[0] == source_id),
+                    reverse=True)
+    top_scores = sorted((m[2] for m in top_matches if m[0] == source_id),
+                        reverse=True)
+    assert top_scores == scores[:2]
+
+
+def test_dictionary_matcher_select_pairs():
+  scores = np.array([[100., np.nan, 49.], [50., np.inf, 75.]])
+  select_pairs = matchers.MnemonicEuclideanMatcher.select_pairs
+
+  rows, columns = select_pairs(scores.copy(), None)
+  assert list(zip(rows, columns)) == [(0, 0), (1, 0), (1, 2)]
+
+  rows, columns = select_pairs(scores.copy(), 1)
+  assert list(zip(rows, columns)) == [(0, 0), (1, 2)]
+
+
+@pytest.mark.django_db
+def test_feature_key_columns():
+  columns = FeatureKey.get_columns('mnemonic_hist', 0, ['mov', 'push'])
+  assert FeatureKey.get_columns('mnemonic_hist', 0, ['push']) == {
+    'push': columns['push']}
+
+  # vocabulary only grows, keeping existing columns
+  more_columns = FeatureKey.get_columns('mnemonic_hist', 0, ['mov', 'call'])
+  assert more_columns['mov'] == columns['mov']
+  assert more_columns['call'] not in columns.values()
+
+  # keys are versioned by vector type and type version
+  other_columns = FeatureKey.get_columns('mnemonic_hist', 1, ['mov'])
+  assert other_columns['mov'] != columns['mov']
+  assert FeatureKey.get_columns('mnemonic_hist', 0, []) == {}
+
+
+def test_dictionary_matcher_typed_data(admin_user):
+  source = create_model('file_versions', admin_user)
+  source.save()
+  target = create_model('file_versions', admin_user)
+  target.save()
+  create_hist_vectors(admin_user, source, 5)
+  create_hist_vectors(admin_user, target, 5)
+
+  source_vectors = Vector.objects.filter(file_version=source).order_by('id')
+  target_vectors = Vector.objects.filter(file_version=target).order_by('id')
+  source_hists = [json.loads(v.data) for v in source_vectors]
+  target_hists = [json.loads(v.data) for v in target_vectors]
+  columns = dict(FeatureKey.objects.filter(vector_type='mnemonic_hist')
+                                   .values_list('id', 'key'))
+  for vector, hist in zip(source_vectors, source_hists):
+    assert vector.hist_columns == sorted(vector.hist_columns)
+    assert {columns[column]: value for column, value
+            in zip(vector.hist_columns, vector.hist_values)} == hist
+
+  # matchers only read typed data
+  Vector.objects.update(data='')
+  matcher = matchers.MnemonicEuclideanMatcher
+  matches = {(s, t): score
+             for s, t, score in matcher.match(source_vectors, target_vectors)}
+
+  dictvect = DictVectorizer().fit(source_hists + target_hists)
+  source_matrix = dictvect.transform(source_hists).toarray()
+  target_matrix = dictvect.transform(target_hists).toarray()
+  distances = euclidean_distances(source_matrix, target_matrix)
+  norms = np.sqrt((source_matrix ** 2).sum(axis=1)[:, None] +
+                  (target_matrix ** 2).sum(axis=1)[None, :])
+  scores = 100 - 100 * distances / norms
+  for i, source_vector in enumerate(source_vectors):
+    for j, target_vector in enumerate(target_vectors):
+      key = (source_vector.instance_id, target_vector.instance_id)
+      if scores[i, j] >= matcher.MIN_SCORE:
+        assert matches[key] == pytest.approx(scores[i, j])
+      else:
+        assert key not in matches
+
+
+@pytest.mark.parametrize('data, packed', [
+    ('17391172068829961267', struct.pack('>Q', 17391172068829961267)),
+    ('"d41d8cd98f00b204e9800998ecf8427e"',
+     b'\xd4\x1d\x8c\xd9\x8f\x00\xb2\x04\xe9\x80\t\x98\xec\xf8B~'),
+    ('0.123456789', struct.pack('>d', 0.123456789)),
+    ('"not hex"', b'"not hex"'),
+    ('data', b'data')])
+def test_hash_matcher_pack_hash(data, packed):
+  assert matchers.HashMatcher.pack_hash(data) == packed
+
+
+def test_mdindex_derived_vector(admin_api_client, admin_user):
+  file_version = create_model('file_versions', admin_user)
+  file_version.save()
+
+  adjacency = json.dumps({0: [1, 2], 1: [2], 2: []})
+  instance = {'file_version': file_version.id, 'type': 'function',
+              'offset': 0, 'size': 16, 'count': 6,
+              'vectors': [{'type': 'basicblock_adjacency', 'type_version': 0,
+                           'data': adjacency}],
+              'annotations': []}
+  response = admin_api_client.post('/collab/instances/', data=instance,
+                                   format='json')
+  assert_response(response, status.HTTP_201_CREATED)
+
+  matcher = matchers.BasicBlockMDIndexMatcher
+  vector = Vector.objects.get(file_version=file_version,
+                              type=matcher.vector_type)
+  assert vector.data == matcher.derive_data(adjacency)
+  assert vector.type_version == 0
+
+  # derived vectors follow updates and deletion of their source vector
+  source = Vector.objects.get(file_version=file_version,
+                              type=matcher.derived_from)
+  updated_adjacency = json.dumps({0: [1], 1: [2, 3], 2: [3], 3: []})
+  response = admin_api_client.patch('/collab/vectors/{}/'.format(source.id),
+                                    data={'data': updated_adjacency},
+                                    format='json')
+  assert_response(response, status.HTTP_200_OK)
+  vector.refresh_from_db()
+  assert vector.data == matcher.derive_data(updated_adjacency)
+  assert bytes(vector.hash) == matcher.pack_hash(vector.data)
+
+  response = admin_api_client.delete('/collab/vectors/{}/'.format(source.id))
+  assert response.status_code == status.HTTP_204_NO_CONTENT
+  assert not Vector.objects.filter(file_version=file_version).exists()
+
+
+@pytest.mark.parametrize('vector_type, data', [
+    ('mnemonic_hist', '{"mov": "x"}'),
+    ('mnemonic_hist', '{"mov": null}'),
+    ('mnemonic_hist', '[1, 2]'),
+    ('mnemonic_hist', 'not json'),
+    ('basicblock_adjacency', '{"0": [1]}'),
+    ('basicblock_adjacency', '{"a": []}'),
+    ('basicblock_adjacency', '{"0": 1}')])
+def test_vector_data_validation(admin_api_client, admin_user, vector_type,
+                                data):
+  instance = create_model('instances', admin_user)
+  instance.save()
+  response = admin_api_client.post('/collab/vectors/',
+                                   data={'instance': instance.id,
+                                         'file_version':
+                                         instance.file_version_id,
+                                         'type': vector_type,
+                                         'type_version': 0, 'data': data},
+                                   format='json')
+  assert_response(response, status.HTTP_400_BAD_REQUEST)
+  assert 'data' in response.data
+
+  instance_data = {'file_version': instance.file_version_id,
+                   'type': 'function', 'offset': 1, 'size': 1, 'count': 1,
+                   'vectors': [{'type': vector_type, 'type_version': 0,
+                                'data': data}]}
+  response = admin_api_client.post('/collab/instances/', data=instance_data,
+                                   format='json')
+  assert_response(response, status.HTTP_400_BAD_REQUEST)
+
+  # malformed vectors stored directly are kept as they are, and never matched
+  vector = create_model('vectors', admin_user, instance=instance,
+                        file_version=instance.file_version, type=vector_type,
+                        data=data)
+  vector.save()
+  assert vector.hash is None and vector.hist_columns is None
+  assert not Vector.derive_vectors([vector])
+
+
+def reference_mdindex(adjacency):
+  """The original networkx and Decimal based MDIndex implementation, kept to
+  validate the array based one"""
+  qs = np.sqrt(np.array([Decimal(1), Decimal(2), Decimal(3), Decimal(5),
+                         Decimal(7)]))
+  adjacency = {int(k): v for k, v in json.loads(adjacency).items()}
+  graph = nx.convert.from_dict_of_lists(adjacency, create_using=nx.DiGraph)
+  t_order = sum(tarjan_recursive(adjacency), [])
+
+  embs = np.array([(t_order.index(s),
+                    graph.in_degree[s], graph.out_degree[s],
+                    graph.in_degree[d], graph.out_degree[d])
+                    for s, d in graph.edges])
+
+  return (1 / np.sqrt(np.dot(embs, qs))).sum()
+
+
+def random_adjacency(rand, node_count):
+  adjacency = {}
+  for node in range(node_count):
+    successor_count = rand.choice((0, 1, 1, 2, 2, 3))
+    adjacency[node] = [rand.randrange(node_count)
+                       for _ in range(successor_count)]
+  # make sure there's at least one edge
+  adjacency[0].append(node_count - 1)
+  return json.dumps(adjacency)
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_mdindex_parity(seed):
+  rand = random.Random(seed)
+  adjacencies = [random_adjacency(rand, rand.randint(2, 60))
+                 for _ in range(50)]
+  adjacencies.append(json.dumps({0: [1, 1], 1: [0]}))
+  adjacencies.append(json.dumps({0: [0, 1], 1: []}))
+
+  matcher = matchers.BasicBlockMDIndexMatcher
+  batch = matcher.calc_mdindex_batch(adjacencies)
+  assert len(batch) == len(adjacencies)
+
+  for adjacency, mdindex in zip(adjacencies, batch):
+    expected = float(reference_mdindex(adjacency))
+    assert np.isclose(mdindex, expected, rtol=1e-12, atol=0)
+    assert matcher.calc_mdindex(adjacency) == mdindex
+    assert (matcher.derive_data(adjacency) ==
+            json.dumps(round(expected, matcher.DIGITS)))
+
+
+def test_mdindex_no_edges():
+  matcher = matchers.BasicBlockMDIndexMatcher
+  assert matcher.calc_mdindex_batch([]).shape == (0,)
+  assert matcher.calc_mdindex(json.dumps({0: [], 1: []})) == 0
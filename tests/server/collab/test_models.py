@@ -1,9 +1,17 @@
+import json
+
+import msgpack
 import pytest
 from rest_framework import status
 
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+
 from utils import (create_model, setup_model, assert_response,
                    collab_models_keys)
 
+from collab.models import Instance, Annotation
+
 
 @pytest.mark.django_db
 @pytest.mark.parametrize('model_name', collab_models_keys)
@@ -92,6 +100,69 @@ def test_full_hierarchy(admin_api_client, admin_user):
   assert_response(response, status.HTTP_200_OK, expected_response)
 
 
+def test_full_hierarchy_closure(admin_api_client, admin_user):
+  def full_hierarchy(annotation):
+    response = admin_api_client.get('/collab/annotations/full_hierarchy/',
+                                    data={'instance': annotation.instance_id},
+                                    HTTP_ACCEPT='application/json')
+    assert_response(response, status.HTTP_200_OK)
+    return [a['id'] for a in response.data]
+
+  annotations = []
+  for _ in range(4):
+    annotation = create_model('annotations', admin_user)
+    annotation.save()
+    annotations.append(annotation)
+  prototype, structure, member, unrelated = annotations
+
+  # dependencies are uploaded in no particular order, and a dependency chain
+  # is longer than the shortcut past it
+  create_model('dependencies', admin_user, dependent=structure,
+               dependency=member).save()
+  create_model('dependencies', admin_user, dependent=prototype,
+               dependency=member).save()
+  shortcut = create_model('dependencies', admin_user, dependent=prototype,
+                          dependency=structure)
+  shortcut.save()
+  create_model('dependencies', admin_user, dependent=unrelated,
+               dependency=prototype).save()
+
+  assert full_hierarchy(prototype) == [member.id, structure.id, prototype.id]
+  assert full_hierarchy(unrelated) == [member.id, structure.id, prototype.id,
+                                       unrelated.id]
+  assert full_hierarchy(member) == [member.id]
+
+  shortcut.delete()
+  assert full_hierarchy(prototype) == [member.id, prototype.id]
+  assert full_hierarchy(unrelated) == [member.id, prototype.id, unrelated.id]
+  assert full_hierarchy(structure) == [member.id, structure.id]
+
+
+def test_full_hierarchy_closure_cascade(admin_api_client, admin_user):
+  def full_hierarchy(annotation):
+    response = admin_api_client.get('/collab/annotations/full_hierarchy/',
+                                    data={'instance': annotation.instance_id},
+                                    HTTP_ACCEPT='application/json')
+    assert_response(response, status.HTTP_200_OK)
+    return [a['id'] for a in response.data]
+
+  chain = []
+  for _ in range(4):
+    annotation = create_model('annotations', admin_user)
+    annotation.save()
+    chain.append(annotation)
+  for dependent, dependency in zip(chain, chain[1:]):
+    create_model('dependencies', admin_user, dependent=dependent,
+                 dependency=dependency).save()
+  assert full_hierarchy(chain[0]) == [a.id for a in reversed(chain)]
+
+  # dependencies of middle annotations are removed by cascades
+  Instance.objects.filter(id=chain[2].instance_id).delete()
+  assert full_hierarchy(chain[0]) == [chain[1].id, chain[0].id]
+  Annotation.objects.filter(id=chain[1].id).delete()
+  assert full_hierarchy(chain[0]) == [chain[0].id]
+
+
 @pytest.mark.django_db
 def test_file_fileversion(admin_client, admin_user):
   fv_obj = create_model('file_versions', admin_user)
@@ -107,3 +178,102 @@ def test_file_fileversion(admin_client, admin_user):
   fv_obj.save()
   response = admin_client.get(url, content_type="application/json")
   assert_response(response, status.HTTP_200_OK, fv_obj)
+
+
+def test_msgpack(admin_api_client, admin_user):
+  file_version = create_model('file_versions', admin_user)
+  file_version.save()
+
+  hist = {'mov': 2, 'push': 1}
+  name = {'name': 'sub_main'}
+  instance_data = {'file_version': file_version.id, 'type': 'function',
+                   'offset': 0, 'size': 1, 'count': 1,
+                   'vectors': [{'type': 'mnemonic_hist', 'type_version': 0,
+                                'data': hist}],
+                   'annotations': [{'type': 'name', 'data': name}]}
+  response = admin_api_client.post('/collab/instances/',
+                                   data=msgpack.packb(instance_data,
+                                                      use_bin_type=True),
+                                   content_type='application/msgpack',
+                                   HTTP_ACCEPT='application/msgpack')
+  assert_response(response, status.HTTP_201_CREATED)
+
+  # binary clients exchange json documents as nested data
+  for url, params, data in (('/collab/vectors/', {'type': 'mnemonic_hist'},
+                             hist),
+                            ('/collab/annotations/', {'type': 'name'},
+                             name)):
+    response = admin_api_client.get(url, params,
+                                    HTTP_ACCEPT='application/msgpack')
+    assert response.status_code == status.HTTP_200_OK
+    assert response['Content-Type'] == 'application/msgpack'
+    results = msgpack.unpackb(response.content, raw=False)
+    assert [result['data'] for result in results] == [data]
+
+    # while json clients keep exchanging them as strings
+    response = admin_api_client.get(url, params,
+                                    HTTP_ACCEPT='application/json')
+    assert [json.loads(result['data']) for result in response.json()] == [data]
+
+  # binary values have no json representation
+  vector_data = {'instance': response.json()[0]['instance'],
+                 'file_version': file_version.id, 'type': 'name_hash',
+                 'type_version': 0, 'data': b'\x00'}
+  response = admin_api_client.post('/collab/vectors/',
+                                   data=msgpack.packb(vector_data,
+                                                      use_bin_type=True),
+                                   content_type='application/msgpack',
+                                   HTTP_ACCEPT='application/json')
+  assert_response(response, status.HTTP_400_BAD_REQUEST)
+  assert list(response.json().keys()) == ['data']
+
+  # msgpack is only negotiated by collab endpoints
+  response = admin_api_client.get('/accounts/profile/',
+                                  HTTP_ACCEPT='application/msgpack')
+  assert response.status_code == status.HTTP_406_NOT_ACCEPTABLE
+
+
+@pytest.mark.parametrize('params', [{}, {'annotation_count': True},
+                                    {'full': True}])
+def test_instances_query_count(admin_api_client, admin_user, params):
+  file_version = create_model('file_versions', admin_user)
+  file_version.save()
+
+  def list_instances():
+    with CaptureQueriesContext(connection) as queries:
+      response = admin_api_client.get('/collab/instances/',
+                                      dict(params,
+                                           file_version=file_version.id),
+                                      HTTP_ACCEPT='application/json')
+    assert response.status_code == status.HTTP_200_OK
+    return response.json()['results'], len(queries)
+
+  def add_instances(offsets):
+    for offset in offsets:
+      instance = create_model('instances', admin_user,
+                              file_version=file_version, offset=offset)
+      instance.save()
+      create_model('annotations', admin_user, instance=instance, type='name',
+                   data=json.dumps({'name': 'f{}'.format(offset)})).save()
+      create_model('annotations', admin_user, instance=instance,
+                   type='prototype', data='{}').save()
+      create_model('vectors', admin_user, instance=instance,
+                   file_version=file_version).save()
+
+  add_instances(range(2))
+  results, query_count = list_instances()
+  assert len(results) == 2
+
+  # serializing more instances does not query any more
+  add_instances(range(2, 10))
+  results, more_query_count = list_instances()
+  assert len(results) == 10
+  assert more_query_count == query_count
+
+  assert sorted(r['name'] for r in results) == sorted('f{}'.format(i)
+                                                      for i in range(10))
+  if 'annotation_count' in params:
+    assert all(r['annotation_count'] == 2 for r in results)
+  if 'full' in params:
+    assert all(len(r['vectors']) == 1 and len(r['annotations']) == 2
+               for r in results)
@@ -1,9 +1,12 @@
+import json
+
 import pytest
 from rest_framework import status
 
-from utils import assert_response
+from utils import assert_response, create_model
 
-from collab import strategies
+from collab import strategies, matchers
+from collab.models import FileVersion, Vector
 
 
 def test_get_strategy_failure():
@@ -25,3 +28,236 @@ def test_strategies_abstract(admin_client):
     admin_client.get('/collab/matches/strategies/',
                      content_type="application/json")
   assert ex.value.args[0] == "Abstract strategy in list"
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize('strategy_type', ['all_strategy',
+                                           'binning_strategy',
+                                           'cascade_strategy'])
+def test_step_params(strategy_type):
+  strategy = strategies.get_strategy(strategy_type, vector_cls=Vector,
+                                     source_file=1, source_start=None,
+                                     source_end=None, source_file_version=1,
+                                     target_project=None, target_file=None,
+                                     matchers=json.dumps(['name_hash']))
+  step = strategy.step_cls(strategy, matchers.NameHashMatcher,
+                           *([16, 32] if strategy_type == 'binning_strategy'
+                             else []))
+
+  rebuilt_step = strategy.build_step(**step.get_params())
+  assert type(rebuilt_step) is type(step)
+  assert rebuilt_step.get_params() == step.get_params()
+  assert str(rebuilt_step.get_source_filter()) == str(step.get_source_filter())
+
+
+def get_binning_strategy(**kwargs):
+  return strategies.get_strategy('binning_strategy', vector_cls=Vector,
+                                 source_start=None, source_end=None,
+                                 target_project=None, target_file=None,
+                                 matchers=json.dumps(['assembly_hash']),
+                                 **kwargs)
+
+
+def test_binning_type_bins():
+  strategy = get_binning_strategy(source_file=1, source_file_version=1)
+  quantiles = [8] * 127 + list(range(20, 20 + 128))
+
+  # quantiles below MINIMAL_BIN_SIZE are all binned together
+  bins = strategy.get_type_bins(1000, 1000, quantiles)
+  assert len(bins) == strategy.BIN_COUNT // 2 + 1
+  assert bins[0] == (None, 20)
+  assert bins[-1][1] is None
+  assert all(a[1] == b[0] for a, b in zip(bins[:-1], bins[1:]))
+
+  # too many pairs per bin require more bins
+  many_bins = strategy.get_type_bins(10 ** 6, 10 ** 6, quantiles)
+  assert len(many_bins) > len(bins)
+
+  assert strategy.get_type_bins(0, 1000, quantiles) == []
+
+
+def test_binning_bins(admin_user):
+  source = create_model('file_versions', admin_user)
+  source.save()
+  for offset, size in enumerate([4, 8, 30, 100, 1000]):
+    instance = create_model('instances', admin_user, file_version=source,
+                            offset=offset, size=size)
+    instance.save()
+    create_model('vectors', admin_user, instance=instance,
+                 file_version=source).save()
+  for size in [4, 30, 40, 50, 60, 70, 2000]:
+    instance = create_model('instances', admin_user, size=size)
+    instance.file_version.complete = True
+    instance.file_version.save()
+    instance.save()
+    create_model('vectors', admin_user, instance=instance,
+                 file_version=instance.file_version).save()
+
+  strategy = get_binning_strategy(source_file=source.file_id,
+                                  source_file_version=source.id)
+  bins = strategy.get_bins()
+  assert list(bins.keys()) == ['assembly_hash']
+  assert bins['assembly_hash'][0][0] is None
+  assert bins['assembly_hash'][-1][1] is None
+
+  # every source vector is matched by a single step
+  source_counts = [Vector.objects.filter(step.get_source_filter()).count()
+                   for step in strategy.get_ordered_steps()]
+  assert len(source_counts) == len(bins['assembly_hash'])
+  assert sum(source_counts) == 5
+
+
+@pytest.mark.parametrize('source_counts, target_counts, blocks, pairs', [
+    ([1, 2, 3], [1, 2, 3], 2, 1 * 3 + 2 * 3),
+    ([10, 11], [100, 1000], 0, 0),
+    ([100, 150], [60, 100, 300, 600], 2, 2 + 2)])
+def test_blocking(admin_user, source_counts, target_counts, blocks, pairs):
+  source = create_model('file_versions', admin_user)
+  source.save()
+  target = create_model('file_versions', admin_user)
+  target.save()
+  for file_version, counts in ((source, source_counts),
+                               (target, target_counts)):
+    for offset, count in enumerate(counts):
+      instance = create_model('instances', admin_user,
+                              file_version=file_version, offset=offset,
+                              count=count)
+      instance.save()
+      create_model('vectors', admin_user, instance=instance,
+                   file_version=file_version).save()
+
+  blocking = strategies.Blocking(strategies.BlockingKey('count_band',
+                                                        'instance__count',
+                                                        tolerance=1))
+  source_vectors = Vector.objects.filter(file_version=source)
+  target_vectors = Vector.objects.filter(file_version=target)
+  result = blocking.get_blocks(source_vectors, target_vectors)
+  block_filters, candidate_pairs, total_pairs = result
+
+  assert len(block_filters) == blocks
+  assert candidate_pairs == pairs
+  assert total_pairs == len(source_counts) * len(target_counts)
+
+  # candidate pairs are exactly the pairs of all blocks
+  source_vectors = blocking.annotate(source_vectors)
+  target_vectors = blocking.annotate(target_vectors)
+  assert candidate_pairs == sum(
+    source_vectors.filter(**source_filter).count() *
+    target_vectors.filter(**target_filter).count()
+    for source_filter, target_filter in block_filters)
+
+
+def test_blocking_top_k(admin_user):
+  source = create_model('file_versions', admin_user)
+  source.save()
+  target = create_model('file_versions', admin_user)
+  target.save()
+  for file_version, hists in ((source, [{'mov': 4, 'push': 1},
+                                        {'mov': 1, 'push': 4}]),
+                              (target, [{'mov': 4, 'push': 1},
+                                        {'mov': 1, 'push': 4},
+                                        {'mov': 2, 'push': 2}])):
+    for hist in hists:
+      create_model('vectors', admin_user, type='mnemonic_hist',
+                   data=json.dumps(hist), file_version=file_version).save()
+
+  strategy = strategies.get_strategy('blocking_strategy', vector_cls=Vector,
+                                     source_file=source.file_id,
+                                     source_start=None, source_end=None,
+                                     source_file_version=source.id,
+                                     target_project=None, target_file=None,
+                                     matchers=json.dumps(['mnemonic_'
+                                                          'euclidean']),
+                                     top_k=1)
+  step = strategy.step_cls(strategy, matchers.MnemonicEuclideanMatcher)
+  source_vectors = Vector.objects.filter(file_version=source)
+  target_vectors = Vector.objects.filter(file_version=target)
+  assert step.is_blocked()
+  matches = list(step.gen_matches(source_vectors, target_vectors))
+
+  # a single match of each source instance, its best in its block
+  best_targets = {source_vector.instance_id: target_vector.instance_id
+                  for source_vector, target_vector
+                  in zip(source_vectors.order_by('id'),
+                         target_vectors.order_by('id'))}
+  assert len(matches) == 2
+  assert {m[0]: m[1] for m in matches} == best_targets
+
+  # hash steps match all pairs, in python or by a query alike
+  hash_step = strategy.step_cls(strategy, matchers.AssemblyHashMatcher)
+  assert not hash_step.is_blocked()
+  assert hash_step.get_match_query(source_vectors, target_vectors)
+  assert step.get_match_query(source_vectors, target_vectors) is None
+
+
+def test_target_latest_version(admin_user, admin_api_client):
+  source = create_model('file_versions', admin_user)
+  source.save()
+  older = create_model('file_versions', admin_user, complete=True)
+  older.save()
+  newer = create_model('file_versions', admin_user, file=older.file,
+                       md5hash='K' * 32)
+  newer.save()
+  for file_version in (source, older, newer):
+    instance = create_model('instances', admin_user,
+                            file_version=file_version)
+    instance.save()
+    create_model('vectors', admin_user, instance=instance,
+                 file_version=file_version).save()
+
+  strategy = get_binning_strategy(source_file=source.file_id,
+                                  source_file_version=source.id)
+
+  def get_target_versions():
+    target_vectors = Vector.objects.filter(strategy.get_target_filter())
+    return list(target_vectors.values_list('file_version_id', flat=True))
+
+  # incomplete versions are never matched against
+  assert get_target_versions() == [older.id]
+
+  newer.complete = True
+  newer.save()
+  assert get_target_versions() == [newer.id]
+
+  # completing an older version does not replace the newest one
+  older.save()
+  assert get_target_versions() == [newer.id]
+
+  # marking the newest version incomplete again falls back to the older one
+  newer.complete = False
+  newer.save()
+  assert get_target_versions() == [older.id]
+
+  newer.complete = True
+  newer.save()
+  assert get_target_versions() == [newer.id]
+
+  # force recreating the newest version falls back to the older one
+  response = admin_api_client.post('/collab/file_versions/?force=1',
+                                   {'file': older.file_id,
+                                    'md5hash': newer.md5hash},
+                                   format='json')
+  assert response.status_code == status.HTTP_201_CREATED
+  assert get_target_versions() == [older.id]
+
+  # deleting the latest version, by itself or in bulk, falls back to the
+  # newest remaining complete version
+  newest = create_model('file_versions', admin_user, file=older.file,
+                        md5hash='L' * 32, complete=True)
+  newest.save()
+  older.file.refresh_from_db()
+  assert older.file.latest_version_id == newest.id
+  response = admin_api_client.delete('/collab/file_versions/{}/'
+                                     ''.format(newest.id))
+  assert response.status_code == status.HTTP_204_NO_CONTENT
+  older.file.refresh_from_db()
+  assert older.file.latest_version_id == older.id
+
+  newest = create_model('file_versions', admin_user, file=older.file,
+                        md5hash='M' * 32, complete=True)
+  newest.save()
+  instance = create_model('instances', admin_user, file_version=newest)
+  instance.save()
+  FileVersion.objects.filter(id=newest.id).delete()
+  older.file.refresh_from_db()
+  assert older.file.latest_version_id == older.id
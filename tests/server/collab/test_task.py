@@ -1,13 +1,42 @@
+import json
+import zlib
+
 import pytest
 
 from utils import create_model
 
+from collab.models import Task, Match, MatchSummary, MatchCache
+from collab.assignment import is_optimal_assignment_supported
+
+
+pytestmark = pytest.mark.usefixtures('celery_eager')
+
+requires_optimal = pytest.mark.skipif(not is_optimal_assignment_supported(),
+                                      reason="requires scipy 1.6")
+
+
+def complete_target(vector):
+  # only vectors of complete file versions are matched against
+  vector.file_version.complete = True
+  vector.file_version.save()
+  vector.instance.file_version = vector.file_version
+
+
+def create_target_vector(admin_user, **kwargs):
+  vector = create_model('vectors', admin_user, **kwargs)
+  complete_target(vector)
+  vector.instance.save()
+  vector.save()
+  return vector
+
 
 @pytest.mark.parametrize('params', [{},
                                     {'source_start': 1000},
                                     {'source_end': 1000},
                                     {'target_file': 'files'},
-                                    {'strategy': 'binning_strategy'}])
+                                    {'strategy': 'binning_strategy'},
+                                    {'strategy': 'cascade_strategy'},
+                                    {'top_k': 1}])
 def test_empty_task(admin_user, params):
   task = create_model('tasks', admin_user, **params)
   task.save()
@@ -24,13 +53,286 @@ def test_task(admin_user):
                file_version=task.source_file_version).save()
   create_model('vectors', admin_user,
                file_version=task.source_file_version).save()
-  create_model('vectors', admin_user).save()
-  create_model('vectors', admin_user).save()
-  create_model('vectors', admin_user).save()
+  create_target_vector(admin_user)
+  create_target_vector(admin_user)
+  create_target_vector(admin_user)
+
+  from collab.tasks import match
+  match(task.id)
+
+  task.refresh_from_db()
+  assert task.status == Task.STATUS_DONE
+  assert task.match_count == 2 * 3
+  assert task.local_count == 2
+  assert task.remote_count == 3
+  assert Match.objects.filter(task=task, score=100).count() == 2 * 3
+  assert task.pair_count == 2 * 3
+
+
+def test_task_dictionary_matcher(admin_user):
+  task = create_model('tasks', admin_user, target_project=None,
+                      matchers='["mnemonic_euclidean"]')
+  task.save()
+
+  hist = '{"mov": 5, "push": 3, "call": 2}'
+  for file_version in (task.source_file_version, None, None):
+    vector = create_model('vectors', admin_user, type='mnemonic_hist',
+                          data=hist)
+    if file_version:
+      vector.file_version = file_version
+    else:
+      complete_target(vector)
+    vector.instance.count = 10
+    vector.instance.save()
+    vector.save()
+
+  from collab.tasks import match
+  match(task.id)
+
+  task.refresh_from_db()
+  assert task.status == Task.STATUS_DONE
+  assert task.match_count == 2
+  matches = Match.objects.filter(task=task, type='mnemonic_euclidean')
+  assert matches.count() == 2
+  assert all(m.score == 100 for m in matches)
+
+
+@pytest.mark.parametrize('strategy, match_count', [('all_strategy', 2),
+                                                    ('blocking_strategy', 1)])
+def test_task_blocking(admin_user, strategy, match_count):
+  task = create_model('tasks', admin_user, target_project=None,
+                      matchers='["mnemonic_euclidean"]', strategy=strategy)
+  task.save()
+
+  # the last target has far more instructions than the source
+  hist = '{"mov": 5, "push": 3, "call": 2}'
+  for file_version, count in ((task.source_file_version, 10), (None, 12),
+                              (None, 200)):
+    vector = create_model('vectors', admin_user, type='mnemonic_hist',
+                          data=hist)
+    if file_version:
+      vector.file_version = file_version
+    else:
+      complete_target(vector)
+    vector.instance.count = count
+    vector.instance.save()
+    vector.save()
+
+  from collab.tasks import match
+  match(task.id)
+
+  task.refresh_from_db()
+  assert task.status == Task.STATUS_DONE
+  assert task.match_count == match_count
+
+
+def test_task_match_cache(admin_user, admin_api_client):
+  task = create_model('tasks', admin_user, target_project=None)
+  task.source_file_version.complete = True
+  task.source_file_version.save()
+  task.save()
+
+  create_model('vectors', admin_user,
+               file_version=task.source_file_version).save()
+  target_vectors = [create_model('vectors', admin_user) for _ in range(3)]
+  for vector in target_vectors:
+    complete_target(vector)
+    vector.instance.save()
+    vector.save()
+
+  from collab.tasks import match
+  match(task.id)
+  assert MatchCache.objects.filter(task=task).count() == 3
+
+  cached_task = create_model('tasks', admin_user, target_project=None,
+                             source_file_version=task.source_file_version)
+  cached_task.save()
+  match(cached_task.id)
+
+  # every match was copied out of the cache, none was recorded again
+  cached_task.refresh_from_db()
+  assert cached_task.status == Task.STATUS_DONE
+  assert cached_task.match_count == 3
+  assert cached_task.remote_count == 3
+  assert not MatchCache.objects.filter(task=cached_task).exists()
+  matches = Match.objects.filter(task=cached_task)
+  assert (sorted(matches.values_list('from_instance', 'to_instance', 'score',
+                                     'type')) ==
+          sorted(Match.objects.filter(task=task)
+                              .values_list('from_instance', 'to_instance',
+                                           'score', 'type')))
+
+  # completing a newer version of a target file invalidates its entry
+  file_version = create_model('file_versions', admin_user,
+                              file=target_vectors[0].file_version.file)
+  file_version.save()
+  response = admin_api_client.patch('/collab/file_versions/{}/'
+                                    ''.format(file_version.id),
+                                    {'complete': True}, format='json')
+  assert response.status_code == 200
+  assert MatchCache.objects.filter(task=task).count() == 2
+
+
+@pytest.mark.parametrize('strategy, match_count',
+                         [('all_strategy', 3),
+                          ('cascade_strategy', 2),
+                          ('exclusive_cascade_strategy', 1)])
+def test_task_cascade(admin_user, strategy, match_count):
+  task = create_model('tasks', admin_user, target_project=None,
+                      strategy=strategy)
+  task.save()
+
+  # the name hash only matches the first source instance to the target, the
+  # assembly hash matches both source instances to it
+  source_instances = [create_model('instances', admin_user,
+                                   file_version=task.source_file_version,
+                                   offset=offset)
+                      for offset in (0, 16)]
+  target_instance = create_model('instances', admin_user)
+  target_instance.file_version.complete = True
+  target_instance.file_version.save()
+  instance_types = [(source_instances[0], ('name_hash', 'assembly_hash')),
+                    (source_instances[1], ('assembly_hash',)),
+                    (target_instance, ('name_hash', 'assembly_hash'))]
+  for instance, vector_types in instance_types:
+    instance.save()
+    for vector_type in vector_types:
+      create_model('vectors', admin_user, type=vector_type,
+                   instance=instance,
+                   file_version=instance.file_version).save()
 
   from collab.tasks import match
   match(task.id)
 
+  task.refresh_from_db()
+  assert task.status == Task.STATUS_DONE
+  assert task.match_count == match_count
+  assert Match.objects.filter(task=task).count() == match_count
+
+
+def test_task_match_summary(admin_user, admin_api_client):
+  task = create_model('tasks', admin_user, target_project=None)
+  task.save()
+
+  source_instance = create_model('instances', admin_user,
+                                 file_version=task.source_file_version)
+  source_instance.save()
+  target_instances = [create_model('instances', admin_user)
+                      for _ in range(2)]
+  instance_types = [(source_instance, ('name_hash', 'assembly_hash')),
+                    (target_instances[0], ('name_hash', 'assembly_hash')),
+                    (target_instances[1], ('assembly_hash',))]
+  for instance, vector_types in instance_types:
+    instance.file_version.complete = True
+    instance.file_version.save()
+    instance.save()
+    for vector_type in vector_types:
+      create_model('vectors', admin_user, type=vector_type,
+                   instance=instance,
+                   file_version=instance.file_version).save()
+
+  from collab.tasks import match
+  match(task.id)
+
+  task.refresh_from_db()
+  assert task.match_count == 3
+  assert task.pair_count == 2
+  assert MatchSummary.objects.filter(task=task).count() == 2
+
+  response = admin_api_client.get('/collab/match_summaries/',
+                                  {'task': task.id})
+  assert response.status_code == 200
+  summaries = {s['to_instance']: s for s in response.json()['results']}
+  assert summaries[target_instances[0].id]['matchers'] == ['name_hash',
+                                                           'assembly_hash']
+  assert summaries[target_instances[1].id]['matchers'] == ['assembly_hash']
+  assert all(s['from_instance'] == source_instance.id and s['score'] == 100
+             for s in summaries.values())
+
+  # pairs matched by types of no listed matcher, such as removed ones
+  removed_instance = create_model('instances', admin_user)
+  removed_instance.save()
+  Match.objects.create(task=task, from_instance=source_instance,
+                       to_instance=removed_instance, type='removed_hash',
+                       score=50)
+  from collab.tasks import summarize_matches
+  assert summarize_matches(task.id) == 3
+  assert (MatchSummary.objects.get(task=task, to_instance=removed_instance)
+                              .matchers == 0)
+
+
+@pytest.mark.parametrize('assignment, assignment_limit, match_count',
+                         [('none', 1, 2 * 3),
+                          ('greedy', 1, 2),
+                          ('greedy', 2, 4),
+                          pytest.param('optimal', 1, 2,
+                                       marks=requires_optimal)])
+def test_task_assignment(admin_user, assignment, assignment_limit,
+                         match_count):
+  task = create_model('tasks', admin_user, target_project=None,
+                      assignment=assignment,
+                      assignment_limit=assignment_limit)
+  task.save()
+
+  create_model('vectors', admin_user,
+               file_version=task.source_file_version).save()
+  create_model('vectors', admin_user,
+               file_version=task.source_file_version).save()
+  create_target_vector(admin_user)
+  create_target_vector(admin_user)
+  create_target_vector(admin_user)
+
+  from collab.tasks import match
+  match(task.id)
+
+  task.refresh_from_db()
+  assert task.status == Task.STATUS_DONE
+  assert task.match_count == match_count
+  assert Match.objects.filter(task=task).count() == match_count
+  assert task.local_count == 2
+
+
+def test_task_assignment_match_cache(admin_user):
+  source_file_version = create_model('file_versions', admin_user,
+                                     complete=True)
+  source_file_version.save()
+  for _ in range(2):
+    create_model('vectors', admin_user,
+                 file_version=source_file_version).save()
+  for _ in range(3):
+    create_target_vector(admin_user)
+
+  from collab.tasks import match
+  tasks = []
+  for assignment in ('greedy', 'none'):
+    task = create_model('tasks', admin_user, target_project=None,
+                        source_file_version=source_file_version,
+                        assignment=assignment)
+    task.save()
+    match(task.id)
+    task.refresh_from_db()
+    tasks.append(task)
+
+  # matches the assigned task deleted are not reused by the unassigned task
+  assigned_task, task = tasks
+  assert assigned_task.match_count == 2
+  assert not MatchCache.objects.filter(task=assigned_task).exists()
+  assert task.match_count == 2 * 3
+  assert Match.objects.filter(task=task).count() == 2 * 3
+
+
+@requires_optimal
+def test_task_assignment_validation(admin_api_client, admin_user):
+  file_version = create_model('file_versions', admin_user)
+  file_version.save()
+  response = admin_api_client.post('/collab/tasks/',
+                                   {'source_file_version': file_version.id,
+                                    'matchers': '[]',
+                                    'assignment': 'optimal',
+                                    'assignment_limit': 2}, format='json')
+  assert response.status_code == 400
+  assert 'one-to-one' in str(response.data)
+
 
 def test_task_nonexistant_matcher(admin_user):
   task = create_model('tasks', admin_user, matchers='["nonexistant_matcher"]')
@@ -40,3 +342,100 @@ def test_task_nonexistant_matcher(admin_user):
   with pytest.raises(ValueError) as ex:
     match(task.id)
   assert 'Unfamiliar matchers were requested' in ex.value.args[0]
+
+
+@pytest.mark.parametrize('accept_encoding, gzipped',
+                         [(None, False), ('gzip', True),
+                          ('deflate, GZIP;q=0.5', True), ('*', True),
+                          ('gzip;q=0', False), ('gzip;q=0.0, *', False),
+                          ('identity, *;q=0', False)])
+def test_task_export(admin_user, admin_api_client, accept_encoding, gzipped):
+  task = create_model('tasks', admin_user, target_project=None)
+  task.save()
+
+  create_model('vectors', admin_user,
+               file_version=task.source_file_version).save()
+  for _ in range(3):
+    create_target_vector(admin_user)
+
+  from collab.tasks import match
+  match(task.id)
+
+  headers = {}
+  if accept_encoding is not None:
+    headers['HTTP_ACCEPT_ENCODING'] = accept_encoding
+  for url, count in (('/collab/matches/export/', 3),
+                     ('/collab/match_summaries/export/', 3)):
+    response = admin_api_client.get(url, {'task': task.id}, **headers)
+    assert response.status_code == 200
+    assert response.streaming
+    assert response['Content-Type'] == 'application/x-ndjson'
+    content = b''.join(response.streaming_content)
+    if gzipped:
+      assert response['Content-Encoding'] == 'gzip'
+      content = zlib.decompress(content, 16 + zlib.MAX_WBITS)
+    else:
+      assert not response.has_header('Content-Encoding')
+    rows = [json.loads(line) for line in content.decode('utf-8').splitlines()]
+    assert len(rows) == count
+    assert all(row['task'] == task.id and row['score'] == 100 for row in rows)
+
+  summaries = admin_api_client.get('/collab/match_summaries/export/',
+                                   {'task': task.id})
+  rows = [json.loads(line) for line in b''.join(summaries.streaming_content)
+                                         .decode('utf-8').splitlines()]
+  assert all(row['matchers'] == ['assembly_hash'] for row in rows)
+
+  # exporting all matches of all tasks at once is not allowed
+  response = admin_api_client.get('/collab/matches/export/')
+  assert response.status_code == 400
+
+
+def test_task_results(admin_user, admin_api_client):
+  task = create_model('tasks', admin_user, target_project=None)
+  task.save()
+
+  for offset in (0, 16):
+    instance = create_model('instances', admin_user,
+                            file_version=task.source_file_version,
+                            offset=offset)
+    instance.save()
+    create_model('vectors', admin_user, instance=instance,
+                 file_version=task.source_file_version).save()
+  target_vectors = [create_target_vector(admin_user) for _ in range(3)]
+  create_model('annotations', admin_user,
+               instance=target_vectors[0].instance, type='name',
+               data=json.dumps({'name': 'remote_main'})).save()
+
+  from collab.tasks import match
+  match(task.id)
+
+  response = admin_api_client.get('/collab/tasks/{}/results/'
+                                  ''.format(task.id))
+  assert response.status_code == 200
+  assert response['Content-Type'] == 'application/x-ndjson'
+  rows = [json.loads(line) for line in b''.join(response.streaming_content)
+                                         .decode('utf-8').splitlines()]
+
+  # every instance is sent once, before any of its matches
+  sent = set()
+  for row in rows:
+    if row['kind'] == 'match':
+      assert ('local', row['from_instance']) in sent
+      assert ('remote', row['to_instance']) in sent
+    else:
+      assert (row['kind'], row['id']) not in sent
+      sent.add((row['kind'], row['id']))
+
+  kinds = [row['kind'] for row in rows]
+  assert kinds.count('local') == 2
+  assert kinds.count('remote') == 3
+  assert kinds.count('match') == 2 * 3
+
+  remotes = {row['id']: row for row in rows if row['kind'] == 'remote'}
+  named_remote = remotes[target_vectors[0].instance_id]
+  assert named_remote['name'] == 'remote_main'
+  assert named_remote['annotation_count'] == 1
+  assert remotes[target_vectors[1].instance_id]['annotation_count'] == 0
+  assert all(row['matchers'] == ['assembly_hash'] for row in rows
+             if row['kind'] == 'match')
@@ -5,3 +5,19 @@ import pytest
 def django_db_use_migrations(request):
   del request
   return False
+
+
+@pytest.fixture
+def celery_eager():
+  # run tasks, including any subtasks they spawn, synchronously in-process
+  from rematch.celery import app
+  app.conf.task_always_eager = True
+  app.conf.task_eager_propagates = True
+  yield
+  app.conf.task_always_eager = False
+  app.conf.task_eager_propagates = False
+
+
+@pytest.fixture(autouse=True)
+def feature_store_root(settings, tmpdir):
+  settings.FEATURE_STORE_ROOT = str(tmpdir.join('feature_store'))